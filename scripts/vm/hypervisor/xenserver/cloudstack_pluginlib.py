@@ -18,6 +18,7 @@
 # Common function for Cloudstack's XenAPI plugins
 
 import ConfigParser
+import fcntl
 import logging
 import os
 import subprocess
@@ -765,65 +766,83 @@ def configure_vpc_bridge_for_routing_policies(bridge, json_config, sequence_no):
 # configures bridge L2 flooding rules stored in table=2. Single bridge is used for all the tiers of VPC. So controlled
 # flooding is required to restrict the broadcast to only to the ports (vifs and tunnel interfaces) in the tier. Also
 # packets arrived from the tunnel ports should not be flooded on the other tunnel ports.
+#
+# The ofport and network id of the ports on the bridge are kept in /var/run/cloud/<bridge>.ports, so a plug or unplug
+# only looks up the ports that are new and only rewrites the flooding rules of the tiers whose ports changed.
 def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_network_id):
 
-    class tier_ports:
-        tier_vif_ofports = []
-        tier_tunnelif_ofports = []
-        tier_all_ofports = []
-
     logging.debug("Updating the flooding rules on bridge " + bridge + " as interface  %s" %interface +
                   " is %s"%command + " now.")
+    ofspec_filename = None
     try:
 
         if not os.path.exists('/var/run/cloud'):
             os.makedirs('/var/run/cloud')
 
-        # create a temporary file to store OpenFlow rules corresponding L2 flooding table
-        ofspec_filename = "/var/run/cloud/" + bridge + "-" +interface + "-" + command + ".ofspec"
-        ofspec = open(ofspec_filename, 'w+')
+        # serialize the updates of the port map of the bridge
+        ports_filename = "/var/run/cloud/" + bridge + ".ports"
+        lock = open(ports_filename + ".lock", 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
 
-        all_tiers = dict()
+        ports = dict()
+        if os.path.isfile(ports_filename):
+            ports_file = open(ports_filename)
+            try:
+                ports = json.load(ports_file)
+            except ValueError:
+                logging.debug("Ignoring the corrupt port map " + ports_filename)
+            ports_file.close()
 
         vsctl_output = do_cmd([VSCTL_PATH, 'list-ports', bridge])
-        ports = vsctl_output.split('\n')
-
-        for port in ports:
-
+        bridge_ports = [port for port in vsctl_output.split('\n') if port.startswith('vif') or port.startswith('t')]
+        if command == 'offline' and interface in bridge_ports:
+            bridge_ports.remove(interface)
+
+        # forget the ports that left the bridge, a plugged interface is looked up again
+        affected_tiers = set()
+        removed_ofports = []
+        for port in ports.keys():
+            if port not in bridge_ports or (port == interface and command == 'online'):
+                port_info = ports.pop(port)
+                affected_tiers.add(port_info['network_id'])
+                removed_ofports.append(port_info['ofport'])
+
+        for port in bridge_ports:
+            if port in ports:
+                continue
             if_ofport = do_cmd([VSCTL_PATH, 'get', 'Interface', port, 'ofport'])
-
-            if port.startswith('vif'):
+            if port == interface:
+                network_id = if_network_id
+            elif port.startswith('vif'):
                 network_id = get_network_id_for_vif(port)
-                if network_id not in all_tiers.keys():
-                    all_tiers[network_id] = tier_ports()
-                tier_ports_info = all_tiers[network_id]
-                tier_ports_info.tier_vif_ofports.append(if_ofport)
-                tier_ports_info.tier_all_ofports.append(if_ofport)
-                all_tiers[network_id] = tier_ports_info
-
-            if port.startswith('t'):
+            else:
                 network_id = get_network_id_for_tunnel_port(port)[1:-1]
-                if network_id not in all_tiers.keys():
-                    all_tiers[network_id] = tier_ports()
-                tier_ports_info = all_tiers[network_id]
-                tier_ports_info.tier_tunnelif_ofports.append(if_ofport)
-                tier_ports_info.tier_all_ofports.append(if_ofport)
-                all_tiers[network_id] = tier_ports_info
-
-        for network_id, tier_ports_info in all_tiers.items():
-            if len(tier_ports_info.tier_all_ofports) == 1 :
+            ports[port] = {'ofport': if_ofport, 'network_id': network_id, 'tunnel': not port.startswith('vif')}
+            affected_tiers.add(network_id)
+
+        # create a temporary file to store OpenFlow rules corresponding L2 flooding table
+        ofspec_filename = "/var/run/cloud/" + bridge + "-" +interface + "-" + command + ".ofspec"
+        ofspec = open(ofspec_filename, 'w+')
+
+        for network_id in affected_tiers:
+            tier_vif_ofports = [p['ofport'] for p in ports.values() if p['network_id'] == network_id and not p['tunnel']]
+            tier_tunnelif_ofports = [p['ofport'] for p in ports.values() if p['network_id'] == network_id and p['tunnel']]
+            tier_all_ofports = tier_vif_ofports + tier_tunnelif_ofports
+            if len(tier_all_ofports) == 1 :
+                # nothing to flood to anymore
+                removed_ofports.append(tier_all_ofports[0])
                 continue
 
             # for a packet arrived from tunnel port, flood only on to VIF ports connected to bridge for this tier
-            for port in tier_ports_info.tier_tunnelif_ofports:
-                action = "".join("output:%s," %ofport for ofport in tier_ports_info.tier_vif_ofports)[:-1]
+            for port in tier_tunnelif_ofports:
+                action = "".join("output:%s," %ofport for ofport in tier_vif_ofports)[:-1]
                 ofspec.write("table=%s " %L2_FLOOD_TABLE + " priority=1100 in_port=%s " %port +
                              "actions=%s " %action + "\n")
 
             # for a packet arrived from VIF port send on all VIF and tunnel ports corresponding to the tier excluding
             # the port on which packet arrived
-            for port in tier_ports_info.tier_vif_ofports:
-                tier_all_ofports_copy = copy.copy(tier_ports_info.tier_all_ofports)
+            for port in tier_vif_ofports:
+                tier_all_ofports_copy = copy.copy(tier_all_ofports)
                 tier_all_ofports_copy.remove(port)
                 action = "".join("output:%s," %ofport for ofport in tier_all_ofports_copy)[:-1]
                 ofspec.write("table=%s " %L2_FLOOD_TABLE + " priority=1100 in_port=%s " %port +
@@ -832,8 +851,9 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
         # add a default rule in L2 flood table to drop packet
         ofspec.write("table=%s " %L2_FLOOD_TABLE + " priority=0 actions=drop")
 
-        # First flush current L2 flooding table before re-populating the tables
-        del_flows(bridge, table=L2_FLOOD_TABLE)
+        # flows of the other tiers are left alone, the rewritten ones replace the flows with the same match
+        for ofport in removed_ofports:
+            del_flows(bridge, in_port=ofport, table=L2_FLOOD_TABLE)
 
         ofspec.seek(0)
         logging.debug("Adding below flows rules L2 flooding table: \n" + ofspec.read())
@@ -845,10 +865,16 @@ def update_flooding_rules_on_port_plug_unplug(bridge, interface, command, if_net
         # now that we updated the bridge with flow rules delete the file.
         os.remove(ofspec_filename)
 
+        ports_file = open(ports_filename + ".tmp", 'w')
+        json.dump(ports, ports_file)
+        ports_file.close()
+        os.rename(ports_filename + ".tmp", ports_filename)
+        lock.close()
+
         logging.debug("successfully configured bridge %s as per the latest flooding rules " %bridge)
 
     except Exception,e:
-        if os.path.isfile(ofspec_filename):
+        if ofspec_filename and os.path.isfile(ofspec_filename):
             os.remove(ofspec_filename)
         error_message = "An unexpected error occurred while updating the flooding rules for the bridge " + \
                         bridge + " when interface " + " %s" %interface + " is %s" %command
@@ -19,23 +19,26 @@
 import pprint
 import XenAPI
 import urllib
-from xml.dom import minidom
+import threading
+from array import array
+from xml.parsers import expat
 import time
-import commands
 
-# Per VM dictionary (used by RRDUpdates to look up column numbers by variable names)
+# Per VM dictionary (used by RRDUpdates to look up the values by variable names)
 class VMReport(dict):
     """Used internally by RRDUpdates"""
     def __init__(self, uuid):
         self.uuid = uuid
+        self.rows = 0
         super(dict, self).__init__()
 
 
-# Per Host dictionary (used by RRDUpdates to look up column numbers by variable names)
+# Per Host dictionary (used by RRDUpdates to look up the values by variable names)
 class HostReport(dict):
     """Used internally by RRDUpdates"""
     def __init__(self, uuid):
         self.uuid = uuid
+        self.rows = 0
         super(dict, self).__init__()
 
 
@@ -51,6 +54,53 @@ class UsageException(Exception):
     pass
 
 
+class RRDDocument:
+    """ Streaming parser for one rrd_updates document
+
+    The values of each column (variable) end up in an array of doubles in
+    chronological order, the document itself is never held in memory.
+    expat is used directly as xml.etree is not available on older dom0s.
+    """
+    def __init__(self):
+        self.meta = {}
+        self.legend = []
+        self.times = array('l')
+        self.values = []
+        self.__text = []
+        self.__col = 0
+
+    def parse(self, source):
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self.__start
+        parser.EndElementHandler = self.__end
+        parser.CharacterDataHandler = self.__text.append
+        parser.ParseFile(source)
+        # the <row> nodes are in reverse chronological order
+        self.times.reverse()
+        for values in self.values:
+            values.reverse()
+        self.rows = len(self.times)
+        return self
+
+    def __start(self, name, attrs):
+        del self.__text[:]
+        if name == 'row':
+            self.__col = 0
+
+    def __end(self, name):
+        if name == 'v':
+            self.values[self.__col].append(float(''.join(self.__text)))
+            self.__col += 1
+        elif name == 't':
+            self.times.append(int(''.join(self.__text)))
+        elif name == 'entry':
+            self.legend.append(''.join(self.__text))
+        elif name == 'legend':
+            self.values = [array('d') for entry in self.legend]
+        elif name in ['start', 'step', 'end', 'rows', 'columns']:
+            self.meta[name] = int(''.join(self.__text))
+
+
 class RRDUpdates:
     """ Object used to get and parse the output the http://localhost/rrd_udpates?...
     """
@@ -62,7 +112,9 @@ class RRDUpdates:
         self.params['cf'] = 'AVERAGE'  # consolidation function, each sample averages 12 from the 5 second RRD
         self.params['interval'] = '60'
 
-    def get_nrows(self):
+    def get_nrows(self, uuid=None):
+        if uuid is not None:
+            return self.vm_reports[uuid].rows
         return self.rows
 
     def get_vm_list(self):
@@ -87,11 +139,7 @@ class RRDUpdates:
             return result
 
     def get_vm_data(self, uuid, param, row):
-	#pp = pprint.PrettyPrinter(indent=4) 
-	#pp.pprint(self.vm_reports)
-        report = self.vm_reports[uuid]
-        col = report[param]
-        return self.__lookup_data(col, row)
+        return self.vm_reports[uuid][param][row]
 
     def get_host_uuid(self):
         report = self.host_report
@@ -106,26 +154,10 @@ class RRDUpdates:
         return report.keys()
 
     def get_host_data(self, param, row):
-        report = self.host_report
-        col = report[param]
-        return self.__lookup_data(col, row)
+        return self.host_report[param][row]
 
     def get_row_time(self, row):
-        return self.__lookup_timestamp(row)
-
-    # extract float from value (<v>) node by col,row
-    def __lookup_data(self, col, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[col + 1]
-        return float(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
-
-    # extract int from value (<t>) node by row
-    def __lookup_timestamp(self, row):
-        # Note: the <rows> nodes are in reverse chronological order, and comprise
-        # a timestamp <t> node, followed by self.columns data <v> nodes
-        node = self.data_node.childNodes[self.rows - 1 - row].childNodes[0]
-        return int(node.firstChild.toxml())  # node.firstChild should have nodeType TEXT_NODE
+        return self.times[row]
 
     def refresh(self, login, starttime, session, override_params):
         self.params['start'] = starttime
@@ -133,48 +165,56 @@ class RRDUpdates:
         params['session_id'] = session
         params.update(self.params)
         paramstr = "&".join(["%s=%s" % (k, params[k]) for k in params])
-        # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
-        # rather than drop into interactive mode
-	for host in login.host.get_all():
-		#print "http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr
-        	sock = urllib.URLopener().open("http://" + str(login.host.get_address(host)) + "/rrd_updates?%s" % paramstr)
-	        xmlsource = sock.read()
-        	sock.close()
-        	xmldoc = minidom.parseString(xmlsource)
-        	self.__parse_xmldoc(xmldoc)
-        	# Update the time used on the next run
-        	self.params['start'] = self.end_time + 1  # avoid retrieving same data twice
-
-    def __parse_xmldoc(self, xmldoc):
-        # The 1st node contains meta data (description of the data)
-        # The 2nd node contains the data
-        self.meta_node = xmldoc.firstChild.childNodes[0]
-        self.data_node = xmldoc.firstChild.childNodes[1]
-
-        def lookup_metadata_bytag(name):
-            return int(self.meta_node.getElementsByTagName(name)[0].firstChild.toxml())
-            # rows = number of samples per variable
+        # fetch and parse the documents of all the hosts concurrently
+        hosts = login.host.get_all()
+        docs = [None] * len(hosts)
+        errors = []
+        def fetch(index, address):
+            try:
+                # this is better than urllib.urlopen() as it raises an Exception on http 401 'Unauthorised' error
+                # rather than drop into interactive mode
+                sock = urllib.URLopener().open("http://" + address + "/rrd_updates?%s" % paramstr)
+                try:
+                    docs[index] = RRDDocument().parse(sock)
+                finally:
+                    sock.close()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch, args=(index, str(login.host.get_address(host))))
+                   for index, host in enumerate(hosts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        for doc in docs:
+            self.__parse_doc(doc)
+            # Update the time used on the next run
+            self.params['start'] = self.end_time + 1  # avoid retrieving same data twice
+
+    def __parse_doc(self, doc):
+        # rows = number of samples per variable
         # columns = number of variables
-        self.rows = lookup_metadata_bytag('rows')
-        self.columns = lookup_metadata_bytag('columns')
+        self.rows = doc.rows
+        self.columns = doc.meta['columns']
         # These indicate the period covered by the data
-        self.start_time = lookup_metadata_bytag('start')
-        self.step_time = lookup_metadata_bytag('step')
-        self.end_time = lookup_metadata_bytag('end')
-        # the <legend> Node describes the variables
-        self.legend = self.meta_node.getElementsByTagName('legend')[0]
+        self.start_time = doc.meta['start']
+        self.step_time = doc.meta['step']
+        self.end_time = doc.meta['end']
+        self.times = doc.times
         # vm_reports matches uuid to per VM report
         if not hasattr(self,'vm_reports'):
-		self.vm_reports = {}
+            self.vm_reports = {}
         # There is just one host_report and its uuid should not change!
         self.host_report = None
         # Handle each column.  (I.e. each variable)
         for col in range(self.columns):
-            self.__handle_col(col)
+            self.__handle_col(doc, col)
 
-    def __handle_col(self, col):
+    def __handle_col(self, doc, col):
         # work out how to interpret col from the legend
-        col_meta_data = self.legend.childNodes[col].firstChild.toxml()
+        col_meta_data = doc.legend[col]
         # vm_or_host will be 'vm' or 'host'.  Note that the Control domain counts as a VM!
         (cf, vm_or_host, uuid, param) = col_meta_data.split(':')
         if vm_or_host == 'vm':
@@ -183,7 +223,8 @@ class RRDUpdates:
                 self.vm_reports[uuid] = VMReport(uuid)
                 # Update the VMReport with the col data and meta data
             vm_report = self.vm_reports[uuid]
-            vm_report[param] = col
+            vm_report[param] = doc.values[col]
+            vm_report.rows = doc.rows
         elif vm_or_host == 'host':
             # Create a report for the host if it doesn't exist
             if not self.host_report:
@@ -191,15 +232,18 @@ class RRDUpdates:
             elif self.host_report.uuid != uuid:
                 raise PerfMonException("Host UUID changed: (was %s, is %s)" % (self.host_report.uuid, uuid))
                 # Update the HostReport with the col data and meta data
-            self.host_report[param] = col
+            self.host_report[param] = doc.values[col]
+            self.host_report.rows = doc.rows
         else:
             raise PerfMonException("Invalid string in <legend>: %s" % col_meta_data)
 
-def getuuid(vm_name):
-    status, output = commands.getstatusoutput("xe vm-list | grep "+vm_name+" -B 1 | head -n 1 | awk -F':' '{print $2}' | tr -d ' '")
-    if (status != 0):
-	raise PerfMonException("Invalid vm name: %s" % vm_name)
-    return output
+def get_vm_uuids(xenapi):
+    """ Returns the uuids of the VMs by name, from a single XenAPI call """
+    uuids = {}
+    for record in xenapi.VM.get_all_records().values():
+        if not record['is_a_template']:
+            uuids[record['name_label']] = record['uuid']
+    return uuids
 
 def get_vm_group_perfmon(args={}):
     login = XenAPI.xapi_local()
@@ -225,18 +269,21 @@ def get_vm_group_perfmon(args={}):
 
     rrd_updates = RRDUpdates()
     rrd_updates.refresh(login.xenapi, now * 60 - max_duration, session, {})
+    vm_uuids = get_vm_uuids(login.xenapi)
 
     #for uuid in rrd_updates.get_vm_list():
     for vm_count in xrange(1, total_vm + 1):
 	vm_name = args['vmname' + str(vm_count)]
-        vm_uuid = getuuid(vm_name)
+        if vm_name not in vm_uuids:
+            raise PerfMonException("Invalid vm name: %s" % vm_name)
+        vm_uuid = vm_uuids[vm_name]
         #print "Got values for VM: " + str(vm_count) + " " + vm_uuid
         for counter_count in xrange(1, total_counter + 1):
 	    #refresh average
 	    average_cpu = 0
 	    average_memory = 0
             counter = args['counter' + str(counter_count)]
-            total_row = rrd_updates.get_nrows()
+            total_row = rrd_updates.get_nrows(vm_uuid)
             duration = int(args['duration' + str(counter_count)]) / 60
             duration_diff = total_row - duration
             if counter == "cpu":
@@ -22,7 +22,9 @@ from cloudutils.configFileOps import configFileOps
 import logging
 import sys
 import os
+import fcntl
 import xml.dom.minidom
+from subprocess import Popen, PIPE, CalledProcessError
 from optparse import OptionParser, OptionGroup, OptParseError, BadOptionError, OptionError, OptionConflictError, OptionValueError
 import re
 import libvirt
@@ -36,10 +38,99 @@ cfo = configFileOps("/etc/cloudstack/agent/agent.properties")
 hyper = cfo.getEntry("hypervisor.type")
 if hyper == "lxc":
     driver = "lxc:///"
+# Rules with at least this many cidrs match a hash:net ipset instead
+ipset_min_cidrs = 10
+
 def execute(cmd):
     logging.debug(cmd)
     return bash("-c", cmd).stdout
 
+def restore(cmd, data):
+    logging.debug(cmd + "\n" + data)
+    p = Popen(cmd.split(), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    m = p.communicate(data)
+    if p.returncode:
+        e = CalledProcessError(p.returncode, cmd)
+        e.stdout, e.stderr = m
+        raise e
+    return m[0]
+
+def iptables_restore(rules, chains=None):
+    """Applies the filter table rules in one transaction, the chains are created or flushed first"""
+    lines = ["*filter"] + [":%s - [0:0]" % chain for chain in chains or []] + rules + ["COMMIT", ""]
+    restore("iptables-restore --noflush", "\n".join(lines))
+
+def ipset_restore(commands):
+    restore("ipset restore", "\n".join(commands + [""]))
+
+def ipset_swap(ipsetname, settype, entries):
+    """Returns the ipset commands that replace the content of a set at once"""
+    ipsettmp = ipsetname + "-t"
+    commands = ["create %s %s -exist" % (ipsetname, settype), "create %s %s -exist" % (ipsettmp, settype), "flush " + ipsettmp]
+    commands += ["add %s %s -exist" % (ipsettmp, entry) for entry in entries]
+    commands += ["swap %s %s" % (ipsettmp, ipsetname), "destroy " + ipsettmp]
+    return commands
+
+def ipset_list(prefix):
+    return [name for name in execute("ipset list -n").split() if name.startswith(prefix)]
+
+def ebtables_update(vm_name, update):
+    """Rewrites the nat chains and rules of a vm with one ebtables-restore
+
+    ebtables-restore replaces the whole table, so the rules of the other vms
+    are read back from ebtables-save while holding a lock. update gets the
+    current chains and rules of the vm and returns the new ones
+    """
+    lockf = open(logpath + "ebtables.lock", 'w')
+    try:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        vmchains = [vm_name + "-in", vm_name + "-out", vm_name + "-in-ips", vm_name + "-out-ips"]
+        table = None
+        declarations = []
+        keep = []
+        chains = []
+        rules = []
+        for line in execute("ebtables-save").split('\n'):
+            line = line.strip()
+            if line.startswith("*"):
+                table = line[1:]
+                continue
+            if table != "nat" or not line or line.startswith("#"):
+                continue
+            if line.startswith(":"):
+                if line.split()[0][1:] not in vmchains:
+                    declarations.append(line)
+                else:
+                    chains.append(line.split()[0][1:])
+            else:
+                #rules in or jumping to the chains of the vm, other vms may share its name as a prefix
+                tokens = line.split()
+                chain = tokens[1] if len(tokens) > 1 else None
+                target = tokens[tokens.index("-j") + 1] if "-j" in tokens[:-1] else None
+                if chain not in vmchains and target not in vmchains:
+                    keep.append(line)
+                else:
+                    rules.append(line)
+        chains, rules = update(chains, rules)
+        declarations += [":%s ACCEPT" % chain for chain in chains]
+        restore("ebtables-restore", "\n".join(["*nat"] + declarations + keep + rules + [""]))
+    finally:
+        lockf.close()
+
+def ebtables_restore(vm_name, chains, rules):
+    """Replaces the nat chains and rules of a vm with one ebtables-restore"""
+    ebtables_update(vm_name, lambda current_chains, current_rules: (chains, rules))
+
+def ebtables_insert(rules, chain, num, rule):
+    """Inserts rule as rule number num of chain, or appends it to a shorter chain"""
+    positions = [i for i, line in enumerate(rules) if line.split()[1:2] == [chain]]
+    if num <= len(positions):
+        rules.insert(positions[num - 1], "-A %s %s" % (chain, rule))
+    elif positions:
+        rules.insert(positions[-1] + 1, "-A %s %s" % (chain, rule))
+    else:
+        rules.append("-A %s %s" % (chain, rule))
+
 def can_bridge_firewall(privnic):
     try:
         execute("which iptables")
@@ -87,6 +178,57 @@ def ipset(ipsetname, proto, start, end, ips):
 
     return result
 '''
+# The libvirt connection and the domains are looked up once per run
+libvirt_conn = None
+libvirt_domains = None
+
+def get_libvirt_conn():
+    global libvirt_conn
+    if libvirt_conn is None:
+        libvirt_conn = libvirt.openReadOnly(driver)
+        if libvirt_conn == None:
+           print 'Failed to open connection to the hypervisor'
+           sys.exit(3)
+    return libvirt_conn
+
+def get_domains():
+    """Returns the details of all domains by name
+
+    The domains are listed with one listAllDomains call, their state and
+    interfaces are fetched on first use
+    """
+    global libvirt_domains
+    if libvirt_domains is None:
+        libvirt_domains = {}
+        for dom in get_libvirt_conn().listAllDomains(0):
+            libvirt_domains[dom.name()] = {'dom': dom}
+    return libvirt_domains
+
+def get_domain(domain):
+    return get_domains().get(domain)
+
+def get_domain_state(domain):
+    details = get_domain(domain)
+    if details is None:
+        return None
+    if 'state' not in details:
+        details['state'] = details['dom'].info()[0]
+    return details['state']
+
+def get_domain_interfaces(domain):
+    """Returns the bridge and target device of the interfaces of a domain"""
+    details = get_domain(domain)
+    if details is None:
+        return None
+    if 'interfaces' not in details:
+        details['interfaces'] = []
+        dom = xml.dom.minidom.parseString(virshdumpxml(domain))
+        for network in dom.getElementsByTagName("interface"):
+            bridges = [source.getAttribute("bridge").strip() for source in network.getElementsByTagName('source')]
+            targets = [target.getAttribute("dev").strip() for target in network.getElementsByTagName('target')]
+            details['interfaces'].append({'bridges': bridges, 'vif': (targets or [None])[0]})
+    return details['interfaces']
+
 def virshlist(*states):
 
     libvirt_states={ 'running'  : libvirt.VIR_DOMAIN_RUNNING,
@@ -100,20 +242,10 @@ def virshlist(*states):
 
     searchstates = list(libvirt_states[state] for state in states)
 
-    conn = libvirt.openReadOnly(driver)
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
-
-    alldomains = map(conn.lookupByID, conn.listDomainsID())
-    alldomains += map(conn.lookupByName, conn.listDefinedDomains())
-
     domains = []
-    for domain in alldomains:
-        if domain.info()[0] in searchstates:
-            domains.append(domain.name())
-
-    conn.close()
+    for domain in get_domains():
+        if get_domain_state(domain) in searchstates:
+            domains.append(domain)
 
     return domains
 
@@ -128,37 +260,22 @@ def virshdomstate(domain):
                      libvirt.VIR_DOMAIN_CRASHED  : 'crashed',
     }
 
-    conn = libvirt.openReadOnly(driver)
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
-
-    try:
-        dom = (conn.lookupByName (domain))
-    except libvirt.libvirtError:
+    state = get_domain_state(domain)
+    if state is None:
         return None
 
-    state = libvirt_states[dom.info()[0]]
-    conn.close()
-
-    return state
+    return libvirt_states[state]
 
 def virshdumpxml(domain):
 
-    conn = libvirt.openReadOnly(driver)
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
-
-    try:
-        dom = (conn.lookupByName (domain))
-    except libvirt.libvirtError:
+    details = get_domain(domain)
+    if details is None:
         return None
 
-    xml = dom.XMLDesc(0)
-    conn.close()
+    if 'xml' not in details:
+        details['xml'] = details['dom'].XMLDesc(0)
 
-    return xml
+    return details['xml']
 
 def destroy_network_rules_for_vm(vm_name, vif=None):
     vmchain = vm_name
@@ -190,6 +307,13 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
     except:
         logging.debug("Ignoring failure to delete ipset " + vmchain)
 
+    try:
+        ipsets = ipset_list(vm_name + "-")
+        if ipsets:
+            ipset_restore(["destroy " + name for name in ipsets])
+    except:
+        logging.debug("Ignoring failure to delete the cidr ipsets of vm " + vm_name)
+
     if vif is not None:
         try:
             dnats = execute("""iptables -t nat -S | awk '/%s/ { sub(/-A/, "-D", $1) ; print }'""" % vif ).split("\n")
@@ -209,82 +333,51 @@ def destroy_network_rules_for_vm(vm_name, vif=None):
     return 'true'
 
 def destroy_ebtables_rules(vm_name, vif):
-    delcmd = "ebtables -t nat -L PREROUTING | grep " + vm_name
-    delcmds = []
     try:
-        delcmds = filter(None, execute(delcmd).split('\n'))
-        delcmds = ["-D PREROUTING " + x for x in delcmds ]
+        ebtables_restore(vm_name, [], [])
     except:
-        pass
-    postcmds = []
-    try:
-        postcmd = "ebtables -t nat -L POSTROUTING | grep " + vm_name
-        postcmds = filter(None, execute(postcmd).split('\n'))
-        postcmds = ["-D POSTROUTING " + x for x in postcmds]
-    except:
-        pass
-
-    delcmds += postcmds
-
-    for cmd in delcmds:
-        try:
-            execute("ebtables -t nat " + cmd)
-        except:
-            logging.debug("Ignoring failure to delete ebtables rules for vm " + vm_name)
-    chains = [vm_name+"-in", vm_name+"-out", vm_name+"-in-ips", vm_name+"-out-ips"]
-    for chain in chains:
-        try:
-            execute("ebtables -t nat -F " + chain)
-            execute("ebtables -t nat -X " + chain)
-        except:
-            logging.debug("Ignoring failure to delete ebtables chain for vm " + vm_name)
+        logging.debug("Ignoring failure to delete ebtables rules for vm " + vm_name)
 
-def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif):
+def default_ebtables_rules(vm_name, vm_ip, vm_mac, vif, sec_ips=None):
     vmchain_in = vm_name + "-in"
     vmchain_out = vm_name + "-out"
     vmchain_in_ips = vm_name + "-in-ips"
     vmchain_out_ips = vm_name + "-out-ips"
 
-    for chain in [vmchain_in, vmchain_out, vmchain_in_ips, vmchain_out_ips]:
-        try:
-            execute("ebtables -t nat -N " + chain)
-        except:
-            execute("ebtables -t nat -F " + chain)
+    # -s ! 52:54:0:56:44:32 -j DROP
+    rules = ["-A PREROUTING -i " + vif + " -j " + vmchain_in, "-A POSTROUTING -o " + vif + " -j " + vmchain_out]
 
-    try:
-        # -s ! 52:54:0:56:44:32 -j DROP
-        execute("ebtables -t nat -A PREROUTING -i " + vif + " -j " + vmchain_in)
-        execute("ebtables -t nat -A POSTROUTING -o " + vif + " -j " + vmchain_out)
-        execute("ebtables -t nat -A " + vmchain_in_ips + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_out_ips + " -j DROP")
-    except:
-        logging.debug("Failed to program default rules")
-        return 'false'
+    for ip in filter(None, sec_ips or []):
+        if ip == "0":
+            continue
+        rules.append("-A " + vmchain_in_ips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
+        rules.append("-A " + vmchain_out_ips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN")
+        rules.append("-A " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN")
+    rules.append("-A " + vmchain_in_ips + " -j DROP")
+    rules.append("-A " + vmchain_out_ips + " -j DROP")
+
+    rules.append("-A " + vmchain_in + " -s ! " + vm_mac + " -j DROP")
+    rules.append("-A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP")
+    rules.append("-A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP")
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
+    rules.append("-A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT")
+    rules.append("-A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT")
+    rules.append("-A " + vmchain_in + " -p ARP -j DROP")
 
-    try:
-        execute("ebtables -t nat -A " + vmchain_in + " -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -s ! " + vm_mac + " -j DROP")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-mac-src ! " + vm_mac + " -j DROP")
-        if vm_ip is not None:
-            execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j " + vmchain_in_ips)
-            execute("ebtables -t nat -I " + vmchain_in_ips + " -p ARP --arp-ip-src " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_in + " -p ARP -j DROP")
-    except:
-        logging.exception("Failed to program default ebtables IN rules")
-        return 'false'
+    rules.append("-A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_out + " -p ARP -j " + vmchain_out_ips)
+    rules.append("-A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT")
+    rules.append("-A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT")
+    rules.append("-A " + vmchain_out + " -p ARP -j DROP")
 
     try:
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply --arp-mac-dst ! " + vm_mac + " -j DROP")
-        if vm_ip is not None:
-            execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j " + vmchain_out_ips )
-            execute("ebtables -t nat -I " + vmchain_out_ips + " -p ARP --arp-ip-dst " + vm_ip + " -j RETURN")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Request -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP --arp-op Reply -j ACCEPT")
-        execute("ebtables -t nat -A " + vmchain_out + " -p ARP -j DROP")
+        ebtables_restore(vm_name, [vmchain_in, vmchain_out, vmchain_in_ips, vmchain_out_ips], rules)
     except:
-        logging.debug("Failed to program default ebtables OUT rules")
+        logging.exception("Failed to program default ebtables rules for vm " + vm_name)
         return 'false'
 
 
@@ -353,19 +446,6 @@ def write_secip_log_for_vm (vmName, secIps, vmId):
 
     return result
 
-def create_ipset_forvm (ipsetname):
-    result = True
-    try:
-        logging.debug("Creating ipset chain .... " + ipsetname)
-        execute("ipset -F " + ipsetname)
-        execute("ipset -X " + ipsetname)
-        execute("ipset -N " + ipsetname + " iphash")
-    except:
-        logging.debug("ipset chain not exists creating.... " + ipsetname)
-        execute("ipset -N " + ipsetname + " iphash")
-
-    return result
-
 def add_to_ipset(ipsetname, ips, action):
     result = True
     for ip in ips:
@@ -396,18 +476,27 @@ def ebtables_rules_vmip (vmname, ips, action):
     vmchain_inips = vmname + "-in-ips"
     vmchain_outips = vmname + "-out-ips"
 
-    if action and action.strip() == "-A":
-        action = "-I"
+    ips = [ip for ip in filter(None, ips) if ip != 0 and ip != "0"]
+    if not ips:
+        return
 
-    for ip in filter(None, ips):
-        logging.debug("ip = " + ip)
-        if ip == 0 or ip == "0":
-            continue
-        try:
-            execute("ebtables -t nat " + action + " " + vmchain_inips + " -p ARP --arp-ip-src " + ip + " -j RETURN")
-            execute("ebtables -t nat " + action + " " + vmchain_outips + " -p ARP --arp-ip-dst " + ip + " -j RETURN")
-        except:
-            logging.debug("Failed to program ebtables rules for secondary ip %s for vm %s with action %s" % (ip, vmname, action))
+    def update(chains, rules):
+        if vmchain_inips not in chains or vmchain_outips not in chains:
+            return chains, rules
+        for ip in ips:
+            logging.debug("ip = " + ip)
+            inips = "-p ARP --arp-ip-src " + ip + " -j RETURN"
+            outips = "-p ARP --arp-ip-dst " + ip + " -j RETURN"
+            rules = [line for line in rules if line.split() not in (("-A " + vmchain_inips + " " + inips).split(), ("-A " + vmchain_outips + " " + outips).split())]
+            if action and action.strip() in ("-A", "-I"):
+                ebtables_insert(rules, vmchain_inips, 1, inips)
+                ebtables_insert(rules, vmchain_outips, 1, outips)
+        return chains, rules
+
+    try:
+        ebtables_update(vmname, update)
+    except:
+        logging.debug("Failed to program ebtables rules for secondary ips %s for vm %s with action %s" % (ips, vmname, action))
 
 def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips):
     if not addFWFramework(brname):
@@ -416,75 +505,56 @@ def default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, sec_ips):
     vmName = vm_name
     brfw = getBrfw(brname)
     domID = getvmId(vm_name)
-    delete_rules_for_vm_in_bridge_firewall_chain(vmName)
     vmchain = vm_name
     vmchain_egress = egress_chain_name(vm_name)
     vmchain_default = '-'.join(vmchain.split('-')[:-1]) + "-def"
 
-    destroy_ebtables_rules(vmName, vif)
-
-    try:
-        execute("iptables -N " + vmchain)
-    except:
-        execute("iptables -F " + vmchain)
-
-    try:
-        execute("iptables -N " + vmchain_egress)
-    except:
-        execute("iptables -F " + vmchain_egress)
-
-    try:
-        execute("iptables -N " + vmchain_default)
-    except:
-        execute("iptables -F " + vmchain_default)
-
-    action = "-A"
     vmipsetName = vm_name
-    #create ipset and add vm ips to that ip set
-    if create_ipset_forvm(vmipsetName) == False:
-       logging.debug(" failed to create ipset for rule " + str(tokens))
-       return 'false'
-
-    #add primary nic ip to ipset
-    if add_to_ipset(vmipsetName, [vm_ip], action ) == False:
-       logging.debug(" failed to add vm " + vm_ip + " ip to set ")
-       return 'false'
-
-    #add secodnary nic ips to ipset
+    #add primary and secondary nic ips to the ipset of the vm
     secIpSet = "1"
     ips = sec_ips.split(':')
     ips.pop()
     if ips[0] == "0":
         secIpSet = "0";
 
+    vmips = filter(None, [vm_ip])
     if secIpSet == "1":
         logging.debug("Adding ipset for secondary ips")
-        add_to_ipset(vmipsetName, ips, action)
+        vmips += filter(None, ips)
         if write_secip_log_for_vm(vm_name, sec_ips, vm_id) == False:
             logging.debug("Failed to log default network rules, ignoring")
 
     try:
-        execute("iptables -A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
-        execute("iptables -A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
-        #allow dhcp
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
-
-        #don't let vm spoof its ip address
-        if vm_ip is not None:
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set ! --set " + vmipsetName + " src -j DROP")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
-            execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
-        execute("iptables -A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
-        execute("iptables -A " + vmchain + " -j DROP")
+        ipset_restore(ipset_swap(vmipsetName, "iphash", vmips))
+    except:
+        logging.exception("Failed to program ipset for vm " + vm_name)
+        return 'false'
+
+    #remove the old jumps and program the chains of the vm in one transaction
+    rules = bridge_firewall_rules_for_vm(vmName)
+    rules.append("-A " + brfw + "-OUT" + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain_default)
+    rules.append("-A " + brfw + "-IN" + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -j " + vmchain_default)
+    rules.append("-A " + vmchain_default + " -m state --state RELATED,ESTABLISHED -j ACCEPT")
+    #allow dhcp
+    rules.append("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -p udp --dport 67 --sport 68 -j ACCEPT")
+    rules.append("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -p udp --dport 68 --sport 67  -j ACCEPT")
+
+    #don't let vm spoof its ip address
+    if vm_ip is not None:
+        rules.append("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set ! --set " + vmipsetName + " src -j DROP")
+        rules.append("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -p udp --dport 53  -j RETURN ")
+        rules.append("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-in " + vif + " -m set --set " + vmipsetName + " src -j " + vmchain_egress)
+    rules.append("-A " + vmchain_default + " -m physdev --physdev-is-bridged --physdev-out " + vif + " -j " + vmchain)
+    rules.append("-A " + vmchain + " -j DROP")
+
+    try:
+        iptables_restore(rules, [vmchain, vmchain_egress, vmchain_default])
     except:
-        logging.debug("Failed to program default rules for vm " + vm_name)
+        logging.exception("Failed to program default rules for vm " + vm_name)
         return 'false'
 
-    default_ebtables_rules(vmchain, vm_ip, vm_mac, vif)
-    #default ebtables rules for vm secondary ips
-    ebtables_rules_vmip(vm_name, ips, "-I")
+    #default ebtables rules for vm and its secondary ips
+    default_ebtables_rules(vmchain, vm_ip, vm_mac, vif, ips)
 
     if vm_ip is not None:
         if write_rule_log_for_vm(vmName, vm_id, vm_ip, domID, '_initial_', '-1') == False:
@@ -507,22 +577,22 @@ def post_default_network_rules(vm_name, vm_id, vm_ip, vm_mac, vif, brname, dhcpS
     except:
         pass
 
-    try:
-        execute("ebtables -t nat -I " + vmchain_in + " -p IPv4 --ip-protocol tcp --ip-destination-port 80 --ip-dst " + dhcpSvr + " -j dnat --to-destination " + hostMacAddr)
-    except:
-        pass
+    def update(chains, rules):
+        if vmchain_in not in chains or vmchain_out not in chains:
+            return chains, rules
+        ebtables_insert(rules, vmchain_in, 1, "-p IPv4 --ip-protocol tcp --ip-destination-port 80 --ip-dst " + dhcpSvr + " -j dnat --to-destination " + hostMacAddr)
+        ebtables_insert(rules, vmchain_in, 4, "-p ARP --arp-ip-src ! " + vm_ip + " -j DROP")
+        ebtables_insert(rules, vmchain_out, 2, "-p ARP --arp-ip-dst ! " + vm_ip + " -j DROP")
+        return chains, rules
 
     try:
-        execute("ebtables -t nat -I " + vmchain_in + " 4 -p ARP --arp-ip-src ! " + vm_ip + " -j DROP")
-    except:
-        pass
-    try:
-        execute("ebtables -t nat -I " + vmchain_out + " 2 -p ARP --arp-ip-dst ! " + vm_ip + " -j DROP")
+        ebtables_update(vm_name, update)
     except:
         pass
     if write_rule_log_for_vm(vm_name, vm_id, vm_ip, domID, '_initial_', '-1') == False:
             logging.debug("Failed to log default network rules, ignoring")
-def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
+def bridge_firewall_rules_for_vm(vmName):
+    """Returns the iptables-restore lines that delete the jumps to the vm from the bridge firewall chains"""
     vm_name = vmName
     if vm_name.startswith('i-'):
         vm_name = '-'.join(vm_name.split('-')[:-1]) + "-def"
@@ -530,12 +600,16 @@ def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
     vmchain = vm_name
 
     delcmd = """iptables-save | awk '/BF(.*)physdev-is-bridged(.*)%s/ { sub(/-A/, "-D", $1) ; print }'""" % vmchain
-    delcmds = filter(None, execute(delcmd).split('\n'))
-    for cmd in delcmds:
-        try:
-            execute("iptables " + cmd)
-        except:
-              logging.exception("Ignoring failure to delete rules for vm " + vmName)
+    return filter(None, execute(delcmd).split('\n'))
+
+def delete_rules_for_vm_in_bridge_firewall_chain(vmName):
+    delcmds = bridge_firewall_rules_for_vm(vmName)
+    if not delcmds:
+        return
+    try:
+        iptables_restore(delcmds)
+    except:
+        logging.exception("Ignoring failure to delete rules for vm " + vmName)
 
 def rewrite_rule_log_for_vm(vm_name, new_domid):
     logfilename = logpath + vm_name + ".log"
@@ -804,6 +878,12 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
 
     if changes[0] or changes[1] or changes[2] or changes[3]:
         default_network_rules(vmName, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
+    else:
+        try:
+            execute("iptables -n -L " + vm_name)
+        except:
+            logging.debug("No iptables chain for " + vm_name + ". Presuming firewall rules deleted, re-initializing." )
+            default_network_rules(vm_name, vm_id, vm_ip, vmMac, vif, brname, sec_ips)
 
     if rules == "" or rules == None:
         lines = []
@@ -811,14 +891,12 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
         lines = rules.split(';')[:-1]
 
     logging.debug("    programming network rules for IP: " + vm_ip + " vmname=" + vm_name)
-    try:
-      vmchain = vm_name
-      execute("iptables -F " + vmchain)
-      egress_vmchain = egress_chain_name(vm_name)
-      execute("iptables -F " + egress_vmchain)
-    except:
-      logging.debug("Error flushing iptables rules for " + vmchain + ". Presuming firewall rules deleted, re-initializing." )
-      default_network_rules(vm_name, vm_id, vm_ip, vmMac, vif, brname)
+    #the rules are collected in the order the former iptables -I calls used,
+    #so they are appended in reverse
+    ingress = []
+    egress = []
+    ipsets = []
+    ipsetnames = []
     egressrule = 0
     for line in lines:
         tokens = line.split(':')
@@ -833,55 +911,71 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
         ips.pop()
         allow_any = False
         if ruletype == 'E':
-            vmchain = egress_chain_name(vm_name)
+            chainrules = egress
             direction = "-d"
+            setdirection = "dst"
             action = "RETURN"
             egressrule = egressrule + 1
         else:
-            vmchain = vm_name
+            chainrules = ingress
             action = "ACCEPT"
             direction = "-s"
+            setdirection = "src"
         if '0.0.0.0/0' in ips:
             i = ips.index('0.0.0.0/0')
             del ips[i]
             allow_any = True
         range = start + ":" + end
-        if ips:
-            if protocol == 'all':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -m state --state NEW " + direction + " " + ip + " -j "+action)
-            elif protocol != 'icmp':
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW " + direction + " " + ip + " -j "+ action)
-            else:
-                range = start + "/" + end
-                if start == "-1":
-                    range = "any"
-                for ip in ips:
-                    execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " " + direction + " " + ip + " -j "+ action)
+        if protocol == 'all':
+            match = "-m state --state NEW"
+        elif protocol != 'icmp':
+            match = "-p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW"
+        else:
+            range = start + "/" + end
+            if start == "-1":
+                range = "any"
+            match = "-p icmp --icmp-type " + range
+
+        if len(ips) >= ipset_min_cidrs:
+            ipsetname = vm_name + "-" + str(len(ipsetnames))
+            ipsetnames.append(ipsetname)
+            ipsets += ipset_swap(ipsetname, "hash:net", ips)
+            chainrules.append(match + " -m set --match-set " + ipsetname + " " + setdirection + " -j " + action)
+        else:
+            for ip in ips:
+                chainrules.append(match + " " + direction + " " + ip + " -j " + action)
 
         if allow_any:
             if protocol == 'all':
-                execute("iptables -I " + vmchain + " -m state --state NEW " + direction + " 0.0.0.0/0 -j "+action)
-            elif protocol != 'icmp':
-                execute("iptables -I " + vmchain + " -p " + protocol + " -m " + protocol + " --dport " + range + " -m state --state NEW -j "+ action)
+                chainrules.append(match + " " + direction + " 0.0.0.0/0 -j " + action)
             else:
-                range = start + "/" + end
-                if start == "-1":
-                    range = "any"
-                execute("iptables -I " + vmchain + " -p icmp --icmp-type " + range + " -j "+action)
+                chainrules.append(match + " -j " + action)
 
+    vmchain = vm_name
     egress_vmchain = egress_chain_name(vm_name)
+    rules = ["-A " + vmchain + " " + rule for rule in reversed(ingress)]
+    rules += ["-A " + egress_vmchain + " " + rule for rule in reversed(egress)]
     if egressrule == 0 :
-        iptables = "iptables -A " + egress_vmchain + " -j RETURN"
-        execute(iptables)
+        rules.append("-A " + egress_vmchain + " -j RETURN")
     else:
-        iptables = "iptables -A " + egress_vmchain + " -j DROP"
-        execute(iptables)
+        rules.append("-A " + egress_vmchain + " -j DROP")
+    rules.append("-A " + vmchain + " -j DROP")
 
-    vmchain = vm_name
-    iptables = "iptables -A " + vmchain + " -j DROP"
-    execute(iptables)
+    #the sets have to exist before the rules use them and can only be
+    #destroyed once no rule uses them anymore
+    try:
+        stale = [name for name in ipset_list(vm_name + "-") if name not in ipsetnames]
+        if ipsets:
+            ipset_restore(ipsets)
+        iptables_restore(rules, [vmchain, egress_vmchain])
+    except:
+        logging.exception("Failed to program network rules for vm " + vm_name)
+        return 'false'
+    try:
+        if stale:
+            ipset_restore(["destroy " + name for name in stale])
+    except:
+        logging.debug("Ignoring failure to delete the unused ipsets of vm " + vm_name)
 
     if write_rule_log_for_vm(vmName, vm_id, vm_ip, domId, signature, seqno) == False:
         return 'false'
@@ -889,64 +983,47 @@ def add_network_rules(vm_name, vm_id, vm_ip, signature, seqno, vmMac, rules, vif
     return 'true'
   except:
     logging.exception("Failed to network rule !")
+    return 'false'
 
 def getVifs(vmName):
     vifs = []
-    xmlfile = virshdumpxml(vmName)
-    if xmlfile == None:
+    interfaces = get_domain_interfaces(vmName)
+    if interfaces == None:
         return vifs
 
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        target = network.getElementsByTagName('target')[0]
-        nicdev = target.getAttribute("dev").strip()
-        vifs.append(nicdev)
+    for interface in interfaces:
+        if interface['vif'] is not None:
+            vifs.append(interface['vif'])
     return vifs
 
 def getVifsForBridge(vmName, brname):
     vifs = []
-    xmlfile = virshdumpxml(vmName)
-    if xmlfile == None:
+    interfaces = get_domain_interfaces(vmName)
+    if interfaces == None:
         return vifs
 
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        source = network.getElementsByTagName('source')[0]
-        bridge = source.getAttribute("bridge").strip()
-        if bridge == brname:
-            target = network.getElementsByTagName('target')[0]
-            nicdev = target.getAttribute("dev").strip()
-            vifs.append(nicdev)
+    for interface in interfaces:
+        if interface['bridges'][:1] == [brname] and interface['vif'] is not None:
+            vifs.append(interface['vif'])
     return list(set(vifs))
 
 def getBridges(vmName):
     bridges = []
-    xmlfile = virshdumpxml(vmName)
-    if xmlfile == None:
+    interfaces = get_domain_interfaces(vmName)
+    if interfaces == None:
         return bridges
 
-    dom = xml.dom.minidom.parseString(xmlfile)
-    for network in dom.getElementsByTagName("interface"):
-        for source in network.getElementsByTagName('source'):
-            bridge = source.getAttribute("bridge").strip()
-            bridges.append(bridge)
+    for interface in interfaces:
+        bridges += interface['bridges']
     return list(set(bridges))
 
 def getvmId(vmName):
 
-    conn = libvirt.openReadOnly(driver)
-    if conn == None:
-       print 'Failed to open connection to the hypervisor'
-       sys.exit(3)
-
-    try:
-        dom = (conn.lookupByName (vmName))
-    except libvirt.libvirtError:
+    details = get_domain(vmName)
+    if details is None:
         return None
 
-    conn.close()
-
-    res = dom.ID()
+    res = details['dom'].ID()
     if isinstance(res, int):
         res = str(res)
     return res
@@ -18,9 +18,11 @@
 # cloudstack_pluginlib for openvswitch on KVM hypervisor
 
 import ConfigParser
+import json
 import logging
 import os
 import subprocess
+import tempfile
 
 from time import localtime, asctime
 
@@ -35,6 +37,10 @@ OVS_PID_PATH = "/var/run/openvswitch/ovs-vswitchd.pid"
 OVS_DAEMON_PATH = "ovs-vswitchd"
 VSCTL_PATH = "/usr/bin/ovs-vsctl"
 OFCTL_PATH = "/usr/bin/ovs-ofctl"
+# IP protocol numbers for the nw_proto match of the ACL flows
+IP_PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17}
+# cookie of the flows that configure_bridge_for_network_topology owns
+TOPOLOGY_FLOW_COOKIE = 112
 
 class PluginError(Exception):
     """Base Exception class for all plugin errors."""
@@ -174,26 +180,100 @@ def _build_flow_expr(**kwargs):
     dl_dst = 'dl_dst' in kwargs and ",dl_dst=%s" % kwargs['dl_dst'] or ''
     nw_src = 'nw_src' in kwargs and ",nw_src=%s" % kwargs['nw_src'] or ''
     nw_dst = 'nw_dst' in kwargs and ",nw_dst=%s" % kwargs['nw_dst'] or ''
+    nw_proto = 'nw_proto' in kwargs and ",nw_proto=%s" % kwargs['nw_proto'] or ''
+    tp_dst = 'tp_dst' in kwargs and ",tp_dst=%s" % kwargs['tp_dst'] or ''
     table = 'table' in kwargs and ",table=%s" % kwargs['table'] or ''
+    cookie = 'cookie' in kwargs and ",cookie=%s" % kwargs['cookie'] or ''
     proto = 'proto' in kwargs and ",%s" % kwargs['proto'] or ''
-    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs) and ',ip' or ''
-    flow = (flow + in_port + dl_type + dl_src + dl_dst +
-            (ip or proto) + nw_src + nw_dst)
+    ip = ('nw_src' in kwargs or 'nw_dst' in kwargs or 'nw_proto' in kwargs) and ',ip' or ''
+    flow = (flow + cookie + table + in_port + dl_type + dl_src + dl_dst +
+            (ip or proto) + nw_src + nw_dst + nw_proto + tp_dst)
     return flow
 
 
+def _build_flow(**kwargs):
+    flow = _build_flow_expr(**kwargs)
+    actions = 'actions' in kwargs and ",actions=%s" % kwargs['actions'] or ''
+    return flow + actions
+
+
 def add_flow(bridge, **kwargs):
     """
     Builds a flow expression for **kwargs and adds the flow entry
     to an Open vSwitch instance
     """
-    flow = _build_flow_expr(**kwargs)
-    actions = 'actions' in kwargs and ",actions=%s" % kwargs['actions'] or ''
-    flow = flow + actions
+    flow = _build_flow(**kwargs)
     addflow = [OFCTL_PATH, "add-flow", bridge, flow]
     do_cmd(addflow)
 
 
+def _do_flows_cmd(command, bridge, lines):
+    fd, flow_file = tempfile.mkstemp(prefix="cloudstack-flows-")
+    try:
+        os.write(fd, "".join(line + "\n" for line in lines))
+        os.close(fd)
+        do_cmd([OFCTL_PATH] + command.split() + [bridge, flow_file])
+    finally:
+        os.remove(flow_file)
+
+
+def add_flows(bridge, flows):
+    """
+    Builds a flow expression for each dict of keywords in flows and adds
+    all the flow entries with a single ovs-ofctl add-flows call
+    """
+    if not flows:
+        return
+    _do_flows_cmd("add-flows", bridge, [_build_flow(**kwargs) for kwargs in flows])
+
+
+def replace_flows(bridge, matches, flows):
+    """
+    Deletes the flows matching each expression of matches and adds the
+    flows built from the dicts of keywords in flows, in one OpenFlow 1.4
+    bundle so the switch applies them at once. The other flows of the
+    bridge are left alone. Without bundle support the flows are deleted
+    and then added.
+    """
+    lines = ["delete " + match for match in matches]
+    lines += ["add " + _build_flow(**kwargs) for kwargs in flows]
+    try:
+        _do_flows_cmd("-O OpenFlow14 --bundle add-flows", bridge, lines)
+    except PluginError, e:
+        logging.debug("Failed to replace the flows on %s in a bundle, deleting and adding them: %s" % (bridge, e))
+        for match in matches:
+            do_cmd([OFCTL_PATH, "del-flows", bridge, match])
+        add_flows(bridge, flows)
+
+
+def replace_cookie_flows(bridge, cookie, flows):
+    """
+    Replaces the flows tagged with cookie by flows, see replace_flows()
+    """
+    replace_flows(bridge, ["cookie=%s/-1" % cookie], flows)
+
+
+def port_range_to_masks(start, end):
+    """
+    Returns the minimal list of tp_dst matches, as value/mask strings,
+    that together match the ports from start to end (both included)
+    """
+    matches = []
+    port = start
+    while port <= end:
+        # the largest block of ports aligned on port that fits in the range
+        size = port & -port or 0x10000
+        while port + size - 1 > end:
+            size >>= 1
+        mask = 0xffff & ~(size - 1)
+        if mask == 0xffff:
+            matches.append("%d" % port)
+        else:
+            matches.append("0x%04x/0x%04x" % (port, mask))
+        port += size
+    return matches
+
+
 def del_flows(bridge, **kwargs):
     """
     Removes flows according to criteria passed as keyword.
@@ -242,6 +322,26 @@ def add_flooding_rules_for_port(bridge, in_ofport, out_ofports):
 def get_ofport_for_vif(vif_name):
     return do_cmd([VSCTL_PATH, "get", "interface", vif_name, "ofport"])
 
+def get_ofports():
+    """
+    Returns the ofports of all the Open vSwitch interfaces, by interface name
+    and by the attached-mac of the interface, from a single ovs-vsctl call
+    """
+    listing = json.loads(do_cmd([VSCTL_PATH, "--format=json", "--columns=name,ofport,external_ids",
+                                 "list", "Interface"]))
+    by_name = {}
+    by_mac = {}
+    for row in listing['data']:
+        interface = dict(zip(listing['headings'], row))
+        # an ofport that is not assigned yet is an empty set
+        if not isinstance(interface['ofport'], int):
+            continue
+        by_name[interface['name']] = interface['ofport']
+        external_ids = dict(interface['external_ids'][1])
+        if 'attached-mac' in external_ids:
+            by_mac[external_ids['attached-mac'].lower()] = interface['ofport']
+    return by_name, by_mac
+
 def get_macaddress_of_vif(vif_name):
     domain_id, device_id = vif_name[3:len(vif_name)].split(".")
     dom_uuid = do_cmd([XE_PATH, "vm-list", "dom-id=%s" % domain_id, "--minimal"])
@@ -320,30 +420,37 @@ def configure_bridge_for_network_topology(bridge, this_host_id, json_config):
     # get the list of Vm's in the VPC from the JSON config
     this_host_vms = get_vms_on_host(vpconfig, this_host_id)
 
+    # resolve the ofports of all the vifs and tunnels at once and build the whole flow set,
+    # the flows are tagged with a cookie so the next topology update replaces them
+    ofports_by_name, ofports_by_mac = get_ofports()
+    flows = []
+
     for vm in this_host_vms:
         for nic in vm.nics:
             mac_addr = nic.macaddress
             ip = nic.ipaddress
-            vif_name = get_vif_name_from_macaddress(mac_addr)
-            of_port = get_ofport_for_vif(vif_name)
+            of_port = ofports_by_mac.get(mac_addr.lower())
+            if of_port is None:
+                vif_name = get_vif_name_from_macaddress(mac_addr)
+                of_port = ofports_by_name.get(vif_name) or get_ofport_for_vif(vif_name)
             network = get_network_details(vpconfig, nic.networkuuid)
 
             # Add flow rule in L2 look up table, if the destination mac = MAC of the nic send packet on the found OFPORT
-            add_mac_lookup_table_entry(bridge, mac_addr, of_port)
+            flows.append(dict(cookie=TOPOLOGY_FLOW_COOKIE, priority=1100, dl_dst=mac_addr, table=1,
+                              actions="output:%s" % of_port))
 
             # Add flow rule in L3 look up table: if the destination IP = VM's IP then modify the packet
             # to set DST MAC = VM's MAC, SRC MAC=tier gateway MAC and send to egress table
-            add_ip_lookup_table_entry(bridge, ip, network.gatewaymac, mac_addr)
+            flows.append(dict(cookie=TOPOLOGY_FLOW_COOKIE, priority=1100, nw_dst=ip, table=4,
+                              actions="mod_dl_src:%s,mod_dl_dst:%s,resubmit(,5)" % (network.gatewaymac, mac_addr)))
 
             # Add flow entry to send with intra tier traffic from the NIC to L2 lookup path)
-            addflow = [OFCTL_PATH, "add-flow", bridge, "table=0", "in_port=%s" % of_port,
-                       "nw_dst=%s" %network.cidr, "actions=resubmit(,1)"]
-            do_cmd(addflow)
+            flows.append(dict(cookie=TOPOLOGY_FLOW_COOKIE, priority=1200, in_port=of_port, nw_dst=network.cidr,
+                              table=0, actions="resubmit(,1)"))
 
             #add flow entry to send inter-tier traffic from the NIC to egress ACL table(to L3 lookup path)
-            addflow = [OFCTL_PATH, "add-flow", bridge, "table=0", "in_port=%s" % of_port,
-                       "dl_dst=%s" %network.gatewaymac, "nw_dst=%s" %vpconfig.cidr, "actions=resubmit(,3)"]
-            do_cmd(addflow)
+            flows.append(dict(cookie=TOPOLOGY_FLOW_COOKIE, priority=1100, in_port=of_port, dl_dst=network.gatewaymac,
+                              nw_dst=vpconfig.cidr, table=0, actions="resubmit(,3)"))
 
     # get the list of hosts on which VPC spans from the JSON config
     vpc_spanning_hosts = vpconfig.hosts
@@ -361,14 +468,18 @@ def configure_bridge_for_network_topology(bridge, this_host_id, json_config):
 
                 # generate tunnel name from tunnel naming convention
                 tunnel_name = "t%s-%s-%s" % (gre_key, this_host_id, host.hostid)
-                of_port = get_ofport_for_vif(tunnel_name)
+                of_port = ofports_by_name.get(tunnel_name) or get_ofport_for_vif(tunnel_name)
 
                 # Add flow rule in L2 look up table, if the destination mac = MAC of the nic send packet tunnel port
-                add_mac_lookup_table_entry(bridge, mac_addr, of_port)
+                flows.append(dict(cookie=TOPOLOGY_FLOW_COOKIE, priority=1100, dl_dst=mac_addr, table=1,
+                                  actions="output:%s" % of_port))
 
                 # Add flow tule in L3 look up table: if the destination IP = VM's IP then modify the packet
                 # set DST MAC = VM's MAC, SRC MAC=tier gateway MAC and send to egress table
-                add_ip_lookup_table_entry(bridge, ip, network.gatewaymac, mac_addr)
+                flows.append(dict(cookie=TOPOLOGY_FLOW_COOKIE, priority=1100, nw_dst=ip, table=4,
+                                  actions="mod_dl_src:%s,mod_dl_dst:%s,resubmit(,5)" % (network.gatewaymac, mac_addr)))
+
+    replace_cookie_flows(bridge, TOPOLOGY_FLOW_COOKIE, flows)
 
     return "SUCCESS: successfully configured bridge as per the VPC topology"
 
@@ -386,11 +497,9 @@ def configure_ovs_bridge_for_routing_policies(bridge, json_config):
         logging.debug("WARNING:Can't find VPC info in json config file")
         return "FAILURE:IMPROPER_JSON_CONFG_FILE"
 
-    # First flush current egress ACL's before re-applying the ACL's
-    del_flows(bridge, table=3)
-
     egress_rules_added = False
     ingress_rules_added = False
+    flows = []
 
     tiers = vpconfig.tiers
     for tier in tiers:
@@ -407,39 +516,49 @@ def configure_ovs_bridge_for_routing_policies(bridge, json_config):
             protocol = acl_item.protocol
             source_cidrs = acl_item.sourcecidrs
             acl_priority = 1000 + number
+            if action == "deny":
+                flow_action = 'drop'
+            elif action == "allow":
+                flow_action = 'resubmit(,1)'
+            else:
+                continue
+
+            # one masked match per aligned block of the port range instead of a flow per port,
+            # the ports only apply to tcp and udp
+            matches = [{}]
+            nw_proto = IP_PROTOCOLS.get(str(protocol).lower(), protocol)
+            if nw_proto not in [None, '', 'all']:
+                matches = [{'nw_proto': nw_proto}]
+                if nw_proto in [IP_PROTOCOLS['tcp'], IP_PROTOCOLS['udp']] and source_port_start is not None:
+                    port_end = source_port_end if source_port_end is not None else source_port_start
+                    matches = [{'nw_proto': nw_proto, 'tp_dst': tp_dst} for tp_dst in
+                               port_range_to_masks(int(source_port_start), int(port_end))]
+
             for source_cidr in source_cidrs:
-                if direction is "ingress":
+                if direction == "ingress":
                     ingress_rules_added = True
                     # add flow rule to do action (allow/deny) for flows where source IP of the packet is in
                     # source_cidr and destination ip is in tier_cidr
-                    port = source_port_start
-                    while (port < source_port_end):
-                        if action is "deny":
-                            add_flow(bridge, priority= acl_priority, table=5, nw_src=source_cidr, nw_dst=tier_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='drop')
-                        if action is "allow":
-                            add_flow(bridge, priority= acl_priority,table=5, nw_src=source_cidr, nw_dst=tier_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='resubmit(,1)')
-                        port = port + 1
-
-                elif direction in "egress":
+                    nw_src, nw_dst = source_cidr, tier_cidr
+                elif direction == "egress":
                     egress_rules_added = True
                     # add flow rule to do action (allow/deny) for flows where destination IP of the packet is in
                     # source_cidr and source ip is in tier_cidr
-                    port = source_port_start
-                    while (port < source_port_end):
-                        if action is "deny":
-                            add_flow(bridge, priority= acl_priority, table=5, nw_src=tier_cidr, nw_dst=source_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='drop')
-                        if action is "allow":
-                            add_flow(bridge, priority= acl_priority, table=5, nw_src=tier_cidr, nw_dst=source_cidr, tp_dst=port,
-                                     nw_proto=protocol, actions='resubmit(,1)')
-                        port = port + 1
+                    nw_src, nw_dst = tier_cidr, source_cidr
+                else:
+                    continue
+                for match in matches:
+                    flow = dict(priority=acl_priority, table=5, nw_src=nw_src, nw_dst=nw_dst, actions=flow_action)
+                    flow.update(match)
+                    flows.append(flow)
 
     if egress_rules_added is False:
         # add a default rule in egress table to forward packet to L3 lookup table
-        add_flow(bridge, priority=0, table=3, actions='resubmit(,4)')
+        flows.append(dict(priority=0, table=3, actions='resubmit(,4)'))
 
     if ingress_rules_added is False:
         # add a default rule in egress table drop packets
-        add_flow(bridge, priority=0, table=5, actions='drop')
+        flows.append(dict(priority=0, table=5, actions='drop'))
+
+    # replace the flows of the egress (3) and ingress (5) ACL tables at once
+    replace_flows(bridge, ["table=3", "table=5"], flows)
@@ -49,12 +49,6 @@ class CsPassword(CsDataBag):
     TOKEN_FILE="/tmp/passwdsrvrtoken"
     
     def process(self):
-        for item in self.dbag:
-            if item == "id":
-                continue
-            self.__update(item, self.dbag[item])
-
-    def __update(self, vm_ip, password):
         token = ""
         try:
             tokenFile = open(self.TOKEN_FILE)
@@ -62,16 +56,25 @@ class CsPassword(CsDataBag):
         except IOError:
             logging.debug("File %s does not exist" % self.TOKEN_FILE)
 
-        ips_cmd = "ip addr show | grep inet | awk '{print $2}'"
-        ips = CsHelper.execute(ips_cmd)
-        for ip in ips:
-            server_ip = ip.split('/')[0]
+        # Look the password servers up once, not for every vm
+        servers = []
+        for address in CsHelper.get_addresses():
+            server_ip = address['ip'].split('/')[0]
             proc = CsProcess(['/opt/cloud/bin/passwd_server_ip.py', server_ip])
             if proc.find():
-                update_command = 'curl --header "DomU_Request: save_password" "http://{SERVER_IP}:8080/" -F "ip={VM_IP}" -F "password={PASSWORD}" ' \
-                '-F "token={TOKEN}" >/dev/null 2>/dev/null &'.format(SERVER_IP=server_ip, VM_IP=vm_ip, PASSWORD=password, TOKEN=token)
-                result = CsHelper.execute(update_command)
-                logging.debug("Update password server result ==> %s" % result)
+                servers.append(server_ip)
+
+        for item in self.dbag:
+            if item == "id":
+                continue
+            self.__update(item, self.dbag[item], servers, token)
+
+    def __update(self, vm_ip, password, servers, token):
+        for server_ip in servers:
+            update_command = 'curl --header "DomU_Request: save_password" "http://{SERVER_IP}:8080/" -F "ip={VM_IP}" -F "password={PASSWORD}" ' \
+            '-F "token={TOKEN}" >/dev/null 2>/dev/null &'.format(SERVER_IP=server_ip, VM_IP=vm_ip, PASSWORD=password, TOKEN=token)
+            result = CsHelper.execute(update_command)
+            logging.debug("Update password server result ==> %s" % result)
 
 
 class CsAcl(CsDataBag):
@@ -874,69 +877,86 @@ class CsForwardingRules(CsDataBag):
         self.fw.append(["nat", "front", "-A POSTROUTING -s %s -d %s -j SNAT -o eth0 --to-source %s" % (self.getNetworkByIp(rule['internal_ip']),rule["internal_ip"], self.getGuestIp())])
 
 
-def main(argv):
-    config = CsConfig()
-    logging.basicConfig(filename=config.get_logger(),
-                        level=config.get_level(),
-                        format=config.get_format())
-    config.set_address()
-
+def configure_ips(config):
     logging.debug("Configuring ip addresses")
-    # IP configuration
     config.address().compare()
     config.address().process()
 
+
+def configure_vmpassword(config):
     logging.debug("Configuring vmpassword")
     password = CsPassword("vmpassword", config)
     password.process()
 
+
+def configure_vmdata(config):
     logging.debug("Configuring vmdata")
     metadata = CsVmMetadata('vmdata', config)
     metadata.process()
 
+
+def configure_networkacl(config):
     logging.debug("Configuring networkacl")
     acls = CsAcl('networkacl', config)
     acls.process()
 
+
+def configure_firewallrules(config):
     logging.debug("Configuring firewall rules")
     acls = CsAcl('firewallrules', config)
     acls.process()
 
+
+def configure_forwardingrules(config):
     logging.debug("Configuring PF rules")
     fwd = CsForwardingRules("forwardingrules", config)
     fwd.process()
 
+
+def configure_redundant(config):
     red = CsRedundant(config)
     red.set()
 
+
+def configure_site2sitevpn(config):
     logging.debug("Configuring s2s vpn")
     vpns = CsSite2SiteVpn("site2sitevpn", config)
     vpns.process()
 
+
+def configure_remoteaccessvpn(config):
     logging.debug("Configuring remote access vpn")
-    #remote access vpn
     rvpn = CsRemoteAccessVpn("remoteaccessvpn", config)
     rvpn.process()
 
+
+def configure_vpnusers(config):
     logging.debug("Configuring vpn users list")
-    #remote access vpn users
     vpnuser = CsVpnUser("vpnuserlist", config)
     vpnuser.process()
 
+
+def configure_dhcp(config):
     logging.debug("Configuring dhcp entry")
     dhcp = CsDhcp("dhcpentry", config)
     dhcp.process()
 
+
+def configure_loadbalancer(config):
     logging.debug("Configuring load balancer")
     lb = CsLoadBalancer("loadbalancer", config)
     lb.process()
 
+
+def configure_monitor(config):
     logging.debug("Configuring monitor service")
     mon = CsMonitor("monitorservice", config)
     mon.process()
 
+
+def configure_iptables(config):
     logging.debug("Configuring iptables rules .....")
-    nf = CsNetfilters()
+    nf = CsNetfilters(atomic=True)
     nf.compare(config.get_fw())
 
     logging.debug("Configuring iptables rules done ...saving rules")
@@ -945,5 +965,73 @@ def main(argv):
     CsHelper.save_iptables("iptables-save", "/etc/iptables/router_rules.v4")
     CsHelper.save_iptables("ip6tables-save", "/etc/iptables/router_rules.v6")
 
+
+# The configure stages in the order they run with the databags they depend on.
+# Stages that add firewall rules are flagged: the iptables rules are compared
+# with the complete list of rules, so all of them run whenever one of them does.
+STAGES = [
+    ("ips", ["ips", "cmdline", "guestnetwork"], True, configure_ips),
+    ("vmpassword", ["vmpassword", "ips"], False, configure_vmpassword),
+    ("vmdata", ["vmdata"], False, configure_vmdata),
+    ("networkacl", ["networkacl"], True, configure_networkacl),
+    ("firewallrules", ["firewallrules"], True, configure_firewallrules),
+    ("forwardingrules", ["forwardingrules"], True, configure_forwardingrules),
+    ("redundant", ["cmdline", "ips", "guestnetwork"], False, configure_redundant),
+    ("site2sitevpn", ["site2sitevpn"], True, configure_site2sitevpn),
+    ("remoteaccessvpn", ["remoteaccessvpn"], True, configure_remoteaccessvpn),
+    ("vpnusers", ["vpnuserlist"], False, configure_vpnusers),
+    ("dhcp", ["dhcpentry", "ips", "guestnetwork", "cmdline"], False, configure_dhcp),
+    ("loadbalancer", ["loadbalancer"], True, configure_loadbalancer),
+    ("monitor", ["monitorservice"], False, configure_monitor),
+    ("iptables", [], True, configure_iptables)
+]
+
+
+def get_stages(changed=None):
+    """ Return the names of the stages to run for the changed databags
+    All stages run when changed is None or empty, nothing is known to
+    be converged already then
+    """
+    if not changed:
+        return [stage[0] for stage in STAGES]
+    changed = set(changed)
+    firewall = False
+    for name, bags, fw, method in STAGES:
+        if fw and changed.intersection(bags):
+            firewall = True
+    return [name for name, bags, fw, method in STAGES if changed.intersection(bags) or (fw and firewall)]
+
+
+def main(argv, changed=None):
+    """ Converge the router to the databags
+    changed is the list of databags updated since the last run, only the
+    stages depending on them are run. Without it, when it is empty, or
+    with --full in argv, everything is configured.
+    """
+    # Every databag is read once and shared by all the stages
+    DataBag.enable_cache()
+    config = CsConfig()
+    logging.basicConfig(filename=config.get_logger(),
+                        level=config.get_level(),
+                        format=config.get_format())
+    config.set_address()
+
+    if "--full" in argv:
+        changed = None
+    stages = get_stages(changed)
+    logging.info("Configure stages for changed databags %s: %s", changed, stages)
+
+    total = time.time()
+    try:
+        for name, bags, fw, method in STAGES:
+            if name not in stages:
+                continue
+            start = time.time()
+            method(config)
+            logging.info("Configure stage %s took %.3fs", name, time.time() - start)
+    finally:
+        DataBag.flush()
+    logging.info("Configure took %.3fs", time.time() - total)
+
 if __name__ == "__main__":
     main(sys.argv)
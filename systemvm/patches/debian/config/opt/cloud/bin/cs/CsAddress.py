@@ -270,6 +270,7 @@ class CsIP:
                 logging.info("Configuring address %s on device %s", self.ip(), self.dev)
                 cmd = "ip addr add dev %s %s brd +" % (self.dev, self.ip())
                 subprocess.call(cmd, shell=True)
+                CsHelper.invalidate_network()
             except Exception as e:
                 logging.info("Exception occurred ==> %s" % e)
 
@@ -542,12 +543,9 @@ class CsIP:
 
     def list(self):
         self.iplist = {}
-        cmd = ("ip addr show dev " + self.dev)
-        for i in CsHelper.execute(cmd):
-            vals = i.lstrip().split()
-            if (vals[0] == 'inet'):
-                
-                cidr = vals[1]
+        for address in CsHelper.get_addresses():
+            if address['link'] == self.dev:
+                cidr = address['ip']
                 for ip, device in self.iplist.iteritems():
                     logging.info(
                                  "Iterating over the existing IPs. CIDR to be configured ==> %s, existing IP ==> %s on device ==> %s",
@@ -642,6 +640,7 @@ class CsIP:
         for ip in remove:
             cmd = "ip addr del dev %s %s" % (self.dev, ip)
             subprocess.call(cmd, shell=True)
+            CsHelper.invalidate_network()
             logging.info("Removed address %s from device %s", ip, self.dev)
             self.post_config_change("delete")
 
@@ -23,9 +23,7 @@ class CsDataBag(object):
 
     def __init__(self, key, config=None):
         self.data = {}
-        self.db = DataBag()
-        self.db.setKey(key)
-        self.db.load()
+        self.db = DataBag.get(key)
         self.dbag = self.db.getDataBag()
         if config:
             self.fw = config.get_fw()
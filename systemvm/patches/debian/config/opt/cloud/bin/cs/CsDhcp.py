@@ -43,19 +43,27 @@ class CsDhcp(CsDataBag):
             if item == "id":
                 continue
             self.add(self.dbag[item])
-        self.write_hosts()
-        
-        if self.cloud.is_changed():
+        hosts_changed = self.write_hosts()
+        dhcp_changed = self.cloud.is_changed()
+
+        if dhcp_changed:
             self.delete_leases()
 
         self.configure_server()
-
-        # We restart DNSMASQ every time the configure.py is called in order to avoid lease problems.
-        CsHelper.service("dnsmasq", "restart")
+        conf_changed = self.conf.is_changed()
 
         self.conf.commit()
         self.cloud.commit()
 
+        # dnsmasq rereads the hosts and dhcp hosts files on SIGHUP, it only
+        # needs a restart for its own configuration
+        if conf_changed:
+            CsHelper.service("dnsmasq", "restart")
+        elif hosts_changed or dhcp_changed:
+            CsHelper.hup_dnsmasq("dnsmasq", "dnsmasq")
+        else:
+            CsHelper.start_if_stopped("dnsmasq")
+
     def configure_server(self):
         # self.conf.addeq("dhcp-hostsfile=%s" % DHCP_HOSTS)
         for i in self.devinfo:
@@ -96,31 +104,42 @@ class CsDhcp(CsDataBag):
             self.conf.search(sline, line)
 
     def delete_leases(self):
-        changed = []
-        leases = []
+        """ Release the leases of the hosts whose mac/ip pair changed """
+        pairs = set()
+        for line in self.cloud.new_config:
+            bits = line.strip().split(',')
+            if len(bits) > 1:
+                pairs.add((bits[0], bits[1]))
+        changed = set()
+        for line in set(self.cloud.config) ^ set(self.cloud.new_config):
+            changed.update(line.strip().split(',')[:2])
+        release = []
         try:
             for line in open(LEASES):
+                # expiry mac ip hostname client-id
                 bits = line.strip().split(' ')
-                to = {"device": bits[0],
-                      "mac": bits[1],
-                      "ip": bits[2],
-                      "host": bits[3:],
-                      "del": False
-                      }
-                changed.append(to)
-
-                for v in changed:
-                    if v['mac'] == to['mac'] or v['ip'] == to['ip'] or v['host'] == to['host']:
-                        to['del'] = True
-                leases.append(to)
-
-            for o in leases:
-                if o['del']:
-                    cmd = "dhcp_release eth%s %s %s" % (o['device'], o['ip'], o['mac'])
-                    logging.info(cmd)
-                    CsHelper.execute(cmd)
+                if len(bits) < 3:
+                    continue
+                mac = bits[1]
+                ip = bits[2]
+                if (mac, ip) in pairs or (mac not in changed and ip not in changed):
+                    continue
+                device = self.get_device(ip)
+                if device:
+                    release.append("dhcp_release %s %s %s" % (device, ip, mac))
         except IOError:
             return
+        if release:
+            logging.info("Releasing %s dhcp leases: %s", len(release), release)
+            CsHelper.execute(" ; ".join(release))
+
+    def get_device(self, ip):
+        """ Return the device serving the network of the ip """
+        i = IPAddress(ip)
+        for v in self.devinfo:
+            if i in v['network']:
+                return v['dev']
+        return None
 
     def preseed(self):
         self.add_host("127.0.0.1", "localhost")
@@ -140,8 +159,9 @@ class CsDhcp(CsDataBag):
         if file.is_changed():
             file.commit()
             logging.info("Updated hosts file")
-        else:
-            logging.debug("Hosts file unchanged")
+            return True
+        logging.debug("Hosts file unchanged")
+        return False
 
     def add(self, entry):
         self.add_host(entry['ipv4_adress'], entry['host_name'])
@@ -22,9 +22,7 @@ class CsGuestNetwork:
     def __init__(self, device, config):
         self.data = {}
         self.guest = True
-        db = DataBag()
-        db.setKey("guestnetwork")
-        db.load()
+        db = DataBag.get("guestnetwork")
         dbag = db.getDataBag()
         self.config = config
         if device in dbag.keys() and len(dbag[device]) != 0:
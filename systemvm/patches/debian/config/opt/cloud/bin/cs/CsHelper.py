@@ -22,11 +22,21 @@ for use in the configuration process
 import subprocess
 import logging
 import os.path
+import pwd
 import re
 import shutil
+import signal
+import socket
+import CsNetlink
 from netaddr import *
 from pprint import pprint
 
+# Addresses and routes read from the kernel, kept until the network changes
+network = {}
+# Commands after which the addresses and routes have to be read again
+NETWORK_CHANGES = re.compile(r"^\s*(ifconfig\s|ip\s+(-4\s+)?(addr|address|route|link)\s+(add|del|delete|flush|set|change|replace|append)\b)")
+ROUTE_TABLES = "/etc/iproute2/rt_tables"
+
 
 def is_mounted(name):
     for i in execute("mount"):
@@ -84,18 +94,58 @@ def bool_to_yn(val):
     return "no"
 
 
+def get_addresses():
+    """ Returns the ipv4 addresses on the system
+    They are read once and cached until a command changes the network
+    """
+    if 'addresses' not in network:
+        try:
+            network['addresses'] = CsNetlink.get_addresses()
+        except (socket.error, OSError) as e:
+            logging.error("Could not read the addresses: %s" % e)
+            return []
+    return network['addresses']
+
+
+def get_routes():
+    """ Returns the ipv4 routes of all tables, cached like get_addresses() """
+    if 'routes' not in network:
+        try:
+            network['routes'] = CsNetlink.get_routes()
+        except (socket.error, OSError) as e:
+            logging.error("Could not read the routes: %s" % e)
+            return []
+    return network['routes']
+
+
+def get_route_tables():
+    """ Returns the routing table numbers by name """
+    tables = {"unspec": 0, "default": 253, "main": 254, "local": 255}
+    try:
+        for line in open(ROUTE_TABLES):
+            vals = line.split()
+            if len(vals) > 1 and vals[0].isdigit():
+                tables[vals[1]] = int(vals[0])
+    except IOError:
+        logging.debug("File %s does not exist" % ROUTE_TABLES)
+    return tables
+
+
+def invalidate_network():
+    """ Read the addresses and routes again on next use """
+    network.clear()
+
+
 def get_device_info():
     """ Returns all devices on system with their ipv4 ip netmask """
     list = []
-    for i in execute("ip addr show"):
-        vals = i.strip().lstrip().rstrip().split()
-        if vals[0] == "inet":
-            to = {}
-            to['ip'] = vals[1]
-            to['dev'] = vals[-1]
-            to['network'] = IPNetwork(to['ip'])
-            to['dnsmasq'] = False
-            list.append(to)
+    for address in get_addresses():
+        to = {}
+        to['ip'] = address['ip']
+        to['dev'] = address['dev']
+        to['network'] = IPNetwork(to['ip'])
+        to['dnsmasq'] = False
+        list.append(to)
     return list
 
 
@@ -111,21 +161,17 @@ def get_device(ip):
     """ Returns the device which has a specific ip
     If the ip is not found returns an empty string
     """
-    for i in execute("ip addr show"):
-        vals = i.strip().lstrip().rstrip().split()
-        if vals[0] == "inet":
-            if vals[1].split('/')[0] == ip:
-                return vals[-1]
+    for address in get_addresses():
+        if address['ip'].split('/')[0] == ip:
+            return address['dev']
     return ""
 
 
 def get_ip(device):
     """ Return first ip on an interface """
-    cmd = "ip addr show dev %s" % device
-    for i in execute(cmd):
-        vals = i.lstrip().split()
-        if (vals[0] == 'inet'):
-            return vals[1]
+    for address in get_addresses():
+        if address['link'] == device:
+            return address['ip']
     return ""
 
 
@@ -160,9 +206,24 @@ def execute(command):
     logging.debug("Executing: %s" % command)
     p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
     result = p.communicate()[0]
+    if NETWORK_CHANGES.match(command):
+        invalidate_network()
     return result.splitlines()
 
 
+def execute_input(command, data):
+    """ Execute command with data on its standard input
+    Returns True if the command exited successfully
+    """
+    logging.debug("Executing: %s" % command)
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    err = p.communicate(data)[1]
+    if p.returncode != 0:
+        logging.error("Command %s failed with code %s: %s" % (command, p.returncode, err.strip()))
+        return False
+    return True
+
+
 def save_iptables(command, iptables_file):
     """ Execute command """
     logging.debug("Saving iptables for %s" % command)
@@ -195,15 +256,53 @@ def start_if_stopped(name):
         execute2("service %s start" % name)
 
 
+def get_process_uid(pid):
+    """ Returns the real uid of a process
+    The owner of /proc/<pid> is root for processes which changed their uid,
+    like dnsmasq, so it is read from the Uid: line of its status
+    """
+    handle = open("/proc/%s/status" % pid)
+    try:
+        for line in handle:
+            if line.startswith("Uid:"):
+                return int(line.split()[1])
+    finally:
+        handle.close()
+    return None
+
+
+def get_processes():
+    """ Returns the pid, real uid and command line of the running processes """
+    procs = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            handle = open("/proc/%s/cmdline" % pid)
+            cmdline = handle.read()
+            handle.close()
+            uid = get_process_uid(pid)
+        except (IOError, OSError, ValueError):
+            # The process exited
+            continue
+        # Kernel threads have no command line
+        if cmdline:
+            procs.append((pid, uid, " ".join(cmdline.rstrip("\0").split("\0"))))
+    return procs
+
+
 def hup_dnsmasq(name, user):
     pid = ""
-    for i in execute("ps -ef | grep %s" % name):
-        vals = i.lstrip().split()
-        if (vals[0] == user):
-            pid = vals[1]
+    try:
+        uid = pwd.getpwnam(user).pw_uid
+    except KeyError:
+        uid = None
+    for p, u, cmdline in get_processes():
+        if u == uid and name in cmdline:
+            pid = p
     if pid:
         logging.info("Sent hup to %s", name)
-        execute("kill -HUP %s" % pid)
+        os.kill(int(pid), signal.SIGHUP)
     else:
         service("dnsmasq", "start")
 
@@ -79,10 +79,18 @@ class CsTable(object):
 
 class CsNetfilters(object):
 
-    def __init__(self, load=True):
+    def __init__(self, load=True, atomic=False):
         self.rules = []
+        # Rules indexed on their canonical key, see CsNetfilter.get_key()
+        self.index = {}
+        self.purge = False
         self.table = CsTable()
         self.chain = CsChain()
+        # In atomic mode the changes are queued per table and applied
+        # with a single iptables-restore transaction in commit()
+        self.atomic = atomic
+        self.pending = {}
+        self.diff = {}
         if load:
             self.get_all_rules()
 
@@ -102,11 +110,20 @@ class CsNetfilters(object):
                 self.save(rule)
 
     def save(self, rule):
+        self.purge_deleted()
         self.rules.append(rule)
+        self.index.setdefault(rule.get_key(), []).append(rule)
 
     def get(self):
+        self.purge_deleted()
         return self.rules
 
+    def purge_deleted(self):
+        """ Drop the rules removed by delete() from the ordered list """
+        if self.purge:
+            self.rules[:] = [x for x in self.rules if x.get_key() in self.index]
+            self.purge = False
+
     def has_table(self, table):
         return table in self.table.get()
 
@@ -114,20 +131,20 @@ class CsNetfilters(object):
         return self.chain.has_chain(table, chain)
 
     def has_rule(self, new_rule):
-        for r in self.get():
-            if new_rule == r:
-                if new_rule.get_count() > 0:
-                    continue
-                r.mark_seen()
-                return True
-        return False
+        # Rules with a position are always (re)inserted
+        if new_rule.get_count() > 0:
+            return False
+        matches = self.index.get(new_rule.get_key())
+        if not matches:
+            return False
+        matches[0].mark_seen()
+        return True
 
     def get_unseen(self):
-        del_list = [x for x in self.rules if x.unseen()]
+        del_list = [x for x in self.get() if x.unseen()]
         for r in del_list:
-            cmd = "iptables -t %s %s" % (r.get_table(), r.to_str(True))
-            logging.debug("unseen cmd:  %s ", cmd)
-            CsHelper.execute(cmd)
+            logging.debug("unseen cmd:  %s ", r.to_str(True))
+            self.apply(r.get_table(), r.to_str(True), "delete")
             # print "Delete rule %s from table %s" % (r.to_str(True), r.get_table())
             logging.info("Delete rule %s from table %s", r.to_str(True), r.get_table())
 
@@ -164,16 +181,62 @@ class CsNetfilters(object):
                 if isinstance(fw[1], int):
                     cpy = cpy.replace("-A %s" % new_rule.get_chain(), '-I %s %s' % (new_rule.get_chain(), fw[1]))
 
-                CsHelper.execute("iptables -t %s %s" % (new_rule.get_table(), cpy))
+                self.apply(new_rule.get_table(), cpy.strip(), "add")
         self.del_standard()
         self.get_unseen()
+        self.commit()
 
     def add_chain(self, rule):
         """ Add the given chain if it is not already present """
         if not self.has_chain(rule.get_table(), rule.get_chain()):
-            CsHelper.execute("iptables -t %s -N %s" % (rule.get_table(), rule.get_chain()))
+            if self.atomic:
+                self.get_pending(rule.get_table())['chains'].append(rule.get_chain())
+            else:
+                CsHelper.execute("iptables -t %s -N %s" % (rule.get_table(), rule.get_chain()))
             self.chain.add(rule.get_table(), rule.get_chain())
 
+    def get_pending(self, table):
+        if table not in self.pending:
+            self.pending[table] = {'chains': [], 'rules': []}
+        return self.pending[table]
+
+    def get_diff(self):
+        """ Return the rules added and deleted by compare() per table """
+        return self.diff
+
+    def apply(self, table, rule, action):
+        """ Add or delete a rule
+        In atomic mode the rule is queued until commit() is called
+        """
+        self.diff.setdefault(table, {'add': [], 'delete': []})[action].append(rule)
+        if self.atomic:
+            self.get_pending(table)['rules'].append(rule)
+        else:
+            CsHelper.execute("iptables -t %s %s" % (table, rule))
+
+    def commit(self):
+        """ Apply the queued changes with one iptables-restore --noflush per table
+        If a transaction fails nothing has been changed for that table, so the
+        rules are applied one by one instead
+        """
+        for table in self.diff:
+            logging.info("Table %s: %s rules added, %s rules deleted", table,
+                         len(self.diff[table]['add']), len(self.diff[table]['delete']))
+        for table, pending in self.pending.items():
+            lines = ["*%s" % table]
+            lines.extend([":%s - [0:0]" % c for c in pending['chains']])
+            lines.extend(pending['rules'])
+            lines.append("COMMIT")
+            data = "\n".join(lines) + "\n"
+            logging.debug("Restoring table %s:\n%s", table, data)
+            if not CsHelper.execute_input("iptables-restore --noflush", data.encode("utf-8")):
+                logging.error("iptables-restore failed for table %s, applying rules one by one", table)
+                for chain in pending['chains']:
+                    CsHelper.execute("iptables -t %s -N %s" % (table, chain))
+                for rule in pending['rules']:
+                    CsHelper.execute("iptables -t %s %s" % (table, rule))
+        self.pending = {}
+
     def del_standard(self):
         """ Del rules that are there but should not be deleted
         These standard firewall rules vary according to the device type
@@ -201,7 +264,8 @@ class CsNetfilters(object):
     def delete(self, rule):
         """ Delete a rule from the list of configured rules
         The rule will not actually be removed on the host """
-        self.rules[:] = [x for x in self.rules if not x == rule]
+        if self.index.pop(rule.get_key(), None) is not None:
+            self.purge = True
 
 
 class CsNetfilter(object):
@@ -212,9 +276,11 @@ class CsNetfilter(object):
         self.chain = ''
         self.seen = False
         self.count = 0
+        self.key = None
 
     def parse(self, rule):
         self.rule = self.__convert_to_dict(rule)
+        self.key = None
 
     def unseen(self):
         return self.seen is False
@@ -243,12 +309,14 @@ class CsNetfilter(object):
         if table == '':
             table = "filter"
         self.table = table
+        self.key = None
 
     def get_table(self):
         return self.table
 
     def set_chain(self, chain):
         self.chain = chain
+        self.key = None
 
     def set_count(self, count=0):
         self.count = count
@@ -282,14 +350,17 @@ class CsNetfilter(object):
         str = str.replace("--checksum fill", "--checksum-fill")
         return str
 
+    def get_key(self):
+        """ Canonical, hashable form of the rule: (table, chain, sorted options) """
+        if self.key is None:
+            self.key = (self.table, self.chain, tuple(sorted(self.rule.items())))
+        return self.key
+
     def __eq__(self, rule):
-        if rule.get_table() != self.get_table():
-            return False
-        if rule.get_chain() != self.get_chain():
-            return False
-        if len(rule.get_rule().items()) != len(self.get_rule().items()):
-            return False
-        common = set(rule.get_rule().items()) & set(self.get_rule().items())
-        if len(common) != len(rule.get_rule()):
-            return False
-        return True
+        return self.get_key() == rule.get_key()
+
+    def __ne__(self, rule):
+        return not self.__eq__(rule)
+
+    def __hash__(self):
+        return hash(self.get_key())
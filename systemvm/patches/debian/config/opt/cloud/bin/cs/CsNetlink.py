@@ -0,0 +1,161 @@
+# -- coding: utf-8 --
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+""" Read the interfaces, ipv4 addresses and routes from the kernel
+using rtnetlink, without forking ip
+
+"""
+import os
+import socket
+import struct
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+IFA_BROADCAST = 4
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PREFSRC = 7
+RTA_TABLE = 15
+
+NLMSGHDR = "=LHHLL"
+IFINFOMSG = "=BxHiII"
+IFADDRMSG = "=BBBBI"
+RTMSG = "=BBBBBBBBI"
+RTATTR = "=HH"
+
+
+def align(length):
+    return (length + 3) & ~3
+
+
+def dump(msg_type, payload):
+    """ Send a dump request and return the (type, data) of the replies """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        header = struct.pack(NLMSGHDR, struct.calcsize(NLMSGHDR) + len(payload),
+                             msg_type, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+        sock.send(header + payload)
+        messages = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, reply, flags, seq, pid = struct.unpack_from(NLMSGHDR, data, offset)
+                if reply == NLMSG_DONE:
+                    return messages
+                if reply == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", data, offset + struct.calcsize(NLMSGHDR))[0]
+                    raise OSError(-error, os.strerror(-error))
+                messages.append((reply, data[offset + struct.calcsize(NLMSGHDR):offset + length]))
+                offset += align(length)
+    finally:
+        sock.close()
+
+
+def attributes(data, offset):
+    """ Return the route attributes from offset on as a dict """
+    attrs = {}
+    while offset + struct.calcsize(RTATTR) <= len(data):
+        length, attr = struct.unpack_from(RTATTR, data, offset)
+        if length < struct.calcsize(RTATTR):
+            break
+        attrs[attr] = data[offset + struct.calcsize(RTATTR):offset + length]
+        offset += align(length)
+    return attrs
+
+
+def get_links():
+    """ Returns a dict of interface index to name """
+    links = {}
+    payload = struct.pack(IFINFOMSG, socket.AF_UNSPEC, 0, 0, 0, 0)
+    for reply, data in dump(RTM_GETLINK, payload):
+        if reply != RTM_NEWLINK:
+            continue
+        index = struct.unpack_from(IFINFOMSG, data)[2]
+        attrs = attributes(data, struct.calcsize(IFINFOMSG))
+        if IFLA_IFNAME in attrs:
+            links[index] = attrs[IFLA_IFNAME].rstrip('\0')
+    return links
+
+
+def get_addresses():
+    """ Returns the ipv4 addresses as dicts with
+    ip (address/prefix), dev (the label ip addr show prints) and link (the interface)
+    """
+    links = get_links()
+    addresses = []
+    payload = struct.pack(IFADDRMSG, socket.AF_INET, 0, 0, 0, 0)
+    for reply, data in dump(RTM_GETADDR, payload):
+        if reply != RTM_NEWADDR:
+            continue
+        family, prefixlen, flags, scope, index = struct.unpack_from(IFADDRMSG, data)
+        attrs = attributes(data, struct.calcsize(IFADDRMSG))
+        address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+        if family != socket.AF_INET or address is None:
+            continue
+        link = links.get(index, str(index))
+        addresses.append({'ip': "%s/%s" % (socket.inet_ntoa(address), prefixlen),
+                          'dev': attrs.get(IFA_LABEL, link).rstrip('\0'),
+                          'link': link})
+    return addresses
+
+
+def get_routes():
+    """ Returns the ipv4 routes of all tables as dicts with
+    dst (network/prefix), table (number), dev, via and src when known
+    """
+    links = get_links()
+    routes = []
+    payload = struct.pack(RTMSG, socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+    for reply, data in dump(RTM_GETROUTE, payload):
+        if reply != RTM_NEWROUTE:
+            continue
+        fields = struct.unpack_from(RTMSG, data)
+        attrs = attributes(data, struct.calcsize(RTMSG))
+        dst = "0.0.0.0"
+        if RTA_DST in attrs:
+            dst = socket.inet_ntoa(attrs[RTA_DST])
+        route = {'dst': "%s/%s" % (dst, fields[1]), 'table': fields[4]}
+        if RTA_TABLE in attrs:
+            route['table'] = struct.unpack("=I", attrs[RTA_TABLE])[0]
+        if RTA_OIF in attrs:
+            oif = struct.unpack("=i", attrs[RTA_OIF])[0]
+            route['dev'] = links.get(oif, str(oif))
+        if RTA_GATEWAY in attrs:
+            route['via'] = socket.inet_ntoa(attrs[RTA_GATEWAY])
+        if RTA_PREFSRC in attrs:
+            route['src'] = socket.inet_ntoa(attrs[RTA_PREFSRC])
+        routes.append(route)
+    return routes
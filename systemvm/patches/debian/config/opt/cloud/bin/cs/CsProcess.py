@@ -40,12 +40,12 @@ class CsProcess(object):
 
     def find_pid(self):
         self.pid = []
-        for i in CsHelper.execute("ps aux"):
-            items = len(self.search)
-            proc = re.split("\s+", i)[items*-1:]
+        items = len(self.search)
+        for pid, uid, cmdline in CsHelper.get_processes():
+            proc = re.split("\s+", cmdline)[items*-1:]
             matches = len([m for m in proc if m in self.search])
             if matches == items:
-                self.pid.append(re.split("\s+", i)[1])
+                self.pid.append(pid)
 
         logging.debug("CsProcess:: Searching for process ==> %s and found PIDs ==> %s", self.search, self.pid)
         return self.pid
@@ -59,7 +59,7 @@ class CsProcess(object):
             CsHelper.execute("kill -9 %s" % pid)
 
     def grep(self, str):
-        for i in CsHelper.execute("ps aux"):
-            if i.find(str) != -1:
-                return re.split("\s+", i)[1]
+        for pid, uid, cmdline in CsHelper.get_processes():
+            if cmdline.find(str) != -1:
+                return pid
         return -1
@@ -17,6 +17,7 @@
 # under the License.
 import CsHelper
 import logging
+from netaddr import IPNetwork
 
 
 class CsRoute:
@@ -51,11 +52,35 @@ class CsRoute:
         cmd = "dev %s table %s %s" % (dev, table, address)
         self.set_route(cmd)
 
+    def find_route(self, cmd):
+        """ Return True if 'ip route show cmd' would list a route
+        Supports the dev, table and via selectors and an exact prefix
+        """
+        selectors = {'table': 'main'}
+        args = cmd.split()
+        while args:
+            arg = args.pop(0)
+            if arg in ['dev', 'table', 'via'] and args:
+                selectors[arg] = args.pop(0)
+            else:
+                selectors['dst'] = arg
+        tables = CsHelper.get_route_tables()
+        table = selectors.pop('table')
+        table = tables.get(table, int(table) if table.isdigit() else None)
+        if 'dst' in selectors:
+            if selectors['dst'] == "default":
+                selectors['dst'] = "0.0.0.0/0"
+            selectors['dst'] = str(IPNetwork(selectors['dst']).cidr)
+        for route in CsHelper.get_routes():
+            if route['table'] != table:
+                continue
+            if len([k for k in selectors if route.get(k) != selectors[k]]) == 0:
+                return True
+        return False
+
     def set_route(self, cmd, method="add"):
         """ Add a route if it is not already defined """
-        found = False
-        for i in CsHelper.execute("ip route show " + cmd):
-            found = True
+        found = self.find_route(cmd)
         if not found and method == "add":
             logging.info("Add " + cmd)
             cmd = "ip route add " + cmd
@@ -87,10 +112,10 @@ class CsRoute:
         :return: bool
         """
         logging.info("Checking if default ipv4 route is present")
-        route_found = CsHelper.execute("ip -4 route list 0/0")
+        route_found = [r for r in CsHelper.get_routes() if r['table'] == 254 and r['dst'] == "0.0.0.0/0"]
 
         if len(route_found) > 0:
-            logging.info("Default route found: " + route_found[0])
+            logging.info("Default route found: %s" % route_found[0])
             return True
         else:
             logging.warn("No default route found!")
@@ -19,31 +19,49 @@ from pprint import pprint
 from netaddr import *
 
 
-def merge(dbag, data):
-
-    search(dbag, data['host_name'])
+def merge(dbag, data, index=None):
+    """
+    index maps the host names to their ip addresses, see build_index
+    """
+    if index is None:
+        index = build_index(dbag)
+    search(dbag, data['host_name'], index)
     # A duplicate ip address wil clobber the old value
     # This seems desirable ....
     if "add" in data and data['add'] is False and \
             "ipv4_adress" in data:
         if data['ipv4_adress'] in dbag:
+            unindex(index, dbag[data['ipv4_adress']]['host_name'], data['ipv4_adress'])
             del(dbag[data['ipv4_adress']])
         return dbag
     else:
+        if data['ipv4_adress'] in dbag:
+            unindex(index, dbag[data['ipv4_adress']]['host_name'], data['ipv4_adress'])
         dbag[data['ipv4_adress']] = data
+        index.setdefault(data['host_name'], set()).add(data['ipv4_adress'])
     return dbag
 
 
-def search(dbag, name):
-    """
-    Dirty hack because CS does not deprovision hosts
-    """
-    hosts = []
+def build_index(dbag):
+    index = {}
     for o in dbag:
         if o == 'id':
             continue
-        print "%s %s" % (dbag[o]['host_name'], name)
-        if dbag[o]['host_name'] == name:
-            hosts.append(o)
-    for o in hosts:
-        del(dbag[o])
+        index.setdefault(dbag[o]['host_name'], set()).add(o)
+    return index
+
+
+def unindex(index, name, ip):
+    if name in index:
+        index[name].discard(ip)
+        if not index[name]:
+            del(index[name])
+
+
+def search(dbag, name, index):
+    """
+    Dirty hack because CS does not deprovision hosts
+    """
+    for o in index.pop(name, set()):
+        if o in dbag:
+            del(dbag[o])
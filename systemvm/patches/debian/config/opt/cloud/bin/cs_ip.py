@@ -19,14 +19,15 @@ from pprint import pprint
 from netaddr import *
 
 
-def merge(dbag, ip):
-    added = False
-    for dev in dbag:
-        if dev == "id":
-            continue
-        for address in dbag[dev]:
-            if address['public_ip'] == ip['public_ip']:
-                dbag[dev].remove(address)
+def merge(dbag, ip, index=None):
+    """
+    index maps the public ips to their devices, see build_index
+    """
+    if index is None:
+        index = build_index(dbag)
+    for dev in index.pop(ip['public_ip'], set()):
+        if dev in dbag:
+            dbag[dev][:] = [x for x in dbag[dev] if x['public_ip'] != ip['public_ip']]
 
     ipo = IPNetwork(ip['public_ip'] + '/' + ip['netmask'])
     ip['device'] = 'eth' + str(ip['nic_dev_id'])
@@ -37,8 +38,24 @@ def merge(dbag, ip):
     if 'nw_type' not in ip.keys():
         ip['nw_type'] = 'public'
     if ip['nw_type'] == 'control':
-        dbag['eth' + str(ip['nic_dev_id'])] = [ip]
+        for address in dbag.get(ip['device'], []):
+            if address['public_ip'] in index:
+                index[address['public_ip']].discard(ip['device'])
+                if not index[address['public_ip']]:
+                    del index[address['public_ip']]
+        dbag[ip['device']] = [ip]
     else:
-        dbag.setdefault('eth' + str(ip['nic_dev_id']), []).append(ip)
+        dbag.setdefault(ip['device'], []).append(ip)
+    index.setdefault(ip['public_ip'], set()).add(ip['device'])
 
     return dbag
+
+
+def build_index(dbag):
+    index = {}
+    for dev in dbag:
+        if dev == "id":
+            continue
+        for address in dbag[dev]:
+            index.setdefault(address['public_ip'], set()).add(dev)
+    return index
@@ -41,9 +41,52 @@ from pprint import pprint
 class DataBag:
 
     DPATH = "/etc/cloudstack"
+    # Databags shared by the whole process while caching is enabled
+    cache = None
+    # Databags read by other processes during the run, e.g. the redundant
+    # state in cmdline by master.py and keepalived, are written on save()
+    shared = ["cmdline"]
 
     def __init__(self):
         self.bdata = {}
+        self.cached = False
+        self.dirty = False
+        self.indexes = {}
+
+    @classmethod
+    def get(cls, key):
+        """ Return the loaded databag for key
+        While caching is enabled each databag is only read once per process
+        and save() defers the write to flush(), except for the shared ones
+        """
+        if cls.cache is not None and key in cls.cache:
+            return cls.cache[key]
+        db = cls()
+        db.setKey(key)
+        db.load()
+        if cls.cache is not None:
+            db.cached = True
+            cls.cache[key] = db
+        return db
+
+    @classmethod
+    def enable_cache(cls):
+        if cls.cache is None:
+            cls.cache = {}
+
+    @classmethod
+    def flush(cls):
+        """ Write the changed cached databags """
+        if cls.cache is None:
+            return
+        for db in cls.cache.values():
+            if db.dirty:
+                db.write()
+
+    @classmethod
+    def disable_cache(cls):
+        cls.flush()
+        cls.cache = None
 
     def load(self):
         data = self.bdata
@@ -62,19 +105,40 @@ class DataBag:
         self.dbag = data
 
     def save(self, dbag):
+        if dbag is not self.dbag:
+            self.indexes = {}
+        self.dbag = dbag
+        if self.cached and self.key not in self.shared:
+            self.dirty = True
+        else:
+            self.write()
+
+    def write(self):
+        """ Write to a temporary file and rename it, so the databag is never truncated """
+        tmp = self.fpath + ".tmp"
+        logging.debug("Writing data bag type %s", self.key)
+        logging.debug(self.dbag)
         try:
-            handle = open(self.fpath, 'w')
-        except IOError:
+            handle = open(tmp, 'w')
+            handle.write(json.dumps(self.dbag, indent=4, sort_keys=True))
+            handle.close()
+            os.rename(tmp, self.fpath)
+        except (IOError, OSError):
             logging.error("Could not write data bag %s", self.key)
         else:
-            logging.debug("Writing data bag type %s", self.key)
-            logging.debug(dbag)
-        jsono = json.dumps(dbag, indent=4, sort_keys=True)
-        handle.write(jsono)
+            self.dirty = False
 
     def getDataBag(self):
         return self.dbag
 
+    def getIndex(self, name, build):
+        """ Return a secondary index of the databag, build(dbag) creates it on first use
+        The merge functions keep the index up to date, so it lives as long as the databag
+        """
+        if name not in self.indexes:
+            self.indexes[name] = build(self.dbag)
+        return self.indexes[name]
+
     def setKey(self, key):
         self.key = key
 
@@ -82,6 +146,8 @@ class DataBag:
 class updateDataBag:
 
     DPATH = "/etc/cloudstack"
+    # Keys of the databags merged by this process, see configure.get_stages()
+    changed = set()
 
     def __init__(self, qFile):
         self.qFile = qFile
@@ -90,12 +156,11 @@ class updateDataBag:
         self.process()
 
     def process(self):
-        self.db = DataBag()
         if (self.qFile.type == "staticnatrules" or self.qFile.type == "forwardrules"):
-            self.db.setKey("forwardingrules")
+            key = "forwardingrules"
         else:
-            self.db.setKey(self.qFile.type)
-        dbag = self.db.load()
+            key = self.qFile.type
+        self.db = DataBag.get(key)
         logging.info("Command of type %s received", self.qFile.type)
 
         if self.qFile.type == 'ips':
@@ -130,6 +195,7 @@ class updateDataBag:
             logging.error("Error I do not know what to do with file of type %s", self.qFile.type)
             return
         self.db.save(dbag)
+        updateDataBag.changed.add(self.db.key)
 
     def processGuestNetwork(self, dbag):
         d = self.qFile.data
@@ -149,7 +215,7 @@ class updateDataBag:
         return cs_guestnetwork.merge(dbag, d)
 
     def process_dhcp_entry(self, dbag):
-        return cs_dhcp.merge(dbag, self.qFile.data)
+        return cs_dhcp.merge(dbag, self.qFile.data, self.db.getIndex("host_name", cs_dhcp.build_index))
 
     def process_site2sitevpn(self, dbag):
         return cs_site2sitevpn.merge(dbag, self.qFile.data)
@@ -181,7 +247,7 @@ class updateDataBag:
 
     def processIP(self, dbag):
         for ip in self.qFile.data["ip_address"]:
-            dbag = cs_ip.merge(dbag, ip)
+            dbag = cs_ip.merge(dbag, ip, self.db.getIndex("public_ip", cs_ip.build_index))
         return dbag
 
     def processCL(self, dbag):
@@ -254,6 +320,14 @@ class QueueFile:
     def setFile(self, name):
         self.fileName = name
 
+    def archive(self):
+        """ Dequeue the file without merging it """
+        fn = self.configCache + '/' + self.fileName
+        if self.keep:
+            self.__moveFile(fn, self.configCache + "/processed")
+        else:
+            os.remove(fn)
+
     def getType(self):
         return self.type
 
@@ -268,3 +342,58 @@ class QueueFile:
             os.makedirs(path)
         timestamp = str(int(round(time.time())))
         os.rename(origPath, path + "/" + self.fileName + "." + timestamp)
+
+
+class QueueBatch:
+    """ Merge all the pending queue files in arrival order
+    Each databag is loaded and saved once for the whole batch
+    """
+
+    configCache = "/var/cache/cloud"
+    # Always merged first, or the control interfaces will get deleted
+    first = "cmd_line.json"
+    # Files changed more recently may still be being copied, they are left
+    # for the update_config.py run the agent starts once the copy is done
+    settle = 2
+
+    def setPath(self, path):
+        self.configCache = path
+
+    def getFiles(self):
+        files = []
+        now = time.time()
+        for name in os.listdir(self.configCache):
+            fn = os.path.join(self.configCache, name)
+            if name.endswith(".json") and os.path.isfile(fn):
+                mtime = os.path.getmtime(fn)
+                if now - mtime < self.settle:
+                    logging.debug("Leaving queue file %s, it is still being written", name)
+                    continue
+                files.append((name != self.first, mtime, name))
+        return [x[2] for x in sorted(files)]
+
+    def load(self, skip=None):
+        """ Merge the queue files, skip(name) can exclude some of them,
+        they are dequeued without being merged
+        Returns the names of the merged files
+        """
+        merged = []
+        enabled = DataBag.cache is None
+        DataBag.enable_cache()
+        try:
+            for name in self.getFiles():
+                qf = QueueFile()
+                qf.setPath(self.configCache)
+                qf.setFile(name)
+                if skip is not None and skip(name):
+                    logging.info("Skipping queue file %s", name)
+                    qf.archive()
+                    continue
+                qf.load(None)
+                merged.append(name)
+        finally:
+            if enabled:
+                DataBag.disable_cache()
+            else:
+                DataBag.flush()
+        return merged
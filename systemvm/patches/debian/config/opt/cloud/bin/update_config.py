@@ -17,7 +17,7 @@
 # under the License.
 
 import sys
-from merge import QueueFile
+from merge import DataBag, QueueFile, QueueBatch, updateDataBag
 import logging
 import subprocess
 from subprocess import PIPE, STDOUT
@@ -25,10 +25,12 @@ import os
 import os.path
 import configure
 import json
+from fcntl import flock, LOCK_EX
 
 logging.basicConfig(filename='/var/log/cloud.log', level=logging.DEBUG, format='%(asctime)s  %(filename)s %(funcName)s:%(lineno)d %(message)s')
 
 # first commandline argument should be the file to process
+# or --batch to process all the pending files at once
 if (len(sys.argv) != 2):
     print "[ERROR]: Invalid usage"
     sys.exit(1)
@@ -37,11 +39,21 @@ if (len(sys.argv) != 2):
 jsonPath = "/var/cache/cloud/%s"
 jsonCmdConfigPath = jsonPath % sys.argv[1]
 currentGuestNetConfig = "/etc/cloudstack/guestnetwork.json"
+guestNetDevices = ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9']
+# Held while merging and converging so concurrent invocations do not race
+lockPath = jsonPath % "update_config.lock"
 
 
 def finish_config():
-    # Converge
-    returncode = configure.main([])
+    # Write the merged databags before converging
+    DataBag.flush()
+    # Converge only what depends on the databags merged by this run.
+    # The command line is merged at boot, when everything has to be
+    # converged, and nothing merged leaves nothing to go by
+    changed = updateDataBag.changed
+    if not changed or "cmdline" in changed:
+        changed = None
+    returncode = configure.main([], changed)
     sys.exit(returncode)
 
 
@@ -54,7 +66,28 @@ def process_file():
     finish_config()
 
 
-def is_guestnet_configured(guestnet_dict, keys):
+def process_batch():
+    print "[INFO] update_config.py :: Processing all pending JSON files"
+    qb = QueueBatch()
+    merged = qb.load(skip_guestnet)
+    if not merged:
+        print "[INFO] update_config.py :: No JSON files to process"
+        sys.exit(0)
+    print "[INFO] update_config.py :: Processed %s" % ", ".join(merged)
+    # Converge
+    finish_config()
+
+
+def skip_guestnet(name):
+    """ Do not process a guest network which is already configured """
+    if name != "guest_network.json" or not os.path.isfile(currentGuestNetConfig):
+        return False
+    file = open(currentGuestNetConfig)
+    guestnet_dict = json.load(file)
+    return is_guestnet_configured(guestnet_dict, guestNetDevices, jsonPath % name)
+
+
+def is_guestnet_configured(guestnet_dict, keys, config_path):
 
     existing_keys = []
     new_eth_key = None
@@ -70,7 +103,7 @@ def is_guestnet_configured(guestnet_dict, keys):
         print "[WARN] update_config.py :: Reconfiguring guest network..."
         return False
 
-    file = open(jsonCmdConfigPath)
+    file = open(config_path)
     new_guestnet_dict = json.load(file)
 
     if not new_guestnet_dict['add']:
@@ -109,10 +142,24 @@ def is_guestnet_configured(guestnet_dict, keys):
 
     return exists
 
-if not (os.path.isfile(jsonCmdConfigPath) and os.access(jsonCmdConfigPath, os.R_OK)):
+if sys.argv[1] != "--batch" and not (os.path.isfile(jsonCmdConfigPath) and os.access(jsonCmdConfigPath, os.R_OK)):
     print "[ERROR] update_config.py :: You are telling me to process %s, but i can't access it" % jsonCmdConfigPath
     sys.exit(1)
 
+lock = open(lockPath, "w")
+flock(lock, LOCK_EX)
+
+# Load each databag once for the merges and the converge
+DataBag.enable_cache()
+
+if sys.argv[1] == "--batch":
+    process_batch()
+
+# A batch run may have processed the file while we waited for the lock
+if not os.path.isfile(jsonCmdConfigPath):
+    print "[INFO] update_config.py :: %s was already processed" % sys.argv[1]
+    sys.exit(0)
+
 # If the command line json file is unprocessed process it
 # This is important or, the control interfaces will get deleted!
 if os.path.isfile(jsonPath % "cmd_line.json"):
@@ -126,7 +173,7 @@ if sys.argv[1] == "guest_network.json":
         file = open(currentGuestNetConfig)
         guestnet_dict = json.load(file)
 
-        if not is_guestnet_configured(guestnet_dict, ['eth1', 'eth2', 'eth3', 'eth4', 'eth5', 'eth6', 'eth7', 'eth8', 'eth9']):
+        if not is_guestnet_configured(guestnet_dict, guestNetDevices, jsonCmdConfigPath):
             print "[INFO] update_config.py :: Processing Guest Network."
             process_file()
         else:
@@ -0,0 +1,109 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Microbenchmark for the CsNetfilters rule matching
+
+Compares the former list scans with the indexed lookups on a synthetic
+iptables-save dump. Run with the same PYTHONPATH as runtests.sh:
+
+    python BenchCsNetfilter.py [number of rules]
+"""
+
+import sys
+import time
+import mock
+from cs.CsNetfilter import CsNetfilter, CsNetfilters
+
+
+def list_equal(a, b):
+    """ The former CsNetfilter.__eq__ """
+    if a.get_table() != b.get_table():
+        return False
+    if a.get_chain() != b.get_chain():
+        return False
+    if len(a.get_rule().items()) != len(b.get_rule().items()):
+        return False
+    common = set(a.get_rule().items()) & set(b.get_rule().items())
+    return len(common) == len(a.get_rule())
+
+
+class ListNetfilters(CsNetfilters):
+    """ CsNetfilters with the former O(n) lookups and deletes """
+
+    def save(self, rule):
+        self.rules.append(rule)
+
+    def get(self):
+        return self.rules
+
+    def has_rule(self, new_rule):
+        for r in self.rules:
+            if list_equal(new_rule, r):
+                if new_rule.get_count() > 0:
+                    continue
+                r.mark_seen()
+                return True
+        return False
+
+    def delete(self, rule):
+        self.rules[:] = [x for x in self.rules if not list_equal(x, rule)]
+
+
+def dump(count):
+    chains = 20
+    lines = ["*filter"]
+    lines.extend([":ACL_INBOUND_eth%s - [0:0]" % c for c in range(chains)])
+    for i in range(count):
+        lines.append("-A ACL_INBOUND_eth%s -s 10.%s.%s.0/24 -p tcp -m tcp --dport %s -j ACCEPT" %
+                     (i % chains, (i / 256) % 256, i % 256, 1024 + i % 1000))
+    lines.append("COMMIT")
+    return lines
+
+
+def desired(lines):
+    return [["filter", "", l] for l in lines if l.startswith("-A")]
+
+
+def run(cls, lines, wanted, standard):
+    with mock.patch('cs.CsNetfilter.CsHelper.execute', return_value=lines):
+        start = time.time()
+        nf = cls()
+        for fw in wanted:
+            rule = CsNetfilter()
+            rule.parse(fw[2])
+            rule.set_table(fw[0])
+            nf.has_rule(rule)
+        for line in standard:
+            nf.del_rule("filter", line)
+        unseen = len([x for x in nf.get() if x.unseen()])
+        return time.time() - start, unseen
+
+
+def main(argv):
+    count = 10000
+    if len(argv) > 1:
+        count = int(argv[1])
+    lines = dump(count)
+    # Keep 90% of the rules and delete 50 standard ones
+    wanted = desired(lines)[:count * 9 / 10]
+    standard = [l for l in lines if l.startswith("-A")][-50:]
+    for name, cls in (("list scan", ListNetfilters), ("indexed", CsNetfilters)):
+        elapsed, unseen = run(cls, lines, wanted, standard)
+        print "%-10s %6d rules: %8.3fs (%d unseen)" % (name, count, elapsed, unseen)
+
+if __name__ == "__main__":
+    main(sys.argv)
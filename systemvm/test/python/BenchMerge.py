@@ -0,0 +1,73 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Benchmark for the dhcpentry databag merges
+
+Replays add and remove events against cs_dhcp.merge, once rebuilding the
+host name index for every event (the cost of the former full scan) and
+once with the index kept with the databag. Run with the same PYTHONPATH
+as runtests.sh:
+
+    python BenchMerge.py [number of events]
+"""
+
+import sys
+import time
+import cs_dhcp
+
+
+def events(count):
+    """ Add hosts, then remove every fifth one and re-add it on a new ip """
+    hosts = count * 4 / 5
+    for i in range(hosts):
+        yield host(i, i, True)
+    for i in range(0, hosts, 5):
+        yield host(i, i, False)
+    for i in range(0, count - hosts - hosts / 5):
+        yield host(i * 5, hosts + i, True)
+
+
+def host(num, ip, add):
+    return {"host_name": "vm-%05d" % num,
+            "mac_address": "02:00:%02x:%02x:%02x:01" % (num / 65536, (num / 256) % 256, num % 256),
+            "ipv4_adress": "10.%s.%s.%s" % (ip / 65536, (ip / 256) % 256, ip % 256),
+            "default_gateway": "10.0.0.1",
+            "add": add}
+
+
+def run(count, keep_index):
+    dbag = {"id": "dhcpentry"}
+    index = cs_dhcp.build_index(dbag)
+    start = time.time()
+    for data in events(count):
+        if keep_index:
+            cs_dhcp.merge(dbag, data, index)
+        else:
+            cs_dhcp.merge(dbag, data)
+    return time.time() - start, len(dbag) - 1
+
+
+def main(argv):
+    count = 5000
+    if len(argv) > 1:
+        count = int(argv[1])
+    for name, keep_index in (("rescan", False), ("indexed", True)):
+        elapsed, hosts = run(count, keep_index)
+        print "%-8s %6d events: %8.3fs (%d hosts)" % (name, count, elapsed, hosts)
+
+if __name__ == "__main__":
+    main(sys.argv)
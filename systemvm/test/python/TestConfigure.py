@@ -0,0 +1,45 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import configure
+import merge
+
+
+class TestConfigure(unittest.TestCase):
+
+    def setUp(self):
+        merge.DataBag.DPATH = "."
+
+    def test_get_stages_full(self):
+        self.assertEqual(len(configure.get_stages()), len(configure.STAGES))
+
+    def test_get_stages_nothing_changed(self):
+        self.assertEqual(len(configure.get_stages(set())), len(configure.STAGES))
+
+    def test_get_stages_vmdata(self):
+        self.assertEqual(configure.get_stages(["vmdata"]), ["vmdata"])
+
+    def test_get_stages_firewall(self):
+        stages = configure.get_stages(["networkacl"])
+        self.assertTrue("iptables" in stages)
+        self.assertTrue("forwardingrules" in stages)
+        self.assertFalse("dhcp" in stages)
+        self.assertFalse("vmdata" in stages)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,7 +17,11 @@
 
 import unittest
 import mock
+import os
+import tempfile
+from netaddr import IPNetwork
 from cs.CsDhcp import CsDhcp
+from cs.CsFile import CsFile
 from cs import CsHelper
 import merge
 
@@ -33,5 +37,28 @@ class TestCsDhcp(unittest.TestCase):
         csdhcp = CsDhcp("dhcpentry", {})
         self.assertTrue(csdhcp is not None)
 
+    @mock.patch('cs.CsDhcp.CsHelper')
+    def test_delete_leases(self, mock_helper):
+        handle, leases = tempfile.mkstemp()
+        os.write(handle, "1441000000 02:00:00:00:00:01 10.1.1.11 vm1 *\n"
+                         "1441000000 02:00:00:00:00:02 10.1.1.12 vm2 *\n"
+                         "1441000000 02:00:00:00:00:03 10.1.1.13 vm3 *\n")
+        os.close(handle)
+        csdhcp = CsDhcp("dhcpentry", {})
+        csdhcp.devinfo = [{"dev": "eth0", "network": IPNetwork("10.1.1.1/24")}]
+        csdhcp.cloud = CsFile("/nonexistent")
+        csdhcp.cloud.config = ["02:00:00:00:00:01,10.1.1.11,vm1,infinite\n",
+                               "02:00:00:00:00:02,10.1.1.12,vm2,infinite\n",
+                               "02:00:00:00:00:03,10.1.1.13,vm3,infinite\n"]
+        csdhcp.cloud.new_config = ["02:00:00:00:00:01,10.1.1.11,vm1,infinite\n",
+                                   "02:00:00:00:00:04,10.1.1.12,vm4,infinite\n"]
+        try:
+            with mock.patch('cs.CsDhcp.LEASES', leases):
+                csdhcp.delete_leases()
+        finally:
+            os.remove(leases)
+        mock_helper.execute.assert_called_once_with("dhcp_release eth0 10.1.1.12 02:00:00:00:00:02 ; "
+                                                    "dhcp_release eth0 10.1.1.13 02:00:00:00:00:03")
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,6 +15,7 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import os
 import unittest
 import mock
 from cs import CsHelper
@@ -31,5 +32,26 @@ class TestCsHelper(unittest.TestCase):
         result = CsHelper.execute("/bin/false")
         self.assertTrue(result is not None)
 
+    @mock.patch('cs.CsHelper.subprocess')
+    @mock.patch('cs.CsHelper.CsNetlink.get_addresses')
+    def test_get_addresses(self, mock_addresses, mock_subprocess):
+        mock_addresses.return_value = [{'ip': '10.1.1.1/24', 'dev': 'eth0', 'link': 'eth0'},
+                                       {'ip': '10.1.1.2/24', 'dev': 'eth0:1', 'link': 'eth0'}]
+        CsHelper.invalidate_network()
+        self.assertEqual(CsHelper.get_ip("eth0"), "10.1.1.1/24")
+        self.assertEqual(CsHelper.get_device("10.1.1.2"), "eth0:1")
+        self.assertEqual(len(CsHelper.get_device_info()), 2)
+        self.assertEqual(mock_addresses.call_count, 1)
+        CsHelper.execute("ip route show")
+        CsHelper.get_ip("eth0")
+        self.assertEqual(mock_addresses.call_count, 1)
+        CsHelper.execute("ip addr add dev eth1 10.1.2.1/24 brd +")
+        CsHelper.get_ip("eth0")
+        self.assertEqual(mock_addresses.call_count, 2)
+        CsHelper.invalidate_network()
+
+    def test_get_process_uid(self):
+        self.assertEqual(CsHelper.get_process_uid(os.getpid()), os.getuid())
+
 if __name__ == '__main__':
     unittest.main()
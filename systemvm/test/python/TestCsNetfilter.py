@@ -16,7 +16,8 @@
 # under the License.
 
 import unittest
-from cs.CsNetfilter import CsNetfilter
+import mock
+from cs.CsNetfilter import CsNetfilter, CsNetfilters
 import merge
 
 
@@ -29,5 +30,46 @@ class TestCsNetfilter(unittest.TestCase):
         csnetfilter = CsNetfilter()
         self.assertTrue(csnetfilter is not None)
 
+    @mock.patch('cs.CsNetfilter.CsHelper')
+    def test_compare_atomic(self, mock_helper):
+        mock_helper.execute.return_value = ["*filter",
+                                            ":INPUT ACCEPT [0:0]",
+                                            "-A INPUT -i eth0 -j ACCEPT",
+                                            "-A INPUT -i eth1 -j DROP",
+                                            "COMMIT"]
+        mock_helper.execute_input.return_value = True
+        csnetfilters = CsNetfilters(atomic=True)
+        csnetfilters.compare([["filter", "", "-A INPUT -i eth0 -j ACCEPT"],
+                              ["filter", "front", "-A NEW_CHAIN -i eth2 -j ACCEPT"],
+                              ["filter", 2, "-A INPUT -i eth3 -j ACCEPT"]])
+        mock_helper.execute_input.assert_called_once_with("iptables-restore --noflush",
+                                                          "*filter\n"
+                                                          ":NEW_CHAIN - [0:0]\n"
+                                                          "-I NEW_CHAIN -i eth2 -j ACCEPT\n"
+                                                          "-I INPUT 2 -i eth3 -j ACCEPT\n"
+                                                          "-D INPUT -i eth1 -j DROP\n"
+                                                          "COMMIT\n")
+        diff = csnetfilters.get_diff()["filter"]
+        self.assertEqual(len(diff["add"]), 2)
+        self.assertEqual(diff["delete"], ["-D INPUT -i eth1 -j DROP"])
+
+    @mock.patch('cs.CsNetfilter.CsHelper')
+    def test_has_rule_and_delete(self, mock_helper):
+        mock_helper.execute.return_value = ["*filter",
+                                            ":INPUT ACCEPT [0:0]",
+                                            "-A INPUT -i eth0 -p tcp -m tcp --dport 22 -j ACCEPT",
+                                            "-A INPUT -i eth1 -j DROP",
+                                            "COMMIT"]
+        csnetfilters = CsNetfilters()
+        rule = CsNetfilter()
+        rule.parse("-A INPUT -p tcp -i eth0 --dport 22 -m tcp -j ACCEPT")
+        rule.set_table("filter")
+        self.assertTrue(csnetfilters.has_rule(rule))
+        rule.set_count(1)
+        self.assertFalse(csnetfilters.has_rule(rule))
+        csnetfilters.del_rule("filter", "-A INPUT -i eth1 -j DROP")
+        self.assertEqual(len(csnetfilters.get()), 1)
+        self.assertEqual([x for x in csnetfilters.get() if x.unseen()], [])
+
 if __name__ == '__main__':
     unittest.main()
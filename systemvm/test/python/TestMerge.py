@@ -0,0 +1,128 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import mock
+import json
+import os
+import shutil
+import tempfile
+import merge
+import cs_dhcp
+import cs_ip
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        merge.DataBag.DPATH = os.path.join(self.tmpdir, "databags")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def queue(self, name, data, mtime):
+        fn = os.path.join(self.tmpdir, name)
+        handle = open(fn, "w")
+        json.dump(data, handle)
+        handle.close()
+        os.utime(fn, (mtime, mtime))
+
+    def test_queue_batch(self):
+        self.queue("vm_password.json", {"type": "vmpassword", "ip_address": "10.1.1.2", "password": "old"}, 100)
+        self.queue("vm_password2.json", {"type": "vmpassword", "ip_address": "10.1.1.2", "password": "new"}, 200)
+        qb = merge.QueueBatch()
+        qb.setPath(self.tmpdir)
+        with mock.patch.object(merge.DataBag, "write", autospec=True, side_effect=merge.DataBag.write) as write:
+            self.assertEqual(qb.load(), ["vm_password.json", "vm_password2.json"])
+            self.assertEqual(write.call_count, 1)
+        self.assertTrue(merge.DataBag.cache is None)
+        self.assertTrue("vmpassword" in merge.updateDataBag.changed)
+        self.assertEqual(qb.getFiles(), [])
+        db = merge.DataBag()
+        db.setKey("vmpassword")
+        db.load()
+        self.assertEqual(db.getDataBag()["10.1.1.2"], "new")
+
+    def test_queue_batch_skip(self):
+        self.queue("guest_network.json", {"type": "guestnetwork"}, 100)
+        self.queue("vm_password.json", {"type": "vmpassword", "ip_address": "10.1.1.2", "password": "new"}, 200)
+        qb = merge.QueueBatch()
+        qb.setPath(self.tmpdir)
+        self.assertEqual(qb.load(lambda name: name == "guest_network.json"), ["vm_password.json"])
+        self.assertEqual(qb.getFiles(), [])
+
+    def test_queue_batch_settle(self):
+        self.queue("vm_password.json", {"type": "vmpassword", "ip_address": "10.1.1.2", "password": "new"}, 100)
+        fn = os.path.join(self.tmpdir, "vm_password2.json")
+        open(fn, "w").close()
+        qb = merge.QueueBatch()
+        qb.setPath(self.tmpdir)
+        self.assertEqual(qb.getFiles(), ["vm_password.json"])
+
+    def test_databag_cache(self):
+        merge.DataBag.enable_cache()
+        try:
+            db = merge.DataBag.get("koffie")
+            self.assertTrue(merge.DataBag.get("koffie") is db)
+            dbag = db.getDataBag()
+            dbag["cups"] = 2
+            db.save(dbag)
+            self.assertTrue(db.dirty)
+            self.assertFalse(os.path.exists(db.fpath))
+            merge.DataBag.flush()
+            self.assertFalse(db.dirty)
+        finally:
+            merge.DataBag.disable_cache()
+        db = merge.DataBag.get("koffie")
+        self.assertEqual(db.getDataBag()["cups"], 2)
+        self.assertFalse(os.path.exists(db.fpath + ".tmp"))
+
+    def test_databag_cache_shared(self):
+        merge.DataBag.enable_cache()
+        try:
+            db = merge.DataBag.get("cmdline")
+            db.save(db.getDataBag())
+            self.assertFalse(db.dirty)
+            self.assertTrue(os.path.exists(db.fpath))
+        finally:
+            merge.DataBag.disable_cache()
+
+    def test_dhcp_index(self):
+        dbag = {"id": "dhcpentry"}
+        index = cs_dhcp.build_index(dbag)
+        cs_dhcp.merge(dbag, {"host_name": "vm1", "ipv4_adress": "10.1.1.2"}, index)
+        cs_dhcp.merge(dbag, {"host_name": "vm1", "ipv4_adress": "10.1.1.3"}, index)
+        self.assertFalse("10.1.1.2" in dbag)
+        cs_dhcp.merge(dbag, {"host_name": "vm2", "ipv4_adress": "10.1.1.3"}, index)
+        self.assertEqual(index, cs_dhcp.build_index(dbag))
+        cs_dhcp.merge(dbag, {"host_name": "vm2", "ipv4_adress": "10.1.1.3", "add": False}, index)
+        self.assertEqual(dbag, {"id": "dhcpentry"})
+
+    def test_ip_index(self):
+        dbag = {"id": "ips"}
+        index = cs_ip.build_index(dbag)
+        ip = {"public_ip": "10.0.2.102", "netmask": "255.255.255.0", "nic_dev_id": 1}
+        cs_ip.merge(dbag, dict(ip), index)
+        ip["nic_dev_id"] = 2
+        cs_ip.merge(dbag, dict(ip), index)
+        self.assertEqual(dbag["eth1"], [])
+        self.assertEqual(len(dbag["eth2"]), 1)
+        self.assertEqual(index, cs_ip.build_index(dbag))
+
+if __name__ == '__main__':
+    unittest.main()
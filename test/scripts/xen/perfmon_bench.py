@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Benchmark of the rrd_updates parsing in perfmon.py
+
+Parses a recorded rrd_updates document, or a generated one for 500 VMs,
+with the former minidom code and with RRDDocument, then averages the cpu
+of every VM the way get_vm_group_perfmon does.
+
+    PYTHONPATH=../../../scripts/vm/hypervisor/xenserver python perfmon_bench.py [rrd_updates.xml]
+
+Record a document on a host with:
+
+    wget -O rrd_updates.xml "http://localhost/rrd_updates?start=<now - 3600>&cf=AVERAGE&interval=60&session_id=..."
+"""
+
+import sys
+import time
+from StringIO import StringIO
+from xml.dom import minidom
+
+try:
+    import XenAPI
+except ImportError:
+    # only the parser is benchmarked, allow running it off a XenServer host
+    import types
+    sys.modules['XenAPI'] = types.ModuleType('XenAPI')
+import perfmon
+
+VMS = 500
+ROWS = 60
+PARAMS = ['cpu0', 'cpu1', 'cpu2', 'cpu3', 'memory', 'memory_target', 'memory_internal_free',
+          'vif_0_rx', 'vif_0_tx', 'vbd_xvda_read', 'vbd_xvda_write']
+
+
+def generate():
+    end = 1400000000
+    legend = []
+    for vm in range(VMS):
+        uuid = "%08d-0000-0000-0000-000000000000" % vm
+        legend += ["<entry>AVERAGE:vm:%s:%s</entry>" % (uuid, param) for param in PARAMS]
+    rows = []
+    for row in range(ROWS):
+        values = "".join("<v>%.4f</v>" % ((row * 7 + col) % 100 / 100.0) for col in range(len(legend)))
+        rows.append("<row><t>%d</t>%s</row>" % (end - row * 60, values))
+    return ("<xport><meta><start>%d</start><step>60</step><end>%d</end><rows>%d</rows><columns>%d</columns>"
+            "<legend>%s</legend></meta><data>%s</data></xport>" %
+            (end - ROWS * 60, end, ROWS, len(legend), "".join(legend), "".join(rows)))
+
+
+def minidom_cpu(source):
+    """ The former parsing and lookups """
+    xmldoc = minidom.parseString(source)
+    meta_node = xmldoc.firstChild.childNodes[0]
+    data_node = xmldoc.firstChild.childNodes[1]
+    rows = int(meta_node.getElementsByTagName('rows')[0].firstChild.toxml())
+    legend = meta_node.getElementsByTagName('legend')[0]
+    reports = {}
+    for col in range(len(legend.childNodes)):
+        (cf, vm_or_host, uuid, param) = legend.childNodes[col].firstChild.toxml().split(':')
+        if vm_or_host == 'vm':
+            reports.setdefault(uuid, {})[param] = col
+    averages = {}
+    for uuid, report in reports.items():
+        cpus = [report[param] for param in report if "cpu" in param]
+        total = 0
+        for row in range(rows):
+            for col in cpus:
+                node = data_node.childNodes[rows - 1 - row].childNodes[col + 1]
+                total += float(node.firstChild.toxml())
+        averages[uuid] = total / (rows * len(cpus))
+    return averages
+
+
+def rrddocument_cpu(source):
+    doc = perfmon.RRDDocument().parse(StringIO(source))
+    reports = {}
+    for col in range(len(doc.legend)):
+        (cf, vm_or_host, uuid, param) = doc.legend[col].split(':')
+        if vm_or_host == 'vm':
+            reports.setdefault(uuid, {})[param] = doc.values[col]
+    averages = {}
+    for uuid, report in reports.items():
+        cpus = [report[param] for param in report if "cpu" in param]
+        total = 0
+        for row in range(doc.rows):
+            for values in cpus:
+                total += values[row]
+        averages[uuid] = total / (doc.rows * len(cpus))
+    return averages
+
+
+def main(argv):
+    if len(argv) > 1:
+        source = open(argv[1]).read()
+    else:
+        source = generate()
+    print "document: %d bytes" % len(source)
+    results = []
+    for name, parse in (("minidom", minidom_cpu), ("RRDDocument", rrddocument_cpu)):
+        start = time.time()
+        results.append(parse(source))
+        print "%-12s %d vms: %.3fs" % (name, len(results[-1]), time.time() - start)
+    if results[0] != results[1]:
+        print "results differ!"
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
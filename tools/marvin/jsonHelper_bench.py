@@ -0,0 +1,120 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+""" Benchmark of the response decoding in jsonHelper
+
+Decodes a recorded response, or a generated listVirtualMachines response
+of 5000 VMs, the former way (json.loads and a setattr per attribute) and
+with jsonHelper.loads, then compares the results.
+
+    python tools/marvin/jsonHelper_bench.py [response.json ...]
+
+Record a response with e.g.:
+
+    curl -o vms.json "http://localhost:8096/client/api?command=listVirtualMachines&listall=true&response=json"
+"""
+
+import json
+import sys
+import time
+from marvin import jsonHelper
+
+VMS = 5000
+
+
+def generate():
+    vms = []
+    for vm in range(VMS):
+        uuid = "%08d-0000-0000-0000-000000000000" % vm
+        vms.append({
+            "id": uuid, "name": "i-2-%d-VM" % vm, "displayname": "vm-%d" % vm,
+            "account": "admin", "domainid": uuid, "domain": "ROOT",
+            "created": "2015-01-15T18:30:11+0530", "state": "Running",
+            "haenable": False, "zoneid": uuid, "zonename": "Sandbox-simulator",
+            "hostid": uuid, "hostname": "SimulatedAgent.%s" % uuid,
+            "templateid": uuid, "templatename": "CentOS 5.3(64-bit) no GUI",
+            "passwordenabled": False, "serviceofferingid": uuid,
+            "serviceofferingname": "Small Instance", "cpunumber": 1,
+            "cpuspeed": 500, "memory": 512, "guestosid": uuid,
+            "rootdeviceid": 0, "rootdevicetype": "ROOT",
+            "securitygroup": [], "affinitygroup": [],
+            "nic": [{"id": uuid, "networkid": uuid,
+                     "netmask": "255.255.255.0", "gateway": "10.1.1.1",
+                     "ipaddress": "10.1.%d.%d" % (vm / 250, vm % 250 + 2),
+                     "isolationuri": "vlan://211",
+                     "broadcasturi": "vlan://211", "traffictype": "Guest",
+                     "type": "Isolated", "isdefault": True,
+                     "macaddress": "02:00:04:74:%02x:%02x" % (vm / 256,
+                                                             vm % 256)}],
+            "tags": [{"key": "owner", "value": "marvin",
+                      "resourcetype": "UserVm", "resourceid": uuid}],
+            "hypervisor": "Simulator"})
+    return json.dumps({"listvirtualmachinesresponse":
+                       {"count": VMS, "virtualmachine": vms}})
+
+
+class setattrLoader(object):
+    """ The former jsonLoader """
+
+    def __init__(self, obj):
+        for k in obj:
+            v = obj[k]
+            if isinstance(v, dict):
+                setattr(self, k, setattrLoader(v))
+            elif isinstance(v, (list, tuple)):
+                if len(v) > 0 and isinstance(v[0], dict):
+                    setattr(self, k, [setattrLoader(elem) for elem in v])
+                else:
+                    setattr(self, k, v)
+            else:
+                setattr(self, k, v)
+
+
+def former(source):
+    response = json.loads(source)
+    response = response[filter(lambda a: a != u'cloudstack-version',
+                               response.keys())[0]]
+    result = setattrLoader(response)
+    if getattr(result, "count", None) is not None:
+        for key in result.__dict__.iterkeys():
+            if key != "count":
+                return getattr(result, key)
+    return result
+
+
+def current(source):
+    return jsonHelper.getResultObj(jsonHelper.loads(source))
+
+
+def main(argv):
+    sources = [open(name).read() for name in argv[1:]] or [generate()]
+    print "json backend: %s" % jsonHelper.json.__name__
+    for source in sources:
+        print "response: %d bytes" % len(source)
+        results = []
+        for name, decode in (("former", former), ("loads", current)):
+            start = time.time()
+            results.append(decode(source))
+            print "%-8s %.3fs" % (name, time.time() - start)
+        if jsonHelper.jsonDump.dump(results[0]) != \
+                jsonHelper.jsonDump.dump(results[1]):
+            print "results differ!"
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
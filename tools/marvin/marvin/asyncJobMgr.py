@@ -42,90 +42,148 @@ class jobStatus(object):
         self.duration = None
         self.jobId = None
         self.responsecls = None
+        self.cmd = None
+        self.future = None
 
     def __str__(self):
         return '{%s}' % str(', '.join('%s : %s' % (k, repr(v)) for (k, v)
                                       in self.__dict__.iteritems()))
 
 
+class latencyHistogram(object):
+
+    '''
+    @Desc : Latencies of the jobs of one command, counted in buckets
+            doubling from 10ms up, the last bucket counts everything slower
+    '''
+    buckets = [0.01 * 2 ** i for i in range(14)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, latency):
+        i = 0
+        while i < len(self.buckets) and latency > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, pct):
+        '''
+        @Desc : Returns the upper bound of the bucket holding the
+                pct percentile, the max for the last bucket
+        '''
+        if self.count == 0:
+            return None
+        rank = self.count * pct / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                break
+        return self.max
+
+    def __str__(self):
+        if self.count == 0:
+            return "count: 0"
+        return "count: %d min: %.3fs mean: %.3fs p50: %.3fs p90: %.3fs " \
+               "p99: %.3fs max: %.3fs" % (self.count, self.min, self.mean(),
+                                          self.percentile(50),
+                                          self.percentile(90),
+                                          self.percentile(99), self.max)
+
+
 class workThread(threading.Thread):
 
-    def __init__(self, in_queue, outqueue, apiClient, db=None, lock=None):
+    '''
+    @Desc : Executes the jobs of the queue on a connection of its own,
+            the workers only share the output and the statistics.
+            Async jobs are submitted without waiting, their futures
+            are resolved by asyncJobMgr.waitForComplete
+    '''
+
+    def __init__(self, in_queue, outqueue, apiClient, db=None, lock=None,
+                 semaphore=None, record=None):
         threading.Thread.__init__(self)
         self.inqueue = in_queue
         self.output = outqueue
         self.connection = apiClient.connection.__copy__()
         self.db = None
         self.lock = lock
-
-    def queryAsynJob(self, job):
-        if job.jobId is None:
-            return job
-
-        try:
-            self.lock.acquire()
-            result = self.connection.poll(job.jobId, job.responsecls).jobresult
-        except cloudstackException.CloudstackAPIException as e:
-            result = str(e)
-        finally:
-            self.lock.release()
-
-        job.result = result
-        return job
+        self.semaphore = semaphore
+        self.record = record
 
     def executeCmd(self, job):
         cmd = job.cmd
 
         jobstatus = jobStatus()
-        jobId = None
+        jobstatus.cmd = cmd
+        responsecls = None
+        try:
+            responseName = cmd.__class__.__name__.replace("Cmd", "Response")
+            responsecls = jsonHelper.getclassFromName(cmd, responseName)
+        except:
+            pass
+
+        if self.semaphore is not None:
+            self.semaphore.acquire()
         try:
-            self.lock.acquire()
-
-            if cmd.isAsync == "false":
-                jobstatus.startTime = datetime.datetime.now()
-
-                result = self.connection.marvin_request(cmd)
-                jobstatus.result = result
-                jobstatus.endTime = datetime.datetime.now()
-                jobstatus.duration =\
-                    time.mktime(jobstatus.endTime.timetuple()) - time.mktime(
-                        jobstatus.startTime.timetuple())
-            else:
-                result = self.connection.marvinRequest(cmd)
-                if result is None:
-                    jobstatus.status = False
+            jobstatus.startTime = datetime.datetime.now()
+            start = time.time()
+            try:
+                if cmd.isAsync == "false":
+                    jobstatus.result = self.connection.marvinRequest(
+                        cmd, response_type=responsecls)
+                    jobstatus.status = jobstatus.result is not None
                 else:
-                    jobId = result.jobid
-                    jobstatus.jobId = jobId
-                    try:
-                        responseName =\
-                            cmd.__class__.__name__.replace("Cmd", "Response")
-                        jobstatus.responsecls =\
-                            jsonHelper.getclassFromName(cmd, responseName)
-                    except:
-                        pass
+                    jobstatus.future = self.connection.marvinRequest(
+                        cmd, response_type=responsecls, wait=False)
+                    jobstatus.jobId = jobstatus.future.jobid
                     jobstatus.status = True
-        except cloudstackException.CloudstackAPIException as e:
-            jobstatus.result = str(e)
-            jobstatus.status = False
-        except:
-            jobstatus.status = False
-            jobstatus.result = sys.exc_info()
+            except cloudstackException.CloudstackAPIException as e:
+                jobstatus.result = str(e)
+                jobstatus.status = False
+            except:
+                jobstatus.status = False
+                jobstatus.result = sys.exc_info()
+            jobstatus.duration = time.time() - start
+            jobstatus.endTime = datetime.datetime.now()
         finally:
-            self.lock.release()
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+        if self.record is not None and jobstatus.future is None:
+            self.record(cmd, jobstatus.duration)
 
         return jobstatus
 
     def run(self):
-        while self.inqueue.qsize() > 0:
-            job = self.inqueue.get()
-            if isinstance(job, jobStatus):
-                jobstatus = self.queryAsynJob(job)
-            else:
-                jobstatus = self.executeCmd(job)
-
-            self.output.put(jobstatus)
-            self.inqueue.task_done()
+        while True:
+            try:
+                job = self.inqueue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                self.output.put(self.executeCmd(job))
+            finally:
+                self.inqueue.task_done()
+        self.connection.close()
 
 
 class jobThread(threading.Thread):
@@ -162,6 +220,8 @@ class asyncJobMgr(object):
         self.outqueue = Queue.Queue()
         self.apiClient = apiClient
         self.db = db
+        self.lock = threading.Lock()
+        self.latencies = {}
 
     def submitCmds(self, cmds):
         if not self.inqueue.empty():
@@ -178,55 +238,114 @@ class asyncJobMgr(object):
         return ids
 
     def updateTimeStamp(self, jobstatus):
-        jobId = jobstatus.jobId
-        if jobId is not None and self.db is not None:
-            result = self.db.execute(
-                "select job_status, created, last_updated from async_job where\
- id='%s'" % str(jobId))
-            if result is not None and len(result) > 0:
-                if result[0][0] == 1:
-                    jobstatus.status = True
-                else:
-                    jobstatus.status = False
-                    jobstatus.startTime = result[0][1]
-                    jobstatus.endTime = result[0][2]
-                    delta = jobstatus.endTime - jobstatus.startTime
-                    jobstatus.duration = delta.total_seconds()
+        self.updateTimeStamps([jobstatus])
+
+    def updateTimeStamps(self, jobstatuses):
+        '''
+            update the status and times of the async jobs from the
+            async_job table, with one query for all the jobs
+        '''
+        if self.db is None:
+            return
+        jobs = dict((str(jobstatus.jobId), jobstatus)
+                    for jobstatus in jobstatuses
+                    if jobstatus.jobId is not None)
+        if len(jobs) == 0:
+            return
+        result = self.db.execute(
+            "select uuid, job_status, created, last_updated from async_job "
+            "where uuid in (%s)" % ", ".join(["%s"] * len(jobs)),
+            jobs.keys())
+        for uuid, status, created, updated in result or []:
+            jobstatus = jobs.get(str(uuid))
+            if jobstatus is None:
+                continue
+            jobstatus.status = status == 1
+            jobstatus.startTime = created
+            jobstatus.endTime = updated
+            delta = jobstatus.endTime - jobstatus.startTime
+            jobstatus.duration = delta.total_seconds()
+
+    def waitForJob(self, jobstatus):
+        '''
+            wait for the async job of jobstatus and fill in its result
+        '''
+        future = jobstatus.future
+        try:
+            jobstatus.result = future.result()
+        except cloudstackException.CloudstackAPIException as e:
+            jobstatus.result = str(e)
+            jobstatus.status = False
+        except:
+            jobstatus.status = False
+            jobstatus.result = sys.exc_info()
+        # the time taken by the request submitting the job plus the job
+        jobstatus.duration += future.endTime - future.startTime
+        jobstatus.endTime = datetime.datetime.now()
+        self.addLatency(jobstatus.cmd, jobstatus.duration)
+
+    def addLatency(self, cmd, latency):
+        name = cmd.__class__.__name__.replace("Cmd", "")
+        self.lock.acquire()
+        try:
+            if name not in self.latencies:
+                self.latencies[name] = latencyHistogram()
+            self.latencies[name].add(latency)
+        finally:
+            self.lock.release()
 
     def waitForComplete(self, workers=10):
+        '''
+            wait for the submitted commands to be executed and return
+            their status, the workers argument is unused as every worker
+            completes the jobs it executes
+        '''
         self.inqueue.join()
-        lock = threading.Lock()
-        resultQueue = Queue.Queue()
-        '''intermediate result is stored in self.outqueue'''
-        for i in range(workers):
-            worker = workThread(self.outqueue, resultQueue, self.apiClient,
-                                self.db, lock)
-            worker.start()
-
-        self.outqueue.join()
 
         asyncJobResult = []
-        while resultQueue.qsize() > 0:
-            jobstatus = resultQueue.get()
-            self.updateTimeStamp(jobstatus)
+        while True:
+            try:
+                jobstatus = self.outqueue.get_nowait()
+            except Queue.Empty:
+                break
+            if jobstatus.future is not None:
+                self.waitForJob(jobstatus)
             asyncJobResult.append(jobstatus)
+            self.outqueue.task_done()
 
+        self.updateTimeStamps(asyncJobResult)
         return asyncJobResult
 
-    def submitCmdsAndWait(self, cmds, workers=10):
+    def submitCmdsAndWait(self, cmds, workers=10, concurrency=None):
         '''
             put commands into a queue at first, then start workers numbers
-            threads to execute this commands
+            threads to execute this commands, each worker on a connection
+            of its own. concurrency caps the number of requests in flight
+            across the workers, by default every worker sends one
         '''
         self.submitCmds(cmds)
-        lock = threading.Lock()
-        for i in range(workers):
+        semaphore = None
+        if concurrency is not None:
+            semaphore = threading.BoundedSemaphore(concurrency)
+        for i in range(max(1, min(workers, len(cmds)))):
             worker = workThread(self.inqueue, self.outqueue, self.apiClient,
-                                self.db, lock)
+                                self.db, self.lock, semaphore,
+                                self.addLatency)
             worker.start()
 
         return self.waitForComplete(workers)
 
+    def getLatencies(self):
+        '''
+            return the latency histogram of every command executed by
+            submitCmdsAndWait, by command name
+        '''
+        self.lock.acquire()
+        try:
+            return dict(self.latencies)
+        finally:
+            self.lock.release()
+
     def submitJobExecuteNtimes(self, job, ntimes=1, nums_threads=1,
                                interval=1):
         '''
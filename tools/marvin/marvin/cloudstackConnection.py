@@ -16,17 +16,24 @@
 # under the License.
 
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
 import urllib
 import base64
 import hmac
 import hashlib
 import time
-from cloudstackAPI import queryAsyncJobResult
+import threading
+from cloudstackAPI import queryAsyncJobResult, listAsyncJobs
 import jsonHelper
 from marvin.codes import (
     FAILED,
     JOB_FAILED,
     JOB_CANCELLED,
+    JOB_INPROGRESS,
     JOB_SUCCEEDED
 )
 from marvin.cloudstackException import (
@@ -44,7 +51,8 @@ class CSConnection(object):
     '''
 
     def __init__(self, mgmtDet, asyncTimeout=3600, logger=None,
-                 path='client/api'):
+                 path='client/api', poolSize=10, keepAlive=True,
+                 poller=None):
         self.apiKey = mgmtDet.apiKey
         self.securityKey = mgmtDet.securityKey
         self.mgtSvr = mgmtDet.mgtSvrIp
@@ -68,17 +76,78 @@ class CSConnection(object):
         self.httpsFlag = True if self.protocol == "https" else False
         self.baseUrl = "%s://%s:%d/%s"\
                        % (self.protocol, self.mgtSvr, self.port, self.path)
+        self.poolSize = int(getattr(mgmtDet, "poolSize", None) or poolSize)
+        if getattr(mgmtDet, "retries", None) is not None:
+            self.retries = int(mgmtDet.retries)
+        self.keepAlive = keepAlive
+        if getattr(mgmtDet, "keepAlive", None) is not None:
+            self.keepAlive = str(mgmtDet.keepAlive) == "True"
+        self.__session = self.__createSession()
+        '''
+        Async jobs are polled every pollInterval seconds at first, the
+        interval doubles up to maxPollInterval while the job runs
+        '''
+        self.pollInterval = 0.25
+        self.maxPollInterval = 5
+        self.poller = poller
+        if self.poller is None:
+            self.poller = AsyncJobPoller(self)
 
     def __copy__(self):
+        '''
+        @Desc : Returns a connection with a session of its own,
+                sessions are not shared between threads. The copies
+                share the poller of the jobs submitted with wait=False
+        '''
         return CSConnection(self.mgtDetails,
                             self.asyncTimeout,
                             self.logger,
-                            self.path)
+                            self.path,
+                            self.poolSize,
+                            self.keepAlive,
+                            self.poller)
+
+    def __createSession(self):
+        '''
+        @Name : __createSession
+        @Desc : Creates the HTTP session used for all the requests of
+                this connection. The adapter keeps up to poolSize
+                connections to the management server open and retries
+                the requests failing to connect. Requests are not
+                retried on read errors, the server may have run the
+                command already and most commands are sent as GET
+        @Output: requests.Session
+        '''
+        if Retry is not None:
+            max_retries = Retry(total=self.retries,
+                                connect=self.retries,
+                                read=0,
+                                backoff_factor=0.5)
+        else:
+            max_retries = self.retries
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.poolSize,
+                              max_retries=max_retries)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keepAlive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def close(self):
+        '''
+        @Name : close
+        @Desc : Closes the connections kept open by the session
+        '''
+        self.__session.close()
 
     def __poll(self, jobid, response_cmd):
         '''
         @Name : __poll
-        @Desc: polls for the completion of a given jobid
+        @Desc: polls for the completion of a given jobid, every
+               pollInterval seconds at first and backing off up to
+               maxPollInterval
         @Input 1. jobid: Monitor the Jobid for CS
                2. response_cmd:response command for request cmd
         @return: FAILED if jobid is cancelled,failed
@@ -87,12 +156,12 @@ class CSConnection(object):
         try:
             cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
             cmd.jobid = jobid
-            timeout = self.asyncTimeout
             start_time = time.time()
-            end_time = time.time()
+            deadline = start_time + self.asyncTimeout
+            interval = self.pollInterval
             async_response = FAILED
             self.logger.debug("=== Jobid: %s Started ===" % (str(jobid)))
-            while timeout > 0:
+            while True:
                 async_response = self.\
                     marvinRequest(cmd, response_type=response_cmd)
                 if async_response != FAILED:
@@ -103,13 +172,16 @@ class CSConnection(object):
                     elif job_status == JOB_FAILED:
                         raise Exception("Job failed: %s"\
                                          % async_response)
-                time.sleep(5)
-                timeout -= 5
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                time.sleep(min(interval, timeout))
+                interval = min(interval * 2, self.maxPollInterval)
                 self.logger.debug("=== JobId:%s is Still Processing, "
-                                  "Will TimeOut in:%s ====" % (str(jobid),
-                                                               str(timeout)))
+                                  "Will TimeOut in:%d ====" % (str(jobid),
+                                                               timeout))
             end_time = time.time()
-            tot_time = int(start_time - end_time)
+            tot_time = int(end_time - start_time)
             self.logger.debug(
                 "===Jobid:%s ; StartTime:%s ; EndTime:%s ; "
                 "TotalTime:%s===" %
@@ -161,10 +233,10 @@ class CSConnection(object):
                  else FAILED
         '''
         try:
-            response = requests.post(url,
-                                     params=payload,
-                                     cert=self.certPath,
-                                     verify=self.httpsFlag)
+            response = self.__session.post(url,
+                                           params=payload,
+                                           cert=self.certPath,
+                                           verify=self.httpsFlag)
             return response
         except Exception as e:
             self.__lastError = e
@@ -183,10 +255,10 @@ class CSConnection(object):
                  else FAILED
         '''
         try:
-            response = requests.get(url,
-                                    params=payload,
-                                    cert=self.certPath,
-                                    verify=self.httpsFlag)
+            response = self.__session.get(url,
+                                          params=payload,
+                                          cert=self.certPath,
+                                          verify=self.httpsFlag)
             return response
         except Exception as e:
             self.__lastError = e
@@ -291,7 +363,8 @@ class CSConnection(object):
                                                  GetDetailExceptionInfo(e)))
             return FAILED
 
-    def __parseAndGetResponse(self, cmd_response, response_cls, is_async):
+    def __parseAndGetResponse(self, cmd_response, response_cls, is_async,
+                              wait=True):
         '''
         @Name : __parseAndGetResponse
         @Desc : Verifies the  Response(from CS) and returns an
@@ -299,26 +372,28 @@ class CSConnection(object):
         @Input: cmd_response: Command Response from cs
                 response_cls : Mapping class for this Response
                 is_async: Whether the cmd is async or not.
-        @Output:Response output from CS
+                wait: poll the async job here, else hand it to the poller
+        @Output:Response output from CS, an AsyncJobFuture for async
+                cmds when wait is False
         '''
         try:
-            try:
-                ret = jsonHelper.getResultObj(
-                    cmd_response.json(),
-                    response_cls)
-            except TypeError:
-                ret = jsonHelper.getResultObj(cmd_response.json, response_cls)
+            ret = jsonHelper.getResultObj(
+                jsonHelper.loads(cmd_response.content),
+                response_cls)
 
             '''
             If the response is asynchronous, poll and return response
             else return response as it is
             '''
             if is_async == "false":
-                self.logger.debug("Response : %s" % str(ret))
+                self.logger.debug("Response : %s", ret)
                 return ret
+            elif not wait:
+                self.logger.debug("Polling Jobid: %s" % str(ret.jobid))
+                return self.poller.submit(ret.jobid, response_cls)
             else:
                 response = self.__poll(ret.jobid, response_cls)
-                self.logger.debug("Response : %s" % str(response))
+                self.logger.debug("Response : %s", response)
                 return response.jobresult if response != FAILED else FAILED
         except Exception as e:
             self.__lastError = e
@@ -326,13 +401,17 @@ class CSConnection(object):
                 exception("Exception:%s" % GetDetailExceptionInfo(e))
             return FAILED
 
-    def marvinRequest(self, cmd, response_type=None, method='GET', data=''):
+    def marvinRequest(self, cmd, response_type=None, method='GET', data='',
+                      wait=True):
         """
         @Name : marvinRequest
         @Desc: Handles Marvin Requests
         @Input  cmd: marvin's command from cloudstackAPI
                 response_type: response type of the command in cmd
                 method: HTTP GET/POST, defaults to GET
+                wait: for async cmds, False returns at once with an
+                      AsyncJobFuture, the jobs of all the futures are
+                      polled together
         @Output: Response received from CS
                  Exception in case of Error\Exception
         """
@@ -369,7 +448,8 @@ class CSConnection(object):
             '''
             ret = self.__parseAndGetResponse(cmd_response,
                                              response_type,
-                                             is_async)
+                                             is_async,
+                                             wait)
             if ret == FAILED:
                 raise self.__lastError
             return ret
@@ -377,3 +457,174 @@ class CSConnection(object):
             self.logger.exception("marvinRequest : CmdName: %s Exception: %s" %
                                   (str(cmd), GetDetailExceptionInfo(e)))
             raise e
+
+
+class AsyncJobFuture(object):
+
+    '''
+    @Desc: Result of an async job polled by an AsyncJobPoller
+    '''
+
+    def __init__(self, jobid):
+        self.jobid = jobid
+        self.startTime = time.time()
+        self.endTime = None
+        self.__event = threading.Event()
+        self.__result = None
+        self.__error = None
+
+    def done(self):
+        return self.__event.is_set()
+
+    def setResult(self, result=None, error=None):
+        self.__result = result
+        self.__error = error
+        self.endTime = time.time()
+        self.__event.set()
+
+    def result(self, timeout=None):
+        '''
+        @Name : result
+        @Desc : Waits for the job and returns its jobresult
+        @Input: timeout: seconds to wait, None waits for the job
+        @Output: the jobresult, raises the exception the job failed with
+        '''
+        self.__event.wait(timeout)
+        if not self.__event.is_set():
+            raise Exception("Timed out waiting for Jobid: %s" % self.jobid)
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+
+class AsyncJobPoller(object):
+
+    '''
+    @Desc: Polls the async jobs submitted to it from a thread of its own.
+           Each job is checked after pollInterval seconds at first, the
+           interval doubles up to maxPollInterval. The jobs due at a tick
+           are checked with a single listAsyncJobs, only the finished
+           ones are queried for their result
+    '''
+
+    def __init__(self, connection):
+        self.owner = connection
+        self.connection = None
+        self.jobs = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def submit(self, jobid, response_cls=None):
+        '''
+        @Name : submit
+        @Desc : Starts polling jobid
+        @Output: AsyncJobFuture of the job
+        '''
+        future = AsyncJobFuture(jobid)
+        now = time.time()
+        self.cond.acquire()
+        try:
+            self.jobs[jobid] = {"future": future,
+                                "response": response_cls,
+                                "interval": self.owner.pollInterval,
+                                "due": now + self.owner.pollInterval,
+                                "deadline": now + self.owner.asyncTimeout}
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.__run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return future
+
+    def __dueJobs(self):
+        '''
+        Waits for the next due job, returns the due jobs or None once
+        there are no jobs left
+        '''
+        self.cond.acquire()
+        try:
+            while True:
+                if not self.jobs:
+                    self.thread = None
+                    return None
+                now = time.time()
+                due = dict((jobid, job) for jobid, job in self.jobs.items()
+                           if job["due"] <= now)
+                if due:
+                    return due
+                self.cond.wait(min(job["due"] for job in
+                                   self.jobs.values()) - now)
+        finally:
+            self.cond.release()
+
+    def __finish(self, jobid, result=None, error=None):
+        self.cond.acquire()
+        try:
+            job = self.jobs.pop(jobid)
+        finally:
+            self.cond.release()
+        job["future"].setResult(result, error)
+
+    def __query(self, jobid, job):
+        cmd = queryAsyncJobResult.queryAsyncJobResultCmd()
+        cmd.jobid = jobid
+        response = self.connection.marvinRequest(
+            cmd, response_type=job["response"])
+        if response.jobstatus == JOB_FAILED:
+            self.__finish(jobid, error=Exception("Job failed: %s" % response))
+        elif response.jobstatus in [JOB_CANCELLED, JOB_SUCCEEDED]:
+            self.__finish(jobid, result=response.jobresult)
+        else:
+            return False
+        return True
+
+    def __check(self, due):
+        '''
+        Returns the jobids of the due jobs still running, a single due
+        job is queried right away
+        '''
+        running = set()
+        if len(due) > 1:
+            jobs = self.connection.marvinRequest(
+                listAsyncJobs.listAsyncJobsCmd())
+            listed = {}
+            for job in jobs or []:
+                listed[job.jobid] = job.jobstatus
+            running = set(jobid for jobid in due
+                          if listed.get(jobid) == JOB_INPROGRESS)
+        for jobid in set(due.keys()) - running:
+            if not self.__query(jobid, due[jobid]):
+                running.add(jobid)
+        return running
+
+    def __run(self):
+        if self.connection is None:
+            self.connection = self.owner.__copy__()
+        while True:
+            due = self.__dueJobs()
+            if due is None:
+                return
+            try:
+                running = self.__check(due)
+            except Exception as e:
+                self.owner.logger.exception("AsyncJobPoller: Exception "
+                                            "Occurred: %s" % str(e))
+                running = set(due.keys())
+            now = time.time()
+            self.cond.acquire()
+            try:
+                for jobid in running:
+                    if jobid not in self.jobs:
+                        continue
+                    job = self.jobs[jobid]
+                    if job["deadline"] <= now:
+                        self.__finish(jobid, error=Exception(
+                            "Timed out polling Jobid: %s" % jobid))
+                        continue
+                    job["interval"] = min(job["interval"] * 2,
+                                          self.owner.maxPollInterval)
+                    job["due"] = min(now + job["interval"], job["deadline"])
+            finally:
+                self.cond.release()
@@ -194,7 +194,9 @@ class CSTestClient(object):
             else self.__dbSvrDetails.passwd
         db = 'cloud' if self.__dbSvrDetails.db is None \
             else self.__dbSvrDetails.db
-        self.__dbConnection = DbConnection(host, port, user, passwd, db)
+        poolSize = getattr(self.__dbSvrDetails, "poolSize", None) or 5
+        self.__dbConnection = DbConnection(host, port, user, passwd, db,
+                                           poolSize)
 
     def __getKeys(self, userid):
         '''
@@ -417,16 +419,30 @@ class CSTestClient(object):
             return FAILED
         return self.__createUserApiClient(UserName, DomainName, type)
 
-    def submitCmdsAndWait(self, cmds, workers=1, apiclient=None):
+    def submitCmdsAndWait(self, cmds, workers=1, apiclient=None,
+                          concurrency=None):
         '''
-        @Desc : FixME, httplib has issue if more than one thread submitted
+        @Desc : Executes the commands with workers threads, each on a
+                connection of its own, at most concurrency at a time.
+                The latencies are kept by the job manager, see
+                getAsyncJobLatencies
         '''
         if not apiclient:
             apiclient = self.__apiClient
         if self.__asyncJobMgr is None:
             self.__asyncJobMgr = asyncJobMgr(apiclient,
                                              self.__dbConnection)
-        return self.__asyncJobMgr.submitCmdsAndWait(cmds, workers)
+        return self.__asyncJobMgr.submitCmdsAndWait(cmds, workers,
+                                                    concurrency)
+
+    def getAsyncJobLatencies(self):
+        '''
+        @Desc : Returns the latency histograms of the commands executed
+                by submitCmdsAndWait, by command name
+        '''
+        if self.__asyncJobMgr is None:
+            return {}
+        return self.__asyncJobMgr.getLatencies()
 
     def submitJob(self, job, ntimes=1, nums_threads=10, interval=1):
         '''
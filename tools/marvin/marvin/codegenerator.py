@@ -230,20 +230,35 @@ class CodeGenerator(object):
         body += self.space * 2 + 'self._id = identifier' + self.newline
         body += self.newline
 
+        # The command modules are imported by the first call of their
+        # command, importing the client does not load the whole API
+        #            def _request(self, name, command, method):
+        #                module = getattr(cloudstackAPI, name)
+        #                response = getattr(module, name + 'Response')()
+        #                return self.connection.marvinRequest(...)
+        body += self.space
+        body += 'def _request(self, name, command, method):\n'
+        body += self.space * 2
+        body += 'module = getattr(cloudstackAPI, name)\n'
+        body += self.space * 2
+        body += "response = getattr(module, name + 'Response')()\n"
+        body += self.space * 2
+        body += 'return self.connection.marvinRequest(command,'
+        body += ' response_type=response, method=method)\n'
+        body += self.newline
+
         for cmdName in self.cmdsName:
             body += self.space
             body += 'def %s(self, command, method="GET"):\n' % cmdName
             body += self.space + self.space
-            body += 'response = %sResponse()\n' % cmdName
-            body += self.space + self.space
-            body += 'response = self.connection.marvinRequest(command,'
-            body += ' response_type=response, method=method)\n'
-            body += self.space + self.space + 'return response\n'
+            body += 'return self._request("%s", command, method)\n' % cmdName
             body += self.newline
 
-            imports += 'from %s import %sResponse\n' % (cmdName, cmdName)
             initCmdsList += '"%s",' % cmdName
 
+        imports += "import sys\n"
+        imports += "cloudstackAPI = sys.modules[__name__.rsplit('.', 1)[0]]\n"
+
         fp = open(self.outputFolder + '/cloudstackAPI/cloudstackAPIClient.py',
                   'w')
         fp.write(self.license)
@@ -251,8 +266,38 @@ class CodeGenerator(object):
             fp.write(item)
         fp.close()
 
-        '''generate __init__.py'''
+        '''generate __init__.py, the command modules are stood in for
+        by lazyModule until used, so that importing the package or
+        "from cloudstackAPI import *" does not import all of them'''
         initCmdsList = self.license + initCmdsList + '"cloudstackAPIClient"]'
+        initCmdsList += self.newline + dedent('''
+            import sys
+
+
+            class lazyModule(object):
+                """Imports the command module name on first use"""
+
+                def __init__(self, name):
+                    self.__dict__["_lazyModule__name"] = name
+
+                def __load(self):
+                    name = __name__ + "." + self.__name
+                    __import__(name)
+                    module = sys.modules[name]
+                    self.__dict__.update(module.__dict__)
+                    return module
+
+                def __getattr__(self, attr):
+                    return getattr(self.__load(), attr)
+
+                def __repr__(self):
+                    return "<lazy module \'%s.%s\'>" % (__name__, self.__name)
+
+
+            for name in __all__:
+                globals()[name] = lazyModule(name)
+            del name
+            ''')
         fp = open(self.outputFolder + '/cloudstackAPI/__init__.py', 'w')
         fp.write(initCmdsList)
         fp.close()
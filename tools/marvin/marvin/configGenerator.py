@@ -34,6 +34,9 @@ class managementServer(object):
         self.useHttps = None
         self.certCAPath = None
         self.certPath = None
+        self.poolSize = 10
+        self.retries = 5
+        self.keepAlive = "True"
 
 
 class dbServer(object):
@@ -44,6 +47,7 @@ class dbServer(object):
         self.user = "cloud"
         self.passwd = "cloud"
         self.db = "cloud"
+        self.poolSize = 5
 
 
 class configuration(object):
@@ -17,8 +17,10 @@
 
 import mysql
 import contextlib
+import threading
 from mysql import connector
 from mysql.connector import errors
+from mysql.connector import pooling
 from contextlib import closing
 from marvin import cloudstackException
 import sys
@@ -27,34 +29,115 @@ import os
 
 class DbConnection(object):
 
+    '''
+    @Desc : Connections to the CloudStack DB, the statements on the
+            default database share a pool of poolSize connections, up
+            to 32, and wait for a free connection when all are in use.
+            One DbConnection can be used by many threads
+    '''
+
     def __init__(self, host="localhost", port=3306, user='cloud',
-                 passwd='cloud', db='cloud'):
+                 passwd='cloud', db='cloud', poolSize=5):
         self.host = host
         self.port = port
         self.user = str(user)  # Workaround: http://bugs.mysql.com/?id=67306
         self.passwd = passwd
         self.database = db
+        self.poolSize = min(int(poolSize), pooling.CNX_POOL_MAXSIZE)
+        self.__pool = None
+        self.__lock = threading.Lock()
+        self.__free = threading.BoundedSemaphore(self.poolSize)
+
+    def __config(self, db=None):
+        return {"host": str(self.host),
+                "port": int(self.port),
+                "user": str(self.user),
+                "password": str(self.passwd),
+                "db": str(self.database) if not db else db}
+
+    @contextlib.contextmanager
+    def __connection(self, db=None):
+        '''
+        @Desc : Yields a pooled connection, or a connection of its own
+                for another database than the default one
+        '''
+        if db and db != self.database:
+            with contextlib.closing(
+                    mysql.connector.connect(**self.__config(db))) as conn:
+                conn.autocommit = True
+                yield conn
+            return
+
+        self.__free.acquire()
+        try:
+            with self.__lock:
+                if self.__pool is None:
+                    self.__pool = pooling.MySQLConnectionPool(
+                        pool_size=self.poolSize, **self.__config())
+            conn = self.__pool.get_connection()
+            try:
+                conn.autocommit = True
+                yield conn
+            finally:
+                # returns the connection to the pool
+                conn.close()
+        finally:
+            self.__free.release()
 
-    def execute(self, sql=None, params=None, db=None):
+    @staticmethod
+    def __fetch(cursor):
+        try:
+            return cursor.fetchall()
+        except errors.InterfaceError:
+            # Raised on empty result - DML
+            return []
+
+    def execute(self, sql=None, params=None, db=None, prepared=False):
+        '''
+        @Desc : Executes sql with params, %s placeholders in sql are
+                filled in by the connector. prepared executes it as a
+                server side prepared statement
+        @Output: The rows returned by sql
+        '''
         if sql is None:
             return None
 
-        resultRow = []
-        with contextlib.\
-            closing(mysql.connector.connect(host=str(self.host),
-                                            port=int(self.port),
-                                            user=str(self.user),
-                                            password=str(self.passwd),
-                                            db=str(self.database) if not db else db)) as conn:
-            conn.autocommit = True
-            with contextlib.closing(conn.cursor(buffered=True)) as cursor:
+        with self.__connection(db) as conn:
+            if prepared:
+                cursor = conn.cursor(prepared=True)
+            else:
+                cursor = conn.cursor(buffered=True)
+            with contextlib.closing(cursor):
                 cursor.execute(sql, params)
-                try:
-                    resultRow = cursor.fetchall()
-                except errors.InterfaceError:
-                    # Raised on empty result - DML
-                    resultRow = []
-        return resultRow
+                return self.__fetch(cursor)
+
+    def executemany(self, sql, paramsList, db=None, prepared=False):
+        '''
+        @Desc : Executes sql once for each params of paramsList on one
+                connection. The connector sends the rows of an INSERT
+                as a single statement, prepared prepares sql once for
+                all the executions
+        @Output: The number of rows affected
+        '''
+        with self.__connection(db) as conn:
+            with contextlib.closing(conn.cursor(prepared=prepared)) as cursor:
+                cursor.executemany(sql, paramsList)
+                return cursor.rowcount
+
+    def executeMulti(self, sql, params=None, db=None):
+        '''
+        @Desc : Executes the ; separated statements of sql in one call
+        @Output: The rows returned by each statement, in order
+        '''
+        results = []
+        with self.__connection(db) as conn:
+            with contextlib.closing(conn.cursor(buffered=True)) as cursor:
+                for result in cursor.execute(sql, params, multi=True):
+                    if result.with_rows:
+                        results.append(result.fetchall())
+                    else:
+                        results.append([])
+        return results
 
     def executeSqlFromFile(self, fileName=None):
         if fileName is None:
@@ -66,7 +149,7 @@ class DbConnection(object):
                 InvalidParameterException("%s not exists" % fileName)
 
         sqls = open(fileName, "r").read()
-        return self.execute(sqls)
+        return self.executeMulti(sqls)
 
 if __name__ == "__main__":
     db = DbConnection()
@@ -34,12 +34,36 @@ from marvin.codes import (FAILED, SUCCESS)
 from marvin.lib.utils import (random_gen)
 from marvin.config.test_data import test_data
 from sys import exit
+import copy
 import os
 import pickle
+import threading
+import time
 from time import sleep, strftime, localtime
 from optparse import OptionParser
 
 
+class deployTask(object):
+
+    '''
+    @Desc : A step of the deployment, run once the tasks it depends on
+            are done. key names the step in the progress file
+    '''
+
+    def __init__(self, key, func, deps=()):
+        self.key = key
+        self.func = func
+        self.deps = list(deps)
+        self.children = []
+        self.result = None
+        for dep in self.deps:
+            dep.children.append(self)
+
+    def run(self):
+        self.result = self.func()
+        return self.result
+
+
 class DeployDataCenters(object):
 
     '''
@@ -47,20 +71,90 @@ class DeployDataCenters(object):
             Once the Deployment is successful, it will export
             the DataCenter settings to an obj file
             ( can be used if wanted to delete the created DC)
+            The zones, pods, clusters and hosts are created by up to
+            workers threads, each entity once its parent exists. The
+            progress is saved after each step to progress_file, a
+            deployment started again with the same progress_file
+            skips the steps already done
     '''
 
+    '''
+    Order in which the entities are created, the clean up deletes
+    them in reverse
+    '''
+    CLEANUP_ORDER = ["Zone", "PhysicalNetwork", "TrafficType",
+                     "NetworkServiceProvider", "NetscalerLoadBalancer",
+                     "SrxFirewall", "F5LoadBalancer", "NiciraNvp", "Network",
+                     "Pod", "VmwareDc", "Cluster", "Host", "StoragePool",
+                     "VlanIpRange", "SecondaryStagingStore", "ImageStore",
+                     "s3"]
+
     def __init__(self,
                  test_client,
                  cfg,
                  logger=None,
-                 log_folder_path=None
+                 log_folder_path=None,
+                 workers=10,
+                 progress_file=None
                  ):
         self.__testClient = test_client
         self.__config = cfg
         self.__tcRunLogger = logger
         self.__logFolderPath = log_folder_path
-        self.__apiClient = None
+        self.__local = threading.local()
+        self.__mainApiClient = None
         self.__cleanUp = {}
+        self.__workers = workers
+        self.__progressFile = progress_file
+        self.__progress = {}
+        self.__lock = threading.RLock()
+        self.__failedHosts = {}
+
+    @property
+    def __apiClient(self):
+        '''
+        The deploy tasks run on a copy of the API client of their
+        worker thread, each with a connection of its own
+        '''
+        return getattr(self.__local, "apiClient", self.__mainApiClient)
+
+    @__apiClient.setter
+    def __apiClient(self, api_client):
+        self.__mainApiClient = api_client
+
+    def __loadProgress(self):
+        '''
+        @Name : __loadProgress
+        @Desc : Loads the steps done and the entities created by an
+                earlier run using the same progress file
+        '''
+        if self.__progressFile is None:
+            if self.__logFolderPath:
+                self.__progressFile = self.__logFolderPath + \
+                    "/dc_progress.obj"
+            else:
+                ts = strftime("%b_%d_%Y_%H_%M_%S", localtime())
+                self.__progressFile = "dc_progress_" + str(ts) + ".obj"
+        if os.path.isfile(self.__progressFile):
+            file_to_read = open(self.__progressFile, 'r')
+            saved = pickle.load(file_to_read)
+            file_to_read.close()
+            self.__progress = saved["progress"]
+            self.__cleanUp = saved["cleanUp"]
+            print "\n=== Resuming the deployment saved in %s, %d steps " \
+                  "done===" % (self.__progressFile, len(self.__progress))
+            self.__tcRunLogger.debug(
+                "=== Resuming the deployment saved in %s ===" %
+                self.__progressFile)
+
+    def __persistProgress(self):
+        with self.__lock:
+            tmp_path = self.__progressFile + ".tmp"
+            file_to_write = open(tmp_path, 'w')
+            pickle.dump({"progress": self.__progress,
+                         "cleanUp": self.__cleanUp}, file_to_write)
+            file_to_write.close()
+            os.rename(tmp_path, self.__progressFile)
 
     def __persistDcConfig(self):
         try:
@@ -82,6 +176,12 @@ class DeployDataCenters(object):
                   GetDetailExceptionInfo(e)
 
     def __cleanAndExit(self):
+        if getattr(self.__local, "apiClient", None) is not None:
+            '''
+            In a deploy task, the deployment is cleaned up once the
+            running tasks are done
+            '''
+            raise Exception("Deploy task failed")
         try:
             print "\n===deploy dc failed, so cleaning the created entries==="
             if not test_data.get("deleteDC", None):
@@ -93,6 +193,11 @@ class DeployDataCenters(object):
                                               dc_cfg=self.__cleanUp,
                                               tc_run_logger=self.__tcRunLogger
                                               )
+            '''
+            The entities are removed, the deployment can not be resumed
+            '''
+            if self.__progressFile and os.path.isfile(self.__progressFile):
+                os.remove(self.__progressFile)
             if remove_dc_obj:
                 if remove_dc_obj.removeDataCenter() == FAILED:
                     print "\n===Removing DataCenter Failed==="
@@ -108,44 +213,126 @@ class DeployDataCenters(object):
                   GetDetailExceptionInfo(e)
 
     def __addToCleanUp(self, type, id):
-        if type not in self.__cleanUp.keys():
-            self.__cleanUp[type] = []
-        self.__cleanUp[type].append(id)
-        if "order" not in self.__cleanUp.keys():
-            self.__cleanUp["order"] = []
-        if type not in self.__cleanUp["order"]:
-            self.__cleanUp["order"].append(type)
+        with self.__lock:
+            if type not in self.__cleanUp.keys():
+                self.__cleanUp[type] = []
+            self.__cleanUp[type].append(id)
+            if "order" not in self.__cleanUp.keys():
+                self.__cleanUp["order"] = []
+            order = self.__cleanUp["order"]
+            if type not in order:
+                '''
+                The tasks run concurrently, keep the types in creation
+                order rather than in the order they are first seen
+                '''
+                position = len(order)
+                if type in self.CLEANUP_ORDER:
+                    rank = self.CLEANUP_ORDER.index
+                    position = len([t for t in order
+                                    if t not in self.CLEANUP_ORDER or
+                                    rank(t) < rank(type)])
+                order.insert(position, type)
+
+    def __runTasks(self, tasks):
+        '''
+        @Name : __runTasks
+        @Desc : Runs the tasks with up to self.__workers threads, each
+                task once the tasks it depends on are done. The tasks
+                done by an earlier run are skipped and give the result
+                saved in the progress file. Stops scheduling on the
+                first failure
+        @Output: None, or the task which failed and its exception
+        '''
+        cond = threading.Condition(self.__lock)
+        waiting = dict((task, len(task.deps)) for task in tasks)
+        ready = [task for task in tasks if not task.deps]
+        state = {"running": 0, "failed": None}
+
+        def worker():
+            self.__local.apiClient = copy.copy(self.__mainApiClient)
+            while True:
+                with cond:
+                    while not ready and state["running"] > 0 and \
+                            state["failed"] is None:
+                        cond.wait()
+                    if not ready or state["failed"] is not None:
+                        cond.notify_all()
+                        return
+                    task = ready.pop(0)
+                    state["running"] += 1
+                error = None
+                try:
+                    if task.key in self.__progress:
+                        task.result = self.__progress[task.key]
+                    else:
+                        task.run()
+                except BaseException as e:
+                    error = e
+                with cond:
+                    state["running"] -= 1
+                    if error is not None:
+                        if state["failed"] is None:
+                            state["failed"] = (task, error)
+                    else:
+                        if task.key not in self.__progress:
+                            self.__progress[task.key] = task.result
+                            self.__persistProgress()
+                        for child in task.children:
+                            waiting[child] -= 1
+                            if waiting[child] == 0:
+                                ready.append(child)
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(max(1, self.__workers))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.isAlive():
+                thread.join(1)
+        return state["failed"]
 
     def addHosts(self, hosts, zoneId, podId, clusterId, hypervisor):
         if hosts is None:
             print "\n === Invalid Hosts Information ===="
             return
-        failed_cnt = 0
         for host in hosts:
-            try:
-                hostcmd = addHost.addHostCmd()
-                hostcmd.clusterid = clusterId
-                hostcmd.hosttags = host.hosttags
-                hostcmd.hypervisor = host.hypervisor
-                hostcmd.password = host.password
-                hostcmd.podid = podId
-                hostcmd.url = host.url
-                hostcmd.username = host.username
-                hostcmd.zoneid = zoneId
-                hostcmd.hypervisor = hypervisor
-                ret = self.__apiClient.addHost(hostcmd)
-                if ret:
-                    self.__tcRunLogger.debug("=== Add Host Successful ===")
-                    self.__addToCleanUp("Host", ret[0].id)
-            except Exception as e:
-                failed_cnt = failed_cnt + 1
-                print "Exception Occurred :%s" % GetDetailExceptionInfo(e)
-                self.__tcRunLogger.exception(
-                    "=== Adding Host Failed :%s===" % str(
-                        host.url))
-                if failed_cnt == len(hosts):
-                    self.__cleanAndExit()
-                continue
+            self.addHost(host, len(hosts), zoneId, podId, clusterId,
+                         hypervisor)
+
+    def addHost(self, host, count, zoneId, podId, clusterId, hypervisor):
+        '''
+        @Name : addHost
+        @Desc : Adds host to the cluster, fails the deployment once
+                the count hosts of the cluster all failed
+        '''
+        try:
+            hostcmd = addHost.addHostCmd()
+            hostcmd.clusterid = clusterId
+            hostcmd.hosttags = host.hosttags
+            hostcmd.hypervisor = host.hypervisor
+            hostcmd.password = host.password
+            hostcmd.podid = podId
+            hostcmd.url = host.url
+            hostcmd.username = host.username
+            hostcmd.zoneid = zoneId
+            hostcmd.hypervisor = hypervisor
+            ret = self.__apiClient.addHost(hostcmd)
+            if ret:
+                self.__tcRunLogger.debug("=== Add Host Successful ===")
+                self.__addToCleanUp("Host", ret[0].id)
+                return ret[0].id
+        except Exception as e:
+            with self.__lock:
+                failed_cnt = self.__failedHosts.get(clusterId, 0) + 1
+                self.__failedHosts[clusterId] = failed_cnt
+            print "Exception Occurred :%s" % GetDetailExceptionInfo(e)
+            self.__tcRunLogger.exception(
+                "=== Adding Host Failed :%s===" % str(
+                    host.url))
+            if failed_cnt == count:
+                self.__cleanAndExit()
 
     def addVmWareDataCenter(self, vmwareDc):
         try:
@@ -165,38 +352,38 @@ class DeployDataCenters(object):
             self.__cleanAndExit()
 
     def createClusters(self, clusters, zoneId, podId, vmwareDc=None):
+        if clusters is None:
+            return
+        if vmwareDc is not None:
+            vmwareDc.zoneid = zoneId
+            self.addVmWareDataCenter(vmwareDc)
+
+        for cluster in clusters:
+            clusterId = self.createCluster(cluster, zoneId, podId)
+            if cluster.hypervisor.lower() != "vmware":
+                self.addHosts(cluster.hosts, zoneId, podId, clusterId,
+                              cluster.hypervisor)
+            self.setupCluster(cluster, zoneId, podId, clusterId)
+
+    def createCluster(self, cluster, zoneId, podId):
         try:
-            if clusters is None:
-                return
-            if vmwareDc is not None:
-                vmwareDc.zoneid = zoneId
-                self.addVmWareDataCenter(vmwareDc)
-
-            for cluster in clusters:
-                clustercmd = addCluster.addClusterCmd()
-                clustercmd.clustername = cluster.clustername
-                clustercmd.clustertype = cluster.clustertype
-                clustercmd.hypervisor = cluster.hypervisor
-                clustercmd.password = cluster.password
-                clustercmd.podid = podId
-                clustercmd.url = cluster.url
-                clustercmd.username = cluster.username
-                clustercmd.zoneid = zoneId
-                clusterresponse = self.__apiClient.addCluster(clustercmd)
-                if clusterresponse[0].id:
-                    clusterId = clusterresponse[0].id
-                    self.__tcRunLogger.\
-                        debug("Cluster Name : %s Id : %s Created Successfully"
-                              % (str(cluster.clustername), str(clusterId)))
-                    self.__addToCleanUp("Cluster", clusterId)
-                if cluster.hypervisor.lower() != "vmware":
-                    self.addHosts(cluster.hosts, zoneId, podId, clusterId,
-                                  cluster.hypervisor)
-                self.waitForHost(zoneId, clusterId)
-                self.createPrimaryStorages(cluster.primaryStorages,
-                                           zoneId,
-                                           podId,
-                                           clusterId)
+            clustercmd = addCluster.addClusterCmd()
+            clustercmd.clustername = cluster.clustername
+            clustercmd.clustertype = cluster.clustertype
+            clustercmd.hypervisor = cluster.hypervisor
+            clustercmd.password = cluster.password
+            clustercmd.podid = podId
+            clustercmd.url = cluster.url
+            clustercmd.username = cluster.username
+            clustercmd.zoneid = zoneId
+            clusterresponse = self.__apiClient.addCluster(clustercmd)
+            if clusterresponse[0].id:
+                clusterId = clusterresponse[0].id
+                self.__tcRunLogger.\
+                    debug("Cluster Name : %s Id : %s Created Successfully"
+                          % (str(cluster.clustername), str(clusterId)))
+                self.__addToCleanUp("Cluster", clusterId)
+                return clusterId
         except Exception as e:
             print "Exception Occurred %s" % GetDetailExceptionInfo(e)
             self.__tcRunLogger.exception("====Cluster %s Creation Failed"
@@ -204,22 +391,41 @@ class DeployDataCenters(object):
                                          str(cluster.clustername))
             self.__cleanAndExit()
 
-    def waitForHost(self, zoneId, clusterId):
+    def setupCluster(self, cluster, zoneId, podId, clusterId):
+        '''
+        @Name : setupCluster
+        @Desc : Creates the primary storages of the cluster once its
+                hosts are up
+        '''
+        self.waitForHost(zoneId, clusterId)
+        self.createPrimaryStorages(cluster.primaryStorages,
+                                   zoneId,
+                                   podId,
+                                   clusterId)
+
+    def waitForHost(self, zoneId, clusterId, timeout=60):
         """
         Wait for the hosts in the zoneid, clusterid to be up
-        2 retries with 30s delay
+        Lists the hosts after 1s, then backs off up to 10s between
+        the lists, for up to timeout seconds
         """
         try:
-            retry, timeout = 2, 30
             cmd = listHosts.listHostsCmd()
             cmd.clusterid, cmd.zoneid = clusterId, zoneId
-            hosts = self.__apiClient.listHosts(cmd)
-            while retry != 0:
-                for host in hosts:
-                    if host.state != 'Up':
-                        break
-                sleep(timeout)
-                retry = retry - 1
+            interval, deadline = 1, time.time() + timeout
+            while True:
+                hosts = self.__apiClient.listHosts(cmd)
+                if hosts and \
+                        len([h for h in hosts if h.state != 'Up']) == 0:
+                    return
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.__tcRunLogger.debug(
+                        "=== Hosts of cluster %s not Up after %ss ===" %
+                        (clusterId, timeout))
+                    return
+                sleep(min(interval, remaining))
+                interval = min(interval * 2, 10)
         except Exception as e:
             print "\nException Occurred:%s" %\
                   GetDetailExceptionInfo(e)
@@ -266,29 +472,39 @@ class DeployDataCenters(object):
                    pods,
                    zoneId,
                    networkId=None):
+        if pods is None:
+            return
+        for pod in pods:
+            podId = self.createPod(pod, zoneId, networkId)
+            self.createClusters(pod.clusters, zoneId, podId)
+
+    def createPod(self, pod, zoneId, networkId=None):
+        '''
+        @Name : createPod
+        @Desc : Creates pod, its guest ip ranges and VmWare DC
+        '''
         try:
-            if pods is None:
-                return
-            for pod in pods:
-                createpod = createPod.createPodCmd()
-                createpod.name = pod.name
-                createpod.gateway = pod.gateway
-                createpod.netmask = pod.netmask
-                createpod.startip = pod.startip
-                createpod.endip = pod.endip
-                createpod.zoneid = zoneId
-                createpodResponse = self.__apiClient.createPod(createpod)
-                if createpodResponse.id:
-                    podId = createpodResponse.id
-                    self.__tcRunLogger.debug("Pod Name : %s Id : %s "
-                                             "Created Successfully" %
-                                             (str(pod.name), str(podId)))
-                    self.__addToCleanUp("Pod", podId)
-                if pod.guestIpRanges is not None and networkId is not None:
-                    self.createVlanIpRanges("Basic", pod.guestIpRanges, zoneId,
-                                            podId, networkId)
-                self.createClusters(pod.clusters, zoneId, podId,
-                                    vmwareDc=pod.vmwaredc)
+            createpod = createPod.createPodCmd()
+            createpod.name = pod.name
+            createpod.gateway = pod.gateway
+            createpod.netmask = pod.netmask
+            createpod.startip = pod.startip
+            createpod.endip = pod.endip
+            createpod.zoneid = zoneId
+            createpodResponse = self.__apiClient.createPod(createpod)
+            if createpodResponse.id:
+                podId = createpodResponse.id
+                self.__tcRunLogger.debug("Pod Name : %s Id : %s "
+                                         "Created Successfully" %
+                                         (str(pod.name), str(podId)))
+                self.__addToCleanUp("Pod", podId)
+            if pod.guestIpRanges is not None and networkId is not None:
+                self.createVlanIpRanges("Basic", pod.guestIpRanges, zoneId,
+                                        podId, networkId)
+            if pod.clusters is not None and pod.vmwaredc is not None:
+                pod.vmwaredc.zoneid = zoneId
+                self.addVmWareDataCenter(pod.vmwaredc)
+            return podId
         except Exception as e:
             print "Exception Occurred: %s" % GetDetailExceptionInfo(e)
             self.__tcRunLogger.\
@@ -702,117 +918,202 @@ class DeployDataCenters(object):
             return FAILED
 
     def createZones(self, zones):
-        try:
-            for zone in zones:
-                zonecmd = createZone.createZoneCmd()
-                zonecmd.dns1 = zone.dns1
-                zonecmd.dns2 = zone.dns2
-                zonecmd.internaldns1 = zone.internaldns1
-                zonecmd.internaldns2 = zone.internaldns2
-                zonecmd.name = zone.name
-                zonecmd.securitygroupenabled = zone.securitygroupenabled
-                zonecmd.localstorageenabled = zone.localstorageenabled
-                zonecmd.networktype = zone.networktype
-                zonecmd.domain = zone.domain
-                if zone.securitygroupenabled != "true":
-                    zonecmd.guestcidraddress = zone.guestcidraddress
-                zoneId = self.createZone(zonecmd)
-                if zoneId == FAILED:
-                    self.__tcRunLogger.\
-                        exception(
-                            "====Zone: %s Creation Failed. So Exiting=====" %
-                            str(zone.name))
-                    self.__cleanAndExit()
-                for pnet in zone.physical_networks:
-                    phynetwrk = self.createPhysicalNetwork(pnet, zoneId)
-                    self.configureProviders(phynetwrk, pnet.providers)
-                    self.updatePhysicalNetwork(phynetwrk.id, "Enabled",
-                                               vlan=pnet.vlan)
-                if zone.networktype == "Basic":
-                    listnetworkoffering =\
-                        listNetworkOfferings.listNetworkOfferingsCmd()
-                    listnetworkoffering.name =\
-                        "DefaultSharedNetscalerEIPandELBNetworkOffering" \
-                        if len(filter(lambda x:
-                                      x.typ == 'Public',
-                                      zone.physical_networks[0].
-                                      traffictypes)) > 0 \
-                        else "DefaultSharedNetworkOfferingWithSGService"
-                    if zone.networkofferingname is not None:
-                        listnetworkoffering.name = zone.networkofferingname
-                    listnetworkofferingresponse = \
-                        self.__apiClient.listNetworkOfferings(
-                            listnetworkoffering)
-                    guestntwrk = configGenerator.network()
-                    guestntwrk.displaytext = "guestNetworkForBasicZone"
-                    guestntwrk.name = "guestNetworkForBasicZone"
-                    guestntwrk.zoneid = zoneId
-                    guestntwrk.networkofferingid = \
-                        listnetworkofferingresponse[0].id
-                    networkid = self.createNetworks([guestntwrk], zoneId)
-                    self.createPods(zone.pods, zoneId, networkid)
-                    if self.isEipElbZone(zone):
-                        self.createVlanIpRanges(
-                            zone.networktype, zone.ipranges,
-                            zoneId, forvirtualnetwork=True)
-                isPureAdvancedZone = (zone.networktype == "Advanced"
-                                      and zone.securitygroupenabled != "true")
-                if isPureAdvancedZone:
-                    self.createPods(zone.pods, zoneId)
-                    self.createVlanIpRanges(zone.networktype, zone.ipranges,
-                                            zoneId)
-                elif (zone.networktype == "Advanced"
-                      and zone.securitygroupenabled == "true"):
-                    listnetworkoffering =\
-                        listNetworkOfferings.listNetworkOfferingsCmd()
-                    listnetworkoffering.name =\
-                        "DefaultSharedNetworkOfferingWithSGService"
-                    if zone.networkofferingname is not None:
-                        listnetworkoffering.name = zone.networkofferingname
-                    listnetworkofferingresponse = \
-                        self.__apiClient.listNetworkOfferings(
-                            listnetworkoffering)
-                    networkcmd = createNetwork.createNetworkCmd()
-                    networkcmd.displaytext = "Shared SG enabled network"
-                    networkcmd.name = "Shared SG enabled network"
-                    networkcmd.networkofferingid =\
-                        listnetworkofferingresponse[0].id
-                    networkcmd.zoneid = zoneId
-                    ipranges = zone.ipranges
-                    if ipranges:
-                        iprange = ipranges.pop()
-                        networkcmd.startip = iprange.startip
-                        networkcmd.endip = iprange.endip
-                        networkcmd.gateway = iprange.gateway
-                        networkcmd.netmask = iprange.netmask
-                        networkcmd.vlan = iprange.vlan
-                    networkcmdresponse = self.__apiClient.createNetwork(
-                        networkcmd)
-                    if networkcmdresponse.id:
-                        self.__addToCleanUp("Network", networkcmdresponse.id)
-                        self.__tcRunLogger.\
-                            debug("create Network Successful. NetworkId : %s "
-                                  % str(networkcmdresponse.id))
-                    self.createPods(zone.pods, zoneId, networkcmdresponse.id)
-                '''Note: Swift needs cache storage first'''
-                self.createCacheStorages(zone.cacheStorages, zoneId)
-                self.createSecondaryStorages(zone.secondaryStorages, zoneId)
-                #add zone wide primary storages if any
-                if zone.primaryStorages:
-                    self.createPrimaryStorages(zone.primaryStorages,
-                                               zoneId,
-                                               )
-                enabled = getattr(zone, 'enabled', 'True')
-                if enabled == 'True' or enabled is None:
-                    self.enableZone(zoneId, "Enabled")
-                details = getattr(zone, 'details')
-                if details is not None:
-                    det = [d.__dict__ for d in details]
-                    self.updateZoneDetails(zoneId, det)
-            return
-        except Exception as e:
-            print "\nException Occurred %s" % GetDetailExceptionInfo(e)
-            self.__tcRunLogger.exception("==== Create Zones Failed ===")
+        '''
+        @Name : createZones
+        @Desc : Creates the zones, their pods, clusters and hosts
+                concurrently, see createZoneTasks
+        '''
+        tasks = []
+        for zone in zones:
+            tasks.extend(self.createZoneTasks(zone))
+        failed = self.__runTasks(tasks)
+        if failed is not None:
+            task, error = failed
+            print "\nException Occurred %s" % GetDetailExceptionInfo(error)
+            self.__tcRunLogger.exception("==== Deploy Step %s Failed ===" %
+                                         task.key)
+            self.__cleanAndExit()
+
+    def createZoneTasks(self, zone):
+        '''
+        @Name : createZoneTasks
+        @Desc : Returns the tasks deploying zone. The zone and its
+                networks come first, then each pod, each cluster of a
+                pod and each host of a cluster. The primary storages of
+                a cluster are added once its hosts are up, the zone
+                wide resources once all its pods are ready
+        '''
+        key = "zone:%s" % zone.name
+        zoneTask = deployTask(key, lambda: self.deployZone(zone))
+        tasks = [zoneTask]
+        podsReady = []
+        for pod in zone.pods or []:
+            podKey = "%s/pod:%s" % (key, pod.name)
+            podTask = deployTask(
+                podKey,
+                lambda pod=pod, zoneTask=zoneTask:
+                self.createPod(pod, zoneTask.result[0], zoneTask.result[1]),
+                [zoneTask])
+            tasks.append(podTask)
+            podsReady.append(podTask)
+            for cluster in pod.clusters or []:
+                clusterKey = "%s/cluster:%s" % (podKey, cluster.clustername)
+                clusterTask = deployTask(
+                    clusterKey,
+                    lambda cluster=cluster, zoneTask=zoneTask,
+                    podTask=podTask:
+                    self.createCluster(cluster, zoneTask.result[0],
+                                       podTask.result),
+                    [podTask])
+                tasks.append(clusterTask)
+                hostTasks = []
+                if cluster.hypervisor.lower() != "vmware":
+                    for host in cluster.hosts or []:
+                        hostTasks.append(deployTask(
+                            "%s/host:%s" % (clusterKey, host.url),
+                            lambda host=host, cluster=cluster,
+                            zoneTask=zoneTask, podTask=podTask,
+                            clusterTask=clusterTask:
+                            self.addHost(host, len(cluster.hosts),
+                                         zoneTask.result[0], podTask.result,
+                                         clusterTask.result,
+                                         cluster.hypervisor),
+                            [clusterTask]))
+                tasks.extend(hostTasks)
+                readyTask = deployTask(
+                    "%s/ready" % clusterKey,
+                    lambda cluster=cluster, zoneTask=zoneTask,
+                    podTask=podTask, clusterTask=clusterTask:
+                    self.setupCluster(cluster, zoneTask.result[0],
+                                      podTask.result, clusterTask.result),
+                    [clusterTask] + hostTasks)
+                tasks.append(readyTask)
+                podsReady.append(readyTask)
+        tasks.append(deployTask(
+            "%s/ready" % key,
+            lambda: self.setupZone(zone, zoneTask.result[0]),
+            [zoneTask] + podsReady))
+        return tasks
+
+    def deployZone(self, zone):
+        '''
+        @Name : deployZone
+        @Desc : Creates the zone with its physical networks and guest
+                network, if any
+        @Output: The id of the zone and of its guest network
+        '''
+        zonecmd = createZone.createZoneCmd()
+        zonecmd.dns1 = zone.dns1
+        zonecmd.dns2 = zone.dns2
+        zonecmd.internaldns1 = zone.internaldns1
+        zonecmd.internaldns2 = zone.internaldns2
+        zonecmd.name = zone.name
+        zonecmd.securitygroupenabled = zone.securitygroupenabled
+        zonecmd.localstorageenabled = zone.localstorageenabled
+        zonecmd.networktype = zone.networktype
+        zonecmd.domain = zone.domain
+        if zone.securitygroupenabled != "true":
+            zonecmd.guestcidraddress = zone.guestcidraddress
+        zoneId = self.createZone(zonecmd)
+        if zoneId == FAILED:
+            self.__tcRunLogger.\
+                exception(
+                    "====Zone: %s Creation Failed. So Exiting=====" %
+                    str(zone.name))
+            self.__cleanAndExit()
+        for pnet in zone.physical_networks:
+            phynetwrk = self.createPhysicalNetwork(pnet, zoneId)
+            self.configureProviders(phynetwrk, pnet.providers)
+            self.updatePhysicalNetwork(phynetwrk.id, "Enabled",
+                                       vlan=pnet.vlan)
+        networkid = None
+        if zone.networktype == "Basic":
+            listnetworkoffering =\
+                listNetworkOfferings.listNetworkOfferingsCmd()
+            listnetworkoffering.name =\
+                "DefaultSharedNetscalerEIPandELBNetworkOffering" \
+                if len(filter(lambda x:
+                              x.typ == 'Public',
+                              zone.physical_networks[0].
+                              traffictypes)) > 0 \
+                else "DefaultSharedNetworkOfferingWithSGService"
+            if zone.networkofferingname is not None:
+                listnetworkoffering.name = zone.networkofferingname
+            listnetworkofferingresponse = \
+                self.__apiClient.listNetworkOfferings(
+                    listnetworkoffering)
+            guestntwrk = configGenerator.network()
+            guestntwrk.displaytext = "guestNetworkForBasicZone"
+            guestntwrk.name = "guestNetworkForBasicZone"
+            guestntwrk.zoneid = zoneId
+            guestntwrk.networkofferingid = \
+                listnetworkofferingresponse[0].id
+            networkid = self.createNetworks([guestntwrk], zoneId)
+        elif (zone.networktype == "Advanced"
+              and zone.securitygroupenabled == "true"):
+            listnetworkoffering =\
+                listNetworkOfferings.listNetworkOfferingsCmd()
+            listnetworkoffering.name =\
+                "DefaultSharedNetworkOfferingWithSGService"
+            if zone.networkofferingname is not None:
+                listnetworkoffering.name = zone.networkofferingname
+            listnetworkofferingresponse = \
+                self.__apiClient.listNetworkOfferings(
+                    listnetworkoffering)
+            networkcmd = createNetwork.createNetworkCmd()
+            networkcmd.displaytext = "Shared SG enabled network"
+            networkcmd.name = "Shared SG enabled network"
+            networkcmd.networkofferingid =\
+                listnetworkofferingresponse[0].id
+            networkcmd.zoneid = zoneId
+            ipranges = zone.ipranges
+            if ipranges:
+                iprange = ipranges.pop()
+                networkcmd.startip = iprange.startip
+                networkcmd.endip = iprange.endip
+                networkcmd.gateway = iprange.gateway
+                networkcmd.netmask = iprange.netmask
+                networkcmd.vlan = iprange.vlan
+            networkcmdresponse = self.__apiClient.createNetwork(
+                networkcmd)
+            if networkcmdresponse.id:
+                self.__addToCleanUp("Network", networkcmdresponse.id)
+                self.__tcRunLogger.\
+                    debug("create Network Successful. NetworkId : %s "
+                          % str(networkcmdresponse.id))
+            networkid = networkcmdresponse.id
+        return zoneId, networkid
+
+    def setupZone(self, zone, zoneId):
+        '''
+        @Name : setupZone
+        @Desc : Adds the zone wide ip ranges and storages once the
+                pods are ready, then enables the zone
+        '''
+        if zone.networktype == "Basic" and self.isEipElbZone(zone):
+            self.createVlanIpRanges(
+                zone.networktype, zone.ipranges,
+                zoneId, forvirtualnetwork=True)
+        isPureAdvancedZone = (zone.networktype == "Advanced"
+                              and zone.securitygroupenabled != "true")
+        if isPureAdvancedZone:
+            self.createVlanIpRanges(zone.networktype, zone.ipranges,
+                                    zoneId)
+        '''Note: Swift needs cache storage first'''
+        self.createCacheStorages(zone.cacheStorages, zoneId)
+        self.createSecondaryStorages(zone.secondaryStorages, zoneId)
+        #add zone wide primary storages if any
+        if zone.primaryStorages:
+            self.createPrimaryStorages(zone.primaryStorages,
+                                       zoneId,
+                                       )
+        enabled = getattr(zone, 'enabled', 'True')
+        if enabled == 'True' or enabled is None:
+            self.enableZone(zoneId, "Enabled")
+        details = getattr(zone, 'details')
+        if details is not None:
+            det = [d.__dict__ for d in details]
+            self.updateZoneDetails(zoneId, det)
 
     def isEipElbZone(self, zone):
         if (zone.networktype == "Basic"
@@ -880,6 +1181,7 @@ class DeployDataCenters(object):
             '''
             Step3 :Deploy the Zone
             '''
+            self.__loadProgress()
             self.createZones(self.__config.zones)
             self.configureS3(self.__config.s3)
             '''
@@ -1070,6 +1372,10 @@ if __name__ == "__main__":
             the input configuration file and data center settings file
               EX: python deployDataCenter.py -i <inp-cfg-file>
               -r <dc_exported_entries>
+            3. Resuming an interrupted deployment, from the progress
+            file saved in the log folder
+              EX: python deployDataCenter.py -i <inp-cfg-file>
+              -s <dc_progress.obj>
     '''
     parser = OptionParser()
     parser.add_option("-i", "--input", action="store",
@@ -1081,6 +1387,15 @@ if __name__ == "__main__":
                       default=None, dest="remove",
                       help="path to file\
                       where the created dc entries are kept")
+
+    parser.add_option("-w", "--workers", action="store", type="int",
+                      default=10, dest="workers",
+                      help="number of entities to deploy concurrently")
+
+    parser.add_option("-s", "--resume", action="store",
+                      default=None, dest="resume",
+                      help="progress file of an interrupted deployment\
+                      to resume, or where to save the progress")
     (options, args) = parser.parse_args()
 
     '''
@@ -1140,7 +1455,9 @@ if __name__ == "__main__":
         deploy = DeployDataCenters(obj_tc_client,
                                    cfg,
                                    tc_run_logger,
-                                   log_folder_path=log_folder_path)
+                                   log_folder_path=log_folder_path,
+                                   workers=options.workers,
+                                   progress_file=options.resume)
         if deploy.deploy() == FAILED:
             print "\n===Deploy Failed==="
             tc_run_logger.debug("\n===Deploy Failed===");
@@ -15,7 +15,11 @@
 # specific language governing permissions and limitations
 # under the License.
 import cloudstackException
-import json
+try:
+    # simplejson with its C speedups decodes faster than json on python 2
+    import simplejson as json
+except ImportError:
+    import json
 import inspect
 from marvin.cloudstackAPI import *
 
@@ -25,23 +29,17 @@ class jsonLoader(object):
     '''The recursive class for building and representing objects with.'''
 
     def __init__(self, obj):
-        for k in obj:
-            v = obj[k]
+        self.__dict__.update(obj)
+        for k, v in obj.iteritems():
             if isinstance(v, dict):
-                setattr(self, k, jsonLoader(v))
+                self.__dict__[k] = jsonLoader(v)
             elif isinstance(v, (list, tuple)):
                 if len(v) > 0 and isinstance(v[0], dict):
-                    setattr(self, k, [jsonLoader(elem) for elem in v])
-                else:
-                    setattr(self, k, v)
-            else:
-                setattr(self, k, v)
+                    self.__dict__[k] = [jsonLoader(elem) for elem in v]
 
     def __getattr__(self, val):
-        if val in self.__dict__:
-            return self.__dict__[val]
-        else:
-            return None
+        # only called for the attributes which are not set
+        return None
 
     def __repr__(self):
         return '{%s}' % str(', '.join('%s : %s' % (k, repr(v)) for (k, v)
@@ -83,6 +81,21 @@ class jsonDump(object):
         return jsonDump.__serialize(obj)
 
 
+def _objectHook(obj):
+    result = jsonLoader.__new__(jsonLoader)
+    result.__dict__ = obj
+    return result
+
+
+def loads(text):
+    '''
+    @Name : loads
+    @Desc : Decodes a JSON response into jsonLoader objects, built by
+            the decoder as it goes rather than from the decoded dicts
+    '''
+    return json.loads(text, object_hook=_objectHook)
+
+
 def getclassFromName(cmd, name):
     module = inspect.getmodule(cmd)
     return getattr(module, name)()
@@ -133,16 +146,25 @@ def finalizeResultObj(result, responseName, responsecls):
 
 
 def getResultObj(returnObj, responsecls=None):
+    if isinstance(returnObj, jsonLoader):
+        # decoded by loads()
+        returnObj = returnObj.__dict__
     if len(returnObj) == 0:
         return None
     responseName = filter(lambda a: a != u'cloudstack-version',
                           returnObj.keys())[0]
 
     response = returnObj[responseName]
+    if isinstance(response, jsonLoader):
+        result = response
+        response = response.__dict__
+    else:
+        result = None
     if len(response) == 0:
         return None
 
-    result = jsonLoader(response)
+    if result is None:
+        result = jsonLoader(response)
     if result.errorcode is not None:
         errMsg = "errorCode: %s, errorText:%s" % (result.errorcode,
                                                   result.errortext)
@@ -25,11 +25,64 @@ from marvin.codes import (FAILED, FAIL, PASS, RUNNING, STOPPED,
                           STARTING, DESTROYED, EXPUNGING,
                           STOPPING, BACKED_UP, BACKING_UP)
 from marvin.cloudstackException import GetDetailExceptionInfo, CloudstackAPIException
-from marvin.lib.utils import validateList, is_server_ssh_ready, random_gen
+from marvin.lib.utils import (validateList, is_server_ssh_ready, random_gen,
+                              wait_until)
 # Import System modules
 import time
 import hashlib
 import base64
+import copy
+import threading
+
+
+def listIter(cls, apiclient, pagesize=500, prefetch=False, **kwargs):
+    """Lists the resources of cls one page at a time
+
+    Calls cls.list(apiclient, page=..., pagesize=pagesize, **kwargs) and
+    yields the items of each page as it arrives, until a page comes back
+    short. With prefetch the next page is fetched, on a copy of
+    apiclient, while the items of the current page are consumed.
+
+    e.g.
+    for vm in listIter(VirtualMachine, apiclient, listall=True):
+        ...
+    """
+    client = copy.copy(apiclient) if prefetch else apiclient
+
+    def fetch(page, result):
+        try:
+            result["items"] = cls.list(client, page=page, pagesize=pagesize,
+                                       **kwargs) or []
+        except Exception as e:
+            result["error"] = e
+
+    def fetchAsync(page):
+        result = {}
+        thread = threading.Thread(target=fetch, args=(page, result))
+        thread.daemon = True
+        thread.start()
+        return thread, result
+
+    page = 1
+    items = cls.list(apiclient, page=page, pagesize=pagesize,
+                     **kwargs) or []
+    while items:
+        last = len(items) < pagesize
+        if prefetch and not last:
+            thread, result = fetchAsync(page + 1)
+        for item in items:
+            yield item
+        if last:
+            return
+        page += 1
+        if prefetch:
+            thread.join()
+        else:
+            result = {}
+            fetch(page, result)
+        if "error" in result:
+            raise result["error"]
+        items = result["items"]
 
 
 class Domain:
@@ -591,28 +644,24 @@ class VirtualMachine:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
-                        operation timed out" % state]
+        def inState():
+            projectid = None
+            if hasattr(self, "projectid"):
+                projectid = self.projectid
+            vms = VirtualMachine.list(apiclient, projectid=projectid,
+                    id=self.id, listAll=True)
+            validationresult = validateList(vms)
+            if validationresult[0] == FAIL:
+                raise Exception("VM list validation failed: %s" % validationresult[2])
+            return str(vms[0].state).lower().decode("string_escape") == str(state).lower()
 
-        while timeout > 0:
-            try:
-                projectid = None
-                if hasattr(self, "projectid"):
-                    projectid = self.projectid
-                vms = VirtualMachine.list(apiclient, projectid=projectid,
-                        id=self.id, listAll=True)
-                validationresult = validateList(vms)
-                if validationresult[0] == FAIL:
-                    raise Exception("VM list validation failed: %s" % validationresult[2])
-                elif str(vms[0].state).lower().decode("string_escape") == str(state).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
+        try:
+            if wait_until(inState, timeout=timeout, interval=2)[0] == PASS:
+                return [PASS, None]
+        except Exception as e:
+            return [FAIL, e]
+        return [FAIL, "VM state not trasited to %s,\
+                        operation timed out" % state]
 
     def resetSshKey(self, apiclient, **kwargs):
         """Resets SSH key"""
@@ -1036,19 +1085,14 @@ class Snapshot:
                           else FAIL
                  @Reason: Reason for failure in case Result is FAIL
         """
-        isSnapshotInRequiredState = False
+        def inState():
+            snapshots = Snapshot.list(apiclient, id=self.id)
+            assert validateList(snapshots)[0] == PASS, "snapshots list\
+                    validation failed"
+            return str(snapshots[0].state).lower() == snapshotstate
+
         try:
-            while timeout >= 0:
-                snapshots = Snapshot.list(apiclient, id=self.id)
-                assert validateList(snapshots)[0] == PASS, "snapshots list\
-                        validation failed"
-                if str(snapshots[0].state).lower() == snapshotstate:
-                    isSnapshotInRequiredState = True
-                    break
-                timeout -= 60
-                time.sleep(60)
-            #end while
-            if isSnapshotInRequiredState:
+            if wait_until(inState, timeout=timeout, interval=5)[0] == PASS:
                 return[PASS, None]
             else:
                 raise Exception("Snapshot not in required state")
@@ -2540,25 +2584,21 @@ class Host:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
-                        operation timed out" % state]
+        def inState():
+            hosts = Host.list(apiclient,
+                      id=hostid, listall=True)
+            validationresult = validateList(hosts)
+            if validationresult[0] == FAIL:
+                raise Exception("Host list validation failed: %s" % validationresult[2])
+            return str(hosts[0].state).lower().decode("string_escape") == str(state).lower() and str(hosts[0].resourcestate).lower().decode("string_escape") == str(resourcestate).lower()
 
-        while timeout > 0:
-            try:
-                hosts = Host.list(apiclient,
-                          id=hostid, listall=True)
-                validationresult = validateList(hosts)
-                if validationresult[0] == FAIL:
-                    raise Exception("Host list validation failed: %s" % validationresult[2])
-                elif str(hosts[0].state).lower().decode("string_escape") == str(state).lower() and str(hosts[0].resourcestate).lower().decode("string_escape") == str(resourcestate).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
+        try:
+            if wait_until(inState, timeout=timeout, interval=2)[0] == PASS:
+                return [PASS, None]
+        except Exception as e:
+            return [FAIL, e]
+        return [FAIL, "VM state not trasited to %s,\
+                        operation timed out" % state]
 
 class StoragePool:
     """Manage Storage pools (Primary Storage)"""
@@ -2695,25 +2735,21 @@ class StoragePool:
                        to expected state in given time else PASS
                        2) Reason - Reason for failure"""
 
-        returnValue = [FAIL, "VM state not trasited to %s,\
-                        operation timed out" % state]
+        def inState():
+            pools = StoragePool.list(apiclient,
+                      id=poolid, listAll=True)
+            validationresult = validateList(pools)
+            if validationresult[0] == FAIL:
+                raise Exception("Host list validation failed: %s" % validationresult[2])
+            return str(pools[0].state).lower().decode("string_escape") == str(state).lower()
 
-        while timeout > 0:
-            try:
-                pools = StoragePool.list(apiclient,
-                          id=poolid, listAll=True)
-                validationresult = validateList(pools)
-                if validationresult[0] == FAIL:
-                    raise Exception("Host list validation failed: %s" % validationresult[2])
-                elif str(pools[0].state).lower().decode("string_escape") == str(state).lower():
-                    returnValue = [PASS, None]
-                    break
-            except Exception as e:
-                returnValue = [FAIL, e]
-                break
-            time.sleep(60)
-            timeout -= 60
-        return returnValue
+        try:
+            if wait_until(inState, timeout=timeout, interval=2)[0] == PASS:
+                return [PASS, None]
+        except Exception as e:
+            return [FAIL, e]
+        return [FAIL, "VM state not trasited to %s,\
+                        operation timed out" % state]
 
 class Network:
     """Manage Network pools"""
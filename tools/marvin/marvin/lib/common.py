@@ -68,7 +68,9 @@ from marvin.lib.utils import (validateList,
                               xsplit, 
                               get_process_status,
                               random_gen,
-                              format_volume_to_ext3)
+                              format_volume_to_ext3,
+                              wait_until,
+                              new_events)
 from marvin.lib.base import (PhysicalNetwork,
                              PublicIPAddress,
                              NetworkOffering,
@@ -116,12 +118,16 @@ def is_config_suitable(apiclient, name, value):
     return configs[0].value == value
 
 
-def wait_for_cleanup(apiclient, configs=None):
-    """Sleeps till the cleanup configs passed"""
+def wait_for_cleanup(apiclient, configs=None, condition=None):
+    """Sleeps till the cleanup configs passed
+
+    With condition, e.g. a check that the resource is gone, returns as
+    soon as condition returns a true value, see wait_until()"""
 
     # Configs list consists of the list of global configs
     if not isinstance(configs, list):
         return
+    timeout = 0
     for config in configs:
         cmd = listConfigurations.listConfigurationsCmd()
         cmd.name = config
@@ -135,8 +141,12 @@ def wait_for_cleanup(apiclient, configs=None):
             raise Exception("List configs didn't returned a valid data")
 
         config_desc = config_descs[0]
-        # Sleep for the config_desc.value time
-        time.sleep(int(config_desc.value))
+        timeout += int(config_desc.value)
+    if condition is None:
+        # Sleep for the sum of the config values
+        time.sleep(timeout)
+    else:
+        wait_until(condition, timeout=timeout, interval=5)
     return
 
 
@@ -428,46 +438,31 @@ def download_systemplates_sec_storage(server, services):
 
 
 def wait_for_ssvms(apiclient, zoneid, podid, interval=60):
-    """After setup wait for SSVMs to come Up"""
-
-    time.sleep(interval)
-    timeout = 40
-    while True:
-        list_ssvm_response = list_ssvms(
-            apiclient,
-            systemvmtype='secondarystoragevm',
-            zoneid=zoneid,
-            podid=podid
-        )
-        ssvm = list_ssvm_response[0]
-        if ssvm.state != 'Running':
-            # Sleep to ensure SSVMs are Up and Running
-            time.sleep(interval)
-            timeout = timeout - 1
-        elif ssvm.state == 'Running':
-            break
-        elif timeout == 0:
-            raise Exception("SSVM failed to come up")
-            break
-
-    timeout = 40
-    while True:
-        list_ssvm_response = list_ssvms(
-            apiclient,
-            systemvmtype='consoleproxy',
-            zoneid=zoneid,
-            podid=podid
-        )
-        cpvm = list_ssvm_response[0]
-        if cpvm.state != 'Running':
-            # Sleep to ensure SSVMs are Up and Running
-            time.sleep(interval)
-            timeout = timeout - 1
-        elif cpvm.state == 'Running':
-            break
-        elif timeout == 0:
-            raise Exception("CPVM failed to come up")
-            break
+    """After setup wait for SSVMs to come Up
+
+    Checks the state of the system VMs with backoff up to interval
+    seconds apart, and as soon as they log a start event, for up to 40
+    intervals each"""
+
+    for systemvmtype, eventtype, name in (
+            ('secondarystoragevm', 'SSVM.START', 'SSVM'),
+            ('consoleproxy', 'PROXY.START', 'CPVM')):
+
+        def isRunning():
+            list_ssvm_response = list_ssvms(
+                apiclient,
+                systemvmtype=systemvmtype,
+                zoneid=zoneid,
+                podid=podid
+            )
+            return isinstance(list_ssvm_response, list) and \
+                list_ssvm_response[0].state == 'Running'
+
+        result = wait_until(isRunning, timeout=40 * interval, interval=5,
+                            maxinterval=interval,
+                            wakeup=new_events(apiclient, [eventtype]))
+        if result[0] == FAIL:
+            raise Exception("%s failed to come up" % name)
     return
 
 
@@ -1358,20 +1353,13 @@ def createSnapshotFromVirtualMachineVolume(apiclient, account, vmid):
 
 def isVmExpunged(apiclient, vmid, projectid=None, timeout=600):
     """Verify if VM is expunged or not"""
-    vmExpunged= False
-    while timeout>=0:
+    def isExpunged():
         try:
             vms = VirtualMachine.list(apiclient, id=vmid, projectid=projectid)
-            if vms is None:
-                vmExpunged = True
-                break
-            timeout -= 60
-            time.sleep(60)
         except Exception:
-            vmExpunged = True
-            break
-     #end while
-    return vmExpunged
+            return True
+        return vms is None
+    return wait_until(isExpunged, timeout=timeout, interval=5)[0] == PASS
 
 def isDomainResourceCountEqualToExpectedCount(apiclient, domainid, expectedcount,
                                               resourcetype):
@@ -1552,20 +1540,20 @@ def compareChecksum(
 
 def verifyRouterState(apiclient, routerid, state, listall=True):
     """List router and check if the router state matches the given state"""
-    retriesCount = 10
     isRouterInDesiredState = False
     exceptionOccured = False
     exceptionMessage = ""
+    routers = []
+
+    def inState():
+        routers[:] = Router.list(apiclient, id=routerid,
+                                 listall=listall) or []
+        assert validateList(
+            routers)[0] == PASS, "Routers list validation failed"
+        return str(routers[0].state).lower() == state
     try:
-        while retriesCount >= 0:
-            routers = Router.list(apiclient, id=routerid, listall=listall)
-            assert validateList(
-                routers)[0] == PASS, "Routers list validation failed"
-            if str(routers[0].state).lower() == state:
-                isRouterInDesiredState = True
-                break
-            retriesCount -= 1
-            time.sleep(60)
+        isRouterInDesiredState = \
+            wait_until(inState, timeout=600, interval=5)[0] == PASS
         if not isRouterInDesiredState:
             exceptionMessage = "Router state should be %s, it is %s" %\
                                 (state, routers[0].state)
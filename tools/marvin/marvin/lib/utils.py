@@ -18,8 +18,11 @@
 """
 
 import marvin
+import copy
 import os
 import time
+import threading
+import Queue
 import logging
 import string
 import random
@@ -28,7 +31,8 @@ import email
 import socket
 import urlparse
 import datetime
-from marvin.cloudstackAPI import cloudstackAPIClient, listHosts, listRouters
+from marvin.cloudstackAPI import (cloudstackAPIClient, listHosts,
+                                  listRouters, listEvents)
 from platform import system
 from marvin.cloudstackException import GetDetailExceptionInfo
 from marvin.sshClient import SshClient
@@ -152,10 +156,191 @@ def random_gen(id=None, size=6, chars=string.ascii_uppercase + string.digits):
     return randomstr
 
 
-def cleanup_resources(api_client, resources):
-    """Delete resources"""
+# Resource classes of marvin.lib.base by cleanup tier, a tier is deleted
+# once the tiers before it are. The resources of a concurrent tier are
+# deleted in parallel, the others one at a time in the order given.
+# Resources of other classes are deleted first, in the order given
+CLEANUP_TIERS = [
+    (["NATRule", "StaticNATRule", "EgressFireWallRule", "FireWallRule",
+      "LoadBalancerRule", "ApplicationLoadBalancer", "NetworkACL",
+      "Autoscale", "SnapshotPolicy", "Tag", "StaticRoute", "Vpn",
+      "VpnUser", "ProjectInvitation", "VmSnapshot", "Snapshot"], True),
+    (["VirtualMachine", "PublicIPAddress"], True),
+    (["Volume", "Template", "Iso", "SecurityGroup", "AffinityGroup",
+      "SSHKeyPair", "PrivateGateway", "InstanceGroup"], True),
+    (["Network"], True),
+    # deleting a VPC deletes its ACL lists, they go before it
+    (["NetworkACLList"], True),
+    (["VPC", "VpnCustomerGateway"], True),
+    (["ServiceOffering", "DiskOffering", "NetworkOffering",
+      "VpcOffering", "Project", "User"], True),
+    (["Account"], True),
+    (["Domain"], False),
+    (["PublicIpRange", "PortablePublicIpRange", "StorageNetworkIpRange",
+      "Host", "StoragePool", "Cluster", "Pod", "SecondaryStagingStore",
+      "ImageStore", "NetScaler", "NiciraNvp", "VNMC", "ASA1000V",
+      "NetworkServiceProvider", "TrafficType", "PhysicalNetwork", "Zone"],
+     False),
+]
+
+
+def _cleanup_tier(obj):
+    for cls in type(obj).__mro__:
+        for tier, (names, concurrent) in enumerate(CLEANUP_TIERS):
+            if cls.__name__ in names:
+                return tier + 1
+    return 0
+
+
+def _delete_resource(api_client, obj, retries, retry_delay):
+    """Deletes obj, retrying retries times on failure
+    Returns the seconds taken, the attempts made and the last error"""
+    start = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            obj.delete(api_client)
+            return time.time() - start, attempt, None
+        except Exception as e:
+            if attempt > retries:
+                return time.time() - start, attempt, e
+            time.sleep(retry_delay)
+
+
+def cleanup_resources(api_client, resources, workers=5, retries=0,
+                      retry_delay=5, logger=None):
+    """Delete resources
+
+    The resources are deleted tier by tier as listed in CLEANUP_TIERS,
+    e.g. the virtual machines before the volumes, the networks and the
+    accounts. The resources of a tier are deleted by up to workers
+    threads, each on a copy of api_client. Failed deletes can be retried
+    retries times, retry_delay seconds apart. Stops after the first tier
+    with a resource which could not be deleted and raises its error.
+    Returns the (resource, seconds, attempts) of each resource deleted,
+    the report is logged by logger"""
+    if logger is None:
+        logger = logging.getLogger("testClient")
+    tiers = {}
     for obj in resources:
-        obj.delete(api_client)
+        tiers.setdefault(_cleanup_tier(obj), []).append(obj)
+
+    report = []
+    for tier in sorted(tiers.keys()):
+        objs = tiers[tier]
+        concurrent = tier > 0 and CLEANUP_TIERS[tier - 1][1]
+        results = []
+        if not concurrent or workers <= 1 or len(objs) == 1:
+            for obj in objs:
+                results.append((obj,) + _delete_resource(
+                    api_client, obj, retries, retry_delay))
+                if results[-1][3] is not None:
+                    break
+        else:
+            pending = Queue.Queue()
+            for obj in objs:
+                pending.put(obj)
+            lock = threading.Lock()
+
+            def worker():
+                client = copy.copy(api_client)
+                while True:
+                    try:
+                        obj = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    result = (obj,) + _delete_resource(
+                        client, obj, retries, retry_delay)
+                    with lock:
+                        results.append(result)
+
+            threads = [threading.Thread(target=worker)
+                       for i in range(min(workers, len(objs)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        errors = []
+        for obj, seconds, attempts, error in results:
+            name = "%s %s" % (type(obj).__name__,
+                              getattr(obj, "id", None) or
+                              getattr(obj, "name", ""))
+            if error is None:
+                logger.debug("Deleted %s in %.2fs (%d attempts)" %
+                             (name, seconds, attempts))
+                report.append((obj, seconds, attempts))
+            else:
+                logger.debug("Failed to delete %s after %d attempts: %s" %
+                             (name, attempts, error))
+                errors.append(error)
+        if errors:
+            raise errors[0]
+    return report
+
+
+def wait_until(condition, timeout=600, interval=1, maxinterval=60,
+               wakeup=None):
+    """Calls condition until it returns a true value or timeout seconds
+    have passed
+
+    Waits interval seconds between the calls, doubled after each call up
+    to maxinterval, with 10% jitter. wakeup, e.g. new_events(), is called
+    every interval seconds while waiting and stops the wait early when it
+    returns True. Exceptions raised by condition are not caught
+    @output: List, containing [Result, Reason]
+             PASS and the value returned by condition, or
+             FAIL and the reason if it timed out"""
+    deadline = time.time() + timeout
+    delay = interval
+    while True:
+        result = condition()
+        if result:
+            return [PASS, result]
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return [FAIL, "Condition not met in %ss" % timeout]
+        end = time.time() + min(delay * random.uniform(0.9, 1.1),
+                                remaining)
+        while time.time() < end:
+            time.sleep(min(interval, max(end - time.time(), 0)))
+            if wakeup is not None and wakeup():
+                break
+        delay = min(delay * 2, maxinterval)
+
+
+def new_events(apiclient, eventtypes):
+    """Returns a wakeup for wait_until() which returns True once an event
+    of one of eventtypes, e.g. "VM.START", was logged by the management
+    server after new_events() was called, or after its last wakeup"""
+    cmd = listEvents.listEventsCmd()
+    cmd.listall = True
+    # the events are told apart by id, the start date only bounds the list
+    # and allows for the clocks and timezones of client and server to differ
+    cmd.startdate = (datetime.date.today() -
+                     datetime.timedelta(days=1)).isoformat()
+
+    def listIds():
+        ids = set()
+        for eventtype in eventtypes:
+            cmd.type = eventtype
+            ids.update(event.id for event in apiclient.listEvents(cmd) or [])
+        return ids
+
+    try:
+        seen = listIds()
+    except Exception:
+        return lambda: False
+
+    def wakeup():
+        try:
+            new = listIds() - seen
+        except Exception:
+            return False
+        seen.update(new)
+        return bool(new)
+    return wakeup
 
 
 def is_server_ssh_ready(ipaddress, port, username, password, retries=20, retryinterv=30, timeout=10.0, keyPairFileLocation=None):
@@ -19,11 +19,12 @@ from paramiko import (BadHostKeyException,
                       AuthenticationException,
                       SSHException,
                       SSHClient,
-                      AutoAddPolicy,
-                      Transport,
-                      SFTPClient)
+                      AutoAddPolicy)
+import atexit
 import socket
+import threading
 import time
+import Queue
 from marvin.cloudstackException import (
     internalError,
     GetDetailExceptionInfo
@@ -34,6 +35,29 @@ from marvin.codes import (
     SUCCESS, FAILED, INVALID_INPUT
 )
 
+# Connections kept open for reuse, by (host, port, user, passwd, keys),
+# with the time they were last used. They are closed once idle for
+# IDLE_TIMEOUT seconds
+_connections = {}
+_connectionsLock = threading.Lock()
+IDLE_TIMEOUT = 300
+KEEPALIVE_INTERVAL = 30
+
+
+def closeConnections(idle=0):
+    '''
+    @Name: closeConnections
+    @Desc: Closes the cached connections not used for idle seconds
+    '''
+    with _connectionsLock:
+        now = time.time()
+        for key, (ssh, lastUsed) in _connections.items():
+            if now - lastUsed >= idle:
+                del _connections[key]
+                ssh.close()
+
+atexit.register(closeConnections)
+
 
 class SshClient(object):
 
@@ -46,10 +70,17 @@ class SshClient(object):
             passwd: Password for connection
             retries and delay applies for establishing connection
             timeout : Applies while executing command
+            cache: Reuse the connection of an earlier SshClient with
+                   cache to the same host, port and user with the same
+                   credentials, each command runs on a channel of its
+                   own. Off by default, as creating an SshClient is
+                   used to check that a host can be reached, and the
+                   host behind an address may have changed
     '''
 
     def __init__(self, host, port, user, passwd, retries=60, delay=10,
-                 log_lvl=logging.DEBUG, keyPairFiles=None, timeout=10.0):
+                 log_lvl=logging.DEBUG, keyPairFiles=None, timeout=10.0,
+                 cache=False):
         self.host = None
         self.port = 22
         self.user = user
@@ -77,11 +108,92 @@ class SshClient(object):
             self.timeout = timeout
         if port is not None and port >= 0:
             self.port = port
+        self.retries = self.retryCnt
+        self.cache = cache
+        keys = keyPairFiles
+        if isinstance(keys, list):
+            keys = tuple(keys)
+        self.cacheKey = (self.host, self.port, self.user, self.passwd, keys)
+        if self.cache and self.__fromCache():
+            return
         if self.createConnection() == FAILED:
             raise internalError("SSH Connection Failed")
+        self.__addToCache()
+
+    def __fromCache(self):
+        '''
+        @Desc: Uses the cached connection if there is one which still
+               opens a session within timeout
+        '''
+        closeConnections(IDLE_TIMEOUT)
+        with _connectionsLock:
+            if self.cacheKey not in _connections:
+                return False
+            ssh = _connections[self.cacheKey][0]
+        try:
+            transport = ssh.get_transport()
+            transport.open_session(timeout=self.timeout).close()
+        except Exception as e:
+            self.logger.debug("===Cached SSH connection to Host %s port : %s"
+                              " is down: %s===" %
+                              (str(self.host), str(self.port),
+                               GetDetailExceptionInfo(e)))
+            with _connectionsLock:
+                if _connections.get(self.cacheKey, [None])[0] is ssh:
+                    del _connections[self.cacheKey]
+            ssh.close()
+            return False
+        with _connectionsLock:
+            if _connections.get(self.cacheKey, [None])[0] is ssh:
+                _connections[self.cacheKey][1] = time.time()
+        self.ssh = ssh
+        self.logger.debug("===Reusing SSH connection to Host %s port : %s==="
+                          % (str(self.host), str(self.port)))
+        return True
+
+    def __addToCache(self):
+        if not self.cache:
+            return
+        transport = self.ssh.get_transport()
+        if transport is not None:
+            transport.set_keepalive(KEEPALIVE_INTERVAL)
+        with _connectionsLock:
+            old = _connections.get(self.cacheKey)
+            _connections[self.cacheKey] = [self.ssh, time.time()]
+        if old is not None and old[0] is not self.ssh:
+            old[0].close()
+
+    def __execCommand(self, command, **kwargs):
+        '''
+        @Desc: Runs command on a new channel. A cached connection
+               which went down, e.g. as the host rebooted, is
+               replaced by a new one
+        '''
+        try:
+            result = self.ssh.exec_command(command, **kwargs)
+        except (SSHException, socket.error, EOFError) as e:
+            if not self.cache:
+                raise
+            self.logger.debug("SshClient: Reconnecting to Host %s: %s" %
+                              (str(self.host), GetDetailExceptionInfo(e)))
+            with _connectionsLock:
+                if _connections.get(self.cacheKey, [None])[0] is self.ssh:
+                    del _connections[self.cacheKey]
+            self.ssh.close()
+            self.ssh = SSHClient()
+            self.ssh.set_missing_host_key_policy(AutoAddPolicy())
+            self.retryCnt = self.retries
+            if self.createConnection() == FAILED:
+                raise internalError("SSH Connection Failed")
+            self.__addToCache()
+            result = self.ssh.exec_command(command, **kwargs)
+        with _connectionsLock:
+            if _connections.get(self.cacheKey, [None])[0] is self.ssh:
+                _connections[self.cacheKey][1] = time.time()
+        return result
 
     def execute(self, command):
-        stdin, stdout, stderr = self.ssh.exec_command(command)
+        stdin, stdout, stderr = self.__execCommand(command)
         output = stdout.readlines()
         errors = stderr.readlines()
         results = []
@@ -170,8 +282,8 @@ class SshClient(object):
             return ret
         try:
             status_check = 1
-            stdin, stdout, stderr = self.ssh.\
-                exec_command(command, timeout=self.timeout)
+            stdin, stdout, stderr = self.\
+                __execCommand(command, timeout=self.timeout)
             if stdout is not None:
                 status_check = stdout.channel.recv_exit_status()
                 if status_check == 0:
@@ -189,23 +301,72 @@ class SshClient(object):
             return ret
 
     def scp(self, srcFile, destPath):
-        transport = Transport((self.host, int(self.port)))
-        transport.connect(username=self.user, password=self.passwd)
-        sftp = SFTPClient.from_transport(transport)
+        sftp = self.ssh.open_sftp()
         try:
             sftp.put(srcFile, destPath)
         except IOError as e:
             raise e
+        finally:
+            sftp.close()
 
     def __del__(self):
         self.close()
 
     def close(self):
+        '''
+        @Desc: Closes the connection, a cached connection is left open
+               for reuse until it is idle for IDLE_TIMEOUT seconds
+        '''
         if self.ssh is not None:
-            self.ssh.close()
+            with _connectionsLock:
+                cached = _connections.get(self.cacheKey, [None])[0] \
+                    is self.ssh
+            if not cached:
+                self.ssh.close()
             self.ssh = None
 
 
+def runCommandOnHosts(hosts, command, user, passwd, port=22,
+                      keyPairFiles=None, workers=10, retries=5, delay=5,
+                      timeout=10.0, cache=False):
+    '''
+    @Name: runCommandOnHosts
+    @Desc: Runs command on each of hosts, on up to workers hosts at a
+           time, with cache over the cached connections
+    @Output: Dict of host to the runCommand() result, the stderr of a
+             host which could not be connected to is the reason
+    '''
+    pending = Queue.Queue()
+    for host in hosts:
+        pending.put(host)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                host = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                ssh = SshClient(host, port, user, passwd, retries=retries,
+                                delay=delay, keyPairFiles=keyPairFiles,
+                                timeout=timeout, cache=cache)
+                result = ssh.runCommand(command)
+                ssh.close()
+            except Exception as e:
+                result = {"status": FAILED, "stdin": None, "stdout": None,
+                          "stderr": GetDetailExceptionInfo(e)}
+            results[host] = result
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(workers, len(hosts)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 if __name__ == "__main__":
     with contextlib.closing(SshClient("127.0.0.1", 22, "root",
                                       "asdf!@34")) as ssh: